@@ -2,16 +2,26 @@
 from trytond.pool import Pool
 from .models import (DiseaseNotification, TravelHistory, NotificationSymptom,
                      NotifiedSpecimen, GnuHealthSequences, RiskFactorCondition,
-                     NotificationStateChange, LabResultType)
+                     NotificationStateChange, LabResultType, Party, Patient,
+                     Pathology,
+                     NotificationCaseCount, OutbreakSignal,
+                     NotificationCluster, NotificationClusterMember,
+                     NotificationDuplicate, ReportCache, ReportJob)
 from .reports import (RawDataReport, CaseCountReport, CaseCountWizard,
-                      CaseCountStartModel, Notifications)
-from .wizards import NotifyFromEncounter
+                      CaseCountStartModel, Notifications, PivotStartModel,
+                      PivotWizard, PivotReport, ExportStartModel,
+                      ExportJobWizard)
+from .wizards import (NotifyFromEncounter, ReclassifyStart, ReclassifyDone,
+                      ReclassifyWizard)
 
 
 def register():
     """Register models to tryton's pool"""
     Pool.register(
         GnuHealthSequences,
+        Party,
+        Patient,
+        Pathology,
         DiseaseNotification,
         NotificationSymptom,
         LabResultType,
@@ -19,16 +29,31 @@ def register():
         RiskFactorCondition,
         TravelHistory,
         NotificationStateChange,
+        NotificationCaseCount,
+        OutbreakSignal,
+        NotificationCluster,
+        NotificationClusterMember,
+        NotificationDuplicate,
+        ReportCache,
+        ReportJob,
         CaseCountStartModel,
+        PivotStartModel,
+        ExportStartModel,
+        ReclassifyStart,
+        ReclassifyDone,
         module='health_disease_notification', type_='model')
 
     Pool.register(
         RawDataReport,
         CaseCountReport,
+        PivotReport,
         Notifications,
         module='health_disease_notification', type_='report')
 
     Pool.register(
         CaseCountWizard,
+        PivotWizard,
+        ExportJobWizard,
         NotifyFromEncounter,
+        ReclassifyWizard,
         module='health_disease_notification', type_='wizard')
@@ -0,0 +1,170 @@
+'''
+Aberration detection over weekly case counts.
+
+Every function takes a 2 dimensional array of counts, one row per series
+(e.g. a diagnosis or a diagnosis in a parish) and one column per week, and
+works on all the series at once. The statistics are NaN for the weeks that
+do not have enough history.
+'''
+import numpy as np
+
+# days between 0001-01-01 and 1970-01-04, the first Sunday of 1970. Epi
+# weeks start on Sunday so week_index counts whole epi weeks from there.
+WEEK_ZERO = 719166
+
+
+def week_index(value):
+    '''returns the number of the epi week of the date value since 1970'''
+    return (value.toordinal() - WEEK_ZERO) // 7
+
+
+def week_start(index):
+    '''returns the ordinal of the Sunday that starts the epi week index'''
+    return WEEK_ZERO + 7 * index
+
+
+def count_matrix(cells, weeks):
+    '''
+    returns (keys, counts) from cells, (key, week, count) tuples: counts
+    has a row of weeks columns for each of the sorted keys
+    '''
+    keys = sorted(set([x[0] for x in cells]))
+    counts = np.zeros((len(keys), weeks))
+    if cells:
+        index = dict([(x, i) for i, x in enumerate(keys)])
+        cells = np.array([(index[x], week, count)
+                          for x, week, count in cells], dtype=int)
+        counts[cells[:, 0], cells[:, 1]] = cells[:, 2]
+    return keys, counts
+
+
+def _rolling_baseline(counts, lag, length):
+    '''
+    returns the mean and sample standard deviation of the length weeks
+    ending lag weeks before each week
+    '''
+    series, weeks = counts.shape
+    mean = np.full((series, weeks), np.nan)
+    sd = np.full((series, weeks), np.nan)
+    first = lag + length - 1
+    if weeks <= first:
+        return mean, sd
+    zeros = np.zeros((series, 1))
+    sums = np.hstack([zeros, np.cumsum(counts, axis=1)])
+    squares = np.hstack([zeros, np.cumsum(counts ** 2, axis=1)])
+    end = slice(first - lag + 1, weeks - lag + 1)
+    start = slice(first - lag + 1 - length, weeks - lag + 1 - length)
+    total = sums[:, end] - sums[:, start]
+    total_sq = squares[:, end] - squares[:, start]
+    mean[:, first:] = total / length
+    variance = (total_sq - total ** 2 / length) / (length - 1)
+    sd[:, first:] = np.sqrt(np.maximum(variance, 0))
+    return mean, sd
+
+
+def ears(counts, method='C1', min_sd=0.5):
+    '''
+    returns the EARS statistic of method (C1, C2 or C3) for each week.
+    C1 compares a week with the mean of the 7 weeks before it, C2 with the
+    7 weeks before a 2 week guard band and C3 sums the excess of C2 over
+    1 for the week and the 2 before it. min_sd keeps a series without
+    any variation in its baseline from flagging every single case.
+    '''
+    counts = np.asarray(counts, dtype=float)
+    lag = 1 if method == 'C1' else 3
+    mean, sd = _rolling_baseline(counts, lag, 7)
+    stat = (counts - mean) / np.maximum(sd, min_sd)
+    if method != 'C3':
+        return stat
+    excess = np.maximum(stat - 1, 0)
+    c3 = np.full(stat.shape, np.nan)
+    c3[:, 2:] = excess[:, 2:] + excess[:, 1:-1] + excess[:, :-2]
+    return c3
+
+
+def cusum(counts, k=0.5, min_sd=0.5, lag=3, length=7):
+    '''
+    returns the one sided CUSUM of the counts standardised against the
+    length weeks ending lag weeks before each week. The sum restarts from
+    0 after it went over the threshold (see THRESHOLDS) and wherever the
+    baseline is missing.
+    '''
+    counts = np.asarray(counts, dtype=float)
+    mean, sd = _rolling_baseline(counts, lag, length)
+    z = (counts - mean) / np.maximum(sd, min_sd)
+    stat = np.full(z.shape, np.nan)
+    current = np.zeros(z.shape[0])
+    threshold = THRESHOLDS['CUSUM']
+    for week in range(z.shape[1]):
+        step = z[:, week]
+        known = ~np.isnan(step)
+        current = np.where(known, np.maximum(current + step - k, 0), 0)
+        stat[:, week] = np.where(known, current, np.nan)
+        current[current > threshold] = 0
+    return stat
+
+
+def historical_limits(counts, years=5, window=1, weeks_per_year=52,
+                      min_sd=0.5):
+    '''
+    returns the historical limits statistic: how many standard deviations
+    the count of a week is above the mean of the same week, the one before
+    and the one after, in each of the previous years. Needs years of
+    history before the first week it can be computed for.
+    '''
+    counts = np.asarray(counts, dtype=float)
+    series, weeks = counts.shape
+    stat = np.full((series, weeks), np.nan)
+    first = years * weeks_per_year + window
+    if weeks <= first:
+        return stat
+    total = np.zeros((series, weeks - first))
+    total_sq = np.zeros((series, weeks - first))
+    offsets = [year * weeks_per_year + shift
+               for year in range(1, years + 1)
+               for shift in range(-window, window + 1)]
+    for offset in offsets:
+        past = counts[:, first - offset:weeks - offset]
+        total += past
+        total_sq += past ** 2
+    size = len(offsets)
+    mean = total / size
+    sd = np.sqrt(np.maximum((total_sq - total ** 2 / size) / (size - 1), 0))
+    stat[:, first:] = (counts[:, first:] - mean) / np.maximum(sd, min_sd)
+    return stat
+
+
+METHODS = {
+    'C1': lambda counts: ears(counts, 'C1'),
+    'C2': lambda counts: ears(counts, 'C2'),
+    'C3': lambda counts: ears(counts, 'C3'),
+    'CUSUM': cusum,
+    'HLM': historical_limits,
+}
+# a week is flagged when the statistic of the method goes over these
+THRESHOLDS = {
+    'C1': 3.0,
+    'C2': 3.0,
+    'C3': 2.0,
+    'CUSUM': 4.0,
+    'HLM': 2.0,
+}
+
+
+def detect(counts, methods=None, first_week=0):
+    '''
+    runs methods (default all of METHODS) on counts and returns, per
+    method, the (series, week, statistic) of the flagged weeks from
+    first_week on. Weeks without cases are never flagged.
+    '''
+    counts = np.asarray(counts, dtype=float)
+    flagged = {}
+    for method in methods or sorted(METHODS):
+        stat = METHODS[method](counts)
+        with np.errstate(invalid='ignore'):
+            hits = (stat > THRESHOLDS[method]) & (counts > 0)
+        hits[:, :first_week] = False
+        series, weeks = np.nonzero(hits)
+        flagged[method] = list(zip(series.tolist(), weeks.tolist(),
+                                   stat[series, weeks].tolist()))
+    return flagged
@@ -0,0 +1,120 @@
+'''
+Archive tables built on PostgreSQL table inheritance.
+
+An archive table inherits from the table of a model, so every query on the
+model's table, which does not use ONLY, also reads and updates the archived
+rows. Rows are moved with a single DELETE ... RETURNING / INSERT statement
+per table. The rows of the tables that reference them through a foreign key
+are moved first, into archive tables of their own, because foreign keys are
+not inherited and would otherwise cascade.
+'''
+
+
+def quote(name):
+    return '"%s"' % name
+
+
+def archive_name(table, year):
+    '''returns the name of the archive table of table for year'''
+    # short suffix, the names of relation tables are long already
+    return '%s_a%d' % (table, year)
+
+
+def table_exists(cursor, table):
+    cursor.execute('SELECT 1 FROM pg_class WHERE relname = %s '
+                   'AND relkind = \'r\'', (table,))
+    return bool(cursor.fetchone())
+
+
+def columns(cursor, table):
+    '''returns the names of the columns of table, in order'''
+    cursor.execute('SELECT attname FROM pg_attribute '
+                   'WHERE attrelid = %s::regclass AND attnum > 0 '
+                   'AND NOT attisdropped ORDER BY attnum', (quote(table),))
+    return [x for x, in cursor.fetchall()]
+
+
+def referencing_columns(cursor, table):
+    '''
+    returns [(table, column)] of the foreign keys that reference the id of
+    table, from other tables
+    '''
+    cursor.execute('SELECT r.relname, a.attname FROM pg_constraint c '
+                   'JOIN pg_class r ON r.oid = c.conrelid '
+                   'JOIN pg_attribute a ON a.attrelid = c.conrelid '
+                   'AND a.attnum = c.conkey[1] '
+                   'WHERE c.contype = \'f\' AND c.confrelid = %s::regclass '
+                   'AND c.conrelid != c.confrelid', (quote(table),))
+    return cursor.fetchall()
+
+
+def create_archive(cursor, table, archive, check=None, indexes=()):
+    '''
+    creates the archive table, inheriting from table, with a primary key on
+    id, the check constraint and an index on each of the indexes columns,
+    unless it exists
+    '''
+    if table_exists(cursor, archive):
+        return
+    cursor.execute('CREATE TABLE %s (PRIMARY KEY (id)%s) INHERITS (%s)' % (
+        quote(archive), ', CHECK (%s)' % check if check else '',
+        quote(table)))
+    for column in indexes:
+        cursor.execute('CREATE INDEX %s ON %s (%s)' % (
+            quote('%s_%s_index' % (archive, column)), quote(archive),
+            quote(column)))
+
+
+def move_rows(cursor, source, target, column, ids, only=True):
+    '''
+    moves the rows of source whose column is in ids to target, which has
+    the same columns, and returns the ids of the rows moved. only leaves
+    out the tables that inherit from source.
+    '''
+    if not ids:
+        return []
+    names = ', '.join([quote(x) for x in columns(cursor, target)])
+    cursor.execute('WITH moved AS (DELETE FROM %s %s WHERE %s IN %%s '
+                   'RETURNING %s) INSERT INTO %s (%s) SELECT %s FROM moved '
+                   'RETURNING id' % (
+                       'ONLY' if only else '', quote(source), quote(column),
+                       names, quote(target), names, names),
+                   (tuple(ids),))
+    return [x for x, in cursor.fetchall()]
+
+
+def archive_rows(cursor, table, ids, year, check=None, link=None):
+    '''
+    moves the rows of table with ids to its archive table for year, after
+    moving the rows that reference them to their own archive tables for
+    year. check is the check constraint of the archive table, link the
+    column that references the parent when table is a referencing table.
+    '''
+    for child, column in referencing_columns(cursor, table):
+        cursor.execute('SELECT id FROM ONLY %s WHERE %s IN %%s' % (
+            quote(child), quote(column)), (tuple(ids),))
+        child_ids = [x for x, in cursor.fetchall()]
+        if child_ids:
+            archive_rows(cursor, child, child_ids, year, link=column)
+    archive = archive_name(table, year)
+    create_archive(cursor, table, archive, check, [link] if link else [])
+    return move_rows(cursor, table, archive, 'id', ids)
+
+
+def restore_rows(cursor, table, ids, year):
+    '''
+    moves the rows of table with ids back from its archive table for year,
+    then the rows that reference them from their archive tables
+    '''
+    archive = archive_name(table, year)
+    if not ids or not table_exists(cursor, archive):
+        return []
+    restored = move_rows(cursor, archive, table, 'id', ids)
+    for child, column in referencing_columns(cursor, table):
+        child_archive = archive_name(child, year)
+        if not table_exists(cursor, child_archive):
+            continue
+        cursor.execute('SELECT id FROM %s WHERE %s IN %%s' % (
+            quote(child_archive), quote(column)), (tuple(ids),))
+        restore_rows(cursor, child, [x for x, in cursor.fetchall()], year)
+    return restored
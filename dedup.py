@@ -0,0 +1,116 @@
+'''
+Duplicate notification detection.
+
+Notifications are given as tuples of (id, patient name, date of birth,
+diagnosis, date of onset). Only notifications that share a block, a
+diagnosis and onset window plus either the date of birth or the start of
+the normalised name, are compared, so the work grows with the size of the
+blocks instead of with the square of the number of notifications. Blocks
+bigger than MAX_BLOCK are compared with a sliding window over their sorted
+names instead.
+'''
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+# days between the onsets of two notifications of the same case
+ONSET_WINDOW = 14
+MAX_BLOCK = 200
+# notifications compared with each other in blocks bigger than MAX_BLOCK
+SLIDING_WINDOW = 20
+# pairs scoring this or more are possible duplicates
+THRESHOLD = 0.8
+
+
+def normalize_name(name):
+    '''
+    returns name in lower case, without accents or punctuation and with
+    its words sorted, so that "O'Brien, Mary-Ann" matches "mary ann obrien"
+    '''
+    if not name:
+        return u''
+    if not isinstance(name, unicode):
+        name = name.decode('utf-8')
+    name = unicodedata.normalize('NFKD', name)
+    name = u''.join([x for x in name if not unicodedata.combining(x)])
+    name = re.sub(r"['`]", u'', name.lower())
+    return u' '.join(sorted(re.findall(r'\w+', name, re.UNICODE)))
+
+
+def _blocks(records):
+    '''
+    returns the lists of records sharing a block key. Each record goes to
+    the blocks of its onset window and of the next one so that onsets
+    close to the edge of a window still meet.
+    '''
+    blocks = {}
+    for record in records:
+        _, name, dob, diagnosis, onset = record
+        if onset:
+            window = onset.toordinal() // ONSET_WINDOW
+            windows = [window, window + 1]
+        else:
+            windows = [None]
+        keys = [('name', name[:4])] if name else []
+        if dob:
+            keys.append(('dob', dob))
+        for key in keys:
+            for window in windows:
+                blocks.setdefault((diagnosis, window) + key, []).append(
+                    record)
+    return blocks.values()
+
+
+def _block_pairs(block):
+    if len(block) <= MAX_BLOCK:
+        for index, first in enumerate(block):
+            for second in block[index + 1:]:
+                yield first, second
+    else:
+        block = sorted(block, key=lambda x: x[1])
+        for index, first in enumerate(block):
+            for second in block[index + 1:index + 1 + SLIDING_WINDOW]:
+                yield first, second
+
+
+def score(first, second):
+    '''
+    returns the similarity, from 0 to 1, of two notifications: mostly
+    their names, then their dates of birth and onsets
+    '''
+    _, name, dob, _, onset = first
+    _, other_name, other_dob, _, other_onset = second
+    result = 0.6 * SequenceMatcher(None, name, other_name).ratio()
+    if dob and other_dob:
+        # a typo in one digit of the date of birth still counts for most
+        result += 0.25 * SequenceMatcher(None, dob.isoformat(),
+                                         other_dob.isoformat()).ratio()
+    elif not dob and not other_dob:
+        result += 0.1
+    if onset and other_onset:
+        days = abs((onset - other_onset).days)
+        result += 0.15 * max(0, 1 - float(days) / ONSET_WINDOW)
+    return result
+
+
+def find_pairs(records, new_ids=None, threshold=THRESHOLD):
+    '''
+    returns {(id, other id): score} for the pairs of records (as described
+    above, with names normalised) scoring at least threshold. With new_ids
+    only the pairs with at least one of them are returned. The smaller id
+    comes first.
+    '''
+    pairs = {}
+    for block in _blocks(records):
+        if new_ids is not None and not any([x[0] in new_ids
+                                            for x in block]):
+            continue
+        for first, second in _block_pairs(block):
+            key = tuple(sorted([first[0], second[0]]))
+            if key[0] == key[1] or key in pairs:
+                continue
+            if new_ids is not None and not (key[0] in new_ids or
+                                            key[1] in new_ids):
+                continue
+            pairs[key] = score(first, second)
+    return dict([(x, y) for x, y in pairs.iteritems() if y >= threshold])
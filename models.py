@@ -1,15 +1,38 @@
 
 from trytond.model import ModelView, ModelSQL, fields, ModelSingleton
-from trytond.pyson import Eval, In, And, Bool
-from trytond.pool import Pool
+from trytond.pyson import Eval, In, Bool, Or
+from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
-from sql import operators, Column
+from trytond import backend
+from trytond.config import config
+from trytond.rpc import RPC
+from trytond.protocols.jsonrpc import JSONEncoder, JSONDecoder
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.ir.sequence import sql_sequence
+from sql import operators, Table, Column, Literal, Cast
+from sql.functions import (Age, Extract, Substring, CurrentTimestamp,
+                           ToChar)
+from sql.conditionals import Coalesce, Case
+from sql.aggregate import Count, Sum, Min, Max
 from trytond.modules.health_jamaica.tryton_utils import (
-    get_epi_week, replace_clause_column, epiweek_str
+    get_epi_week, epiweek_str
 )
+from .utils import (SQL_OPERATORS, transaction_cache,
+                    clear_transaction_cache, format_age, CodeGenerator,
+                    many2one_values, domain_fields, cached_field_values,
+                    Rollup, Grouping, Replace, TxidCurrent,
+                    WORKER_SLOTS)
+from . import aberration, scan, dedup, archive
 
+import os
 import re
-from datetime import datetime, date
+import json
+import time
+import hashlib
+import logging
+import threading
+from datetime import datetime, date, timedelta
+from itertools import groupby
 
 ONLY_IF_ADMITTED = {'invisible': ~Eval('hospitalized', False)}
 ONLY_IF_LAB = {'invisible': ~Eval('specimen_taken', False)}
@@ -21,6 +44,8 @@ RO_SAVED = {'readonly': Eval('id', 0) > 0}  # readonly after saved
 RO_NEW = {'readonly': Eval('id', 0) < 0}  # readonly when new
 
 SEX_OPTIONS = [('m', 'Male'), ('f', 'Female'), ('u', 'Unknown')]
+# patient derived fields and the party.party column they are read from
+PATIENT_PARTY_FIELDS = {'sex': 'sex', 'puid': 'ref'}
 NOTIFICATION_STATES = [
     (None, ''),
     ('waiting', 'Awaiting Classification'),
@@ -50,6 +75,85 @@ SPECIMEN_TYPES = [
     ('blood smear', 'Blood Smear'),
     ('unknown', 'Unknown')]
 
+# per process code generators used by the 'worker' code_mode,
+# keyed by (database name, pid)
+CODE_GENERATORS = {}
+CODE_GENERATOR_LOCK = threading.Lock()
+WORKER_SLOT_SEQUENCE = 'gnuhealth_disease_notification_worker_slot'
+# creates tried with new worker slots when a code was already taken
+WORKER_CODE_ATTEMPTS = 3
+# the invalidations of the report cache, by transaction, see ReportCache
+REPORT_CACHE_LOG = 'gnuhealth_disease_notification_report_cache_log'
+# how long the invalidations are kept, longer than any transaction runs
+REPORT_CACHE_LOG_AGE = timedelta(days=1)
+# lower bounds, in days since the sample was taken, of the age buckets of
+# the lab backlog
+LAB_BACKLOG_BUCKETS = (0, 4, 8, 15)
+# notification fields that the case counts are keyed on, a change to any of
+# them (or to active) moves the notification to another count
+CASE_COUNT_FIELDS = ['diagnosis', 'epi_week_onset', 'status',
+                     'reporting_facility', 'active']
+STORAGE_TIERS = [
+    ('hot', 'Current'),
+    ('archive', 'Archived')
+]
+SIGNAL_METHODS = [
+    ('C1', 'EARS C1'),
+    ('C2', 'EARS C2'),
+    ('C3', 'EARS C3'),
+    ('CUSUM', 'CUSUM'),
+    ('HLM', 'Historical Limits')
+]
+# notifications in these states are left out of the outbreak detection
+SIGNAL_EXCLUDED_STATES = ['discarded', 'notsuspected', 'delete', 'invalid']
+# weeks of history loaded for the outbreak detection, enough for the 5
+# years the historical limits look back
+SIGNAL_HISTORY_WEEKS = 6 * 52
+DUPLICATE_STATES = [
+    ('pending', 'Pending review'),
+    ('duplicate', 'Duplicate'),
+    ('distinct', 'Not a duplicate')
+]
+# the notification fields the cached reports read, a write to any of them
+# drops the cached reports that cover the notification
+REPORT_CACHE_FIELDS = CASE_COUNT_FIELDS + ['date_notified', 'date_onset',
+                                           'patient']
+SCAN_TYPES = [
+    ('retrospective', 'Retrospective'),
+    ('prospective', 'Prospective')
+]
+# what notifications can be counted by in pivot
+PIVOT_DIMENSIONS = [
+    ('diagnosis', 'Diagnosis'),
+    ('status', 'Status'),
+    ('parish', 'Parish'),
+    ('reporting_facility', 'Reporting facility'),
+    ('sex', 'Sex'),
+    ('age_band', 'Age group'),
+    ('week', 'Epi. week of onset'),
+    ('month', 'Month of onset'),
+    ('year', 'Year of onset'),
+]
+# the lowest age, in years at onset, of each age group
+PIVOT_AGE_BANDS = (0, 1, 5, 15, 25, 45, 65)
+
+# bytes of a report file sent to the database at a time, see ReportJob
+REPORT_JOB_CHUNK = 1024 * 1024
+REPORT_JOB_STATES = [
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+    ('cancelled', 'Cancelled'),
+]
+# the report job worker threads of this process, keyed by database name,
+# and when each running job last recorded its progress
+_REPORT_JOB_WORKERS = {}
+_REPORT_JOB_PROGRESS = {}
+_REPORT_JOB_LOCK = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
 LAB_RESULT_STATES = [
     (None, ''),
     ('pos', 'Positive'),
@@ -68,6 +172,84 @@ LAB_TEST_TYPES = [
 ]
 
 
+def order_selection_display(name):
+    '''returns an order method that sorts on the label of a *_display'''
+    @classmethod
+    def order(cls, tables):
+        table, _ = tables[None]
+        return [cls._selection_display_case(table, name)]
+    return order
+
+
+class SelectionDisplayMixin(object):
+    '''
+    Implements the <field>_display function fields that show the label of
+    the value selected in the Selection field <field>. The value to label
+    maps are built once in __setup__, the labels are translated once per
+    transaction and are available as SQL CASE expressions for searching
+    and sorting.
+    '''
+
+    @classmethod
+    def __setup__(cls):
+        super(SelectionDisplayMixin, cls).__setup__()
+        cls._selection_display = {}
+        for name in dir(cls):
+            if not name.endswith('_display'):
+                continue
+            real_field = name[:0 - len('_display')]
+            field = getattr(cls, real_field, None)
+            if (isinstance(getattr(cls, name), fields.Function) and
+                    isinstance(field, fields.Selection) and
+                    isinstance(field.selection, (list, tuple))):
+                cls._selection_display[name] = (
+                    real_field, [x for x in field.selection if x[0]])
+
+    @classmethod
+    def _selection_labels(cls, name):
+        '''returns {value: translated label} for the display field name'''
+        language = Transaction().language
+        cache = transaction_cache('%s.selection_display' % cls.__name__)
+        if (name, language) not in cache:
+            Translation = Pool().get('ir.translation')
+            real_field, selection = cls._selection_display[name]
+            source = '%s,%s' % (cls.__name__, real_field)
+            cache[(name, language)] = dict([
+                (value, Translation.get_source(source, 'selection', language,
+                                               label) or label)
+                for value, label in selection])
+        return cache[(name, language)]
+
+    @classmethod
+    def _selection_display_case(cls, table, name):
+        real_field, _ = cls._selection_display[name]
+        column = Column(table, real_field)
+        return Case(*[(column == value, label) for value, label
+                      in cls._selection_labels(name).iteritems()],
+                    else_='')
+
+    @classmethod
+    def get_selection_display(cls, instances, names):
+        result = {}
+        for name in names:
+            real_field, _ = cls._selection_display[name]
+            labels = cls._selection_labels(name)
+            result[name] = dict([
+                (x.id, labels.get(getattr(x, real_field), ''))
+                for x in instances])
+        return result
+
+    @classmethod
+    def search_selection_display(cls, name, clause):
+        _, operator, value = clause
+        if value is None:
+            value = ''
+        table = cls.__table__()
+        column = cls._selection_display_case(table, name)
+        return [('id', 'in', table.select(
+            table.id, where=SQL_OPERATORS[operator](column, value)))]
+
+
 class GnuHealthSequences(ModelSingleton, ModelSQL, ModelView):
     'Standard Sequences for GNU Health'
     __name__ = 'gnuhealth.sequences'
@@ -77,7 +259,7 @@ class GnuHealthSequences(ModelSingleton, ModelSQL, ModelView):
         domain=[('code', '=', 'gnuhealth.disease_notification')]))
 
 
-class DiseaseNotification(ModelView, ModelSQL):
+class DiseaseNotification(SelectionDisplayMixin, ModelView, ModelSQL):
     'Disease Notification'
 
     __name__ = 'gnuhealth.disease_notification'
@@ -87,12 +269,13 @@ class DiseaseNotification(ModelView, ModelSQL):
     status = fields.Selection(NOTIFICATION_STATES, 'Status', required=True,
                               sort=False)
     status_display = fields.Function(fields.Char('State'),
-                                     'get_selection_display')
-    name = fields.Char('Code', size=18, states={'readonly': True},
+                                     'get_selection_display',
+                                     searcher='search_selection_display')
+    name = fields.Char('Code', size=24, states={'readonly': True},
                        required=True)
     tracking_code = fields.Char('Case Tracking Code', select=True)
     date_notified = fields.DateTime('Date reported', required=True,
-                                    states=RO_SAVED)
+                                    states=RO_SAVED, select=True)
     date_received = fields.DateTime(
         'Date received', states=RO_NEW,
         help='Date received the National Surveillance Unit')
@@ -105,9 +288,9 @@ class DiseaseNotification(ModelView, ModelSQL):
                                'name', 'Symptoms', states=RO_STATE_END)
     date_onset = fields.Date('Date of Onset',
                              help='Date of onset of the illness')
-    epi_week_onset = fields.Function(fields.Char('Epi. Week of onset', size=8,
-                                     help='Week of onset (epidemiological)'),
-                                     'epi_week')
+    epi_week_onset = fields.Char('Epi. Week of onset', size=8, readonly=True,
+                                 select=True,
+                                 help='Week of onset (epidemiological)')
     date_seen = fields.Date('Date Seen', help='Date seen by a medical officer')
     reporting_facility = fields.Many2One(
         'gnuhealth.institution', 'Reporting facility',
@@ -133,7 +316,8 @@ class DiseaseNotification(ModelView, ModelSQL):
     date_of_death = fields.Date('Date of Death', states=ONLY_IF_DEAD)
     healthprof = fields.Many2One('gnuhealth.healthprofessional', 'Reported by')
     comments = fields.Text('Additional comments')
-    comments_short = fields.Function(fields.Char('Comments'), 'short_comment')
+    comments_short = fields.Function(fields.Char('Comments'), 'short_comment',
+                                     searcher='search_short_comment')
     risk_factors = fields.One2Many(
         'gnuhealth.disease_notification.risk_disease', 'notification',
         'Risk Factors', help="Other conditions of merit")
@@ -146,16 +330,21 @@ class DiseaseNotification(ModelView, ModelSQL):
         states={'invisible': ~Eval('hx_travel', False)})
     age = fields.Function(fields.Char('Age', size=8,
                                       help='age at date of onset'),
-                          'get_patient_age')
-    sex = fields.Function(fields.Selection(SEX_OPTIONS, 'Sex'),
-                          'get_patient_field',
-                          searcher='search_patient_field')
-    puid = fields.Function(fields.Char('UPI', size=12), 'get_patient_field',
-                           searcher='search_patient_field')
+                          'get_patient_age', searcher='search_patient_age')
+    # sex and puid are copies of the patient's, kept in sync by
+    # _sync_patient_fields, so that they can be sorted and searched
+    # without joining patient and party
+    sex = fields.Selection(SEX_OPTIONS, 'Sex', readonly=True)
+    puid = fields.Char('UPI', readonly=True, select=True)
     state_changes = fields.One2Many(
         'gnuhealth.disease_notification.statechange', 'notification',
         'Status Changes', order=[('create_date', 'DESC')], readonly=True)
     ir_received = fields.Boolean('IR Received')
+    # archived notifications live in yearly archive tables that inherit
+    # from this one, see archive
+    storage = fields.Selection(STORAGE_TIERS, 'Storage', required=True,
+                               readonly=True, select=True)
+    order_status_display = order_selection_display('status_display')
     # medical_record_num = fields.Function(fields.Char('Medical Record Numbers'),
     #                                      'get_patient_field',
     #                                      searcher='search_patient_field')
@@ -169,50 +358,253 @@ class DiseaseNotification(ModelView, ModelSQL):
         }
         cls._sql_constraints = [
             ('name_uniq', 'UNIQUE(name)', 'The code must be unique.')]
+        cls._error_messages.update({
+            'invalid_encounter': ('Invalid encounter selected. '
+                                  'Different patient (%s)'),
+            'date_in_future': '%s cannot be in the future (%s)',
+            'invalid_pivot_dimension': 'Notifications can not be counted '
+            'by "%s"',
+            'archived': 'Archived notifications can not be changed, restore '
+            'them first (%s)',
+        })
+        # the archive tables have no foreign keys or unique constraints of
+        # their own, nothing may point at or change an archived notification
+        archived = Eval('storage') == 'archive'
+        for name in dir(cls):
+            field = getattr(cls, name)
+            if (name == 'storage' or name.startswith('_')
+                    or not isinstance(field, fields.Field)):
+                continue
+            field.states = field.states.copy()
+            if 'readonly' in field.states:
+                field.states['readonly'] = Or(
+                    Bool(field.states['readonly']), archived)
+            else:
+                field.states['readonly'] = archived
+            if 'storage' not in field.depends:
+                field.depends = field.depends + ['storage']
+        cls.__rpc__.update({
+            'pivot': RPC(),
+            'archive': RPC(readonly=False),
+            'restore': RPC(readonly=False, instantiate=0),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        # epi_week_onset used to be a function field
+        backfill_epi_week = not table.column_exist('epi_week_onset')
+        # sex and puid used to be function fields reading the patient
+        backfill_patient = not table.column_exist('puid')
+
+        super(DiseaseNotification, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        if backfill_epi_week:
+            cls._backfill_epi_week_onset()
+        if backfill_patient:
+            cls._sync_patient_fields()
+        table.index_action(['epi_week_onset', 'diagnosis', 'status'], 'add')
+
+        # SQL sequence handing out the worker slots of the code generator.
+        # It cycles through the slots, a slot is drawn again only once
+        # WORKER_SLOTS other processes have drawn theirs (see create).
+        if not TableHandler.sequence_exist(cursor, WORKER_SLOT_SEQUENCE):
+            cursor.execute('CREATE SEQUENCE "%s" MINVALUE 0 MAXVALUE %d '
+                           'START 0 CYCLE' % (WORKER_SLOT_SEQUENCE,
+                                              WORKER_SLOTS - 1))
+
+    @classmethod
+    def _backfill_epi_week_onset(cls):
+        '''stores the epi week for every distinct date of onset'''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cursor.execute(*table.select(table.date_onset,
+                                     where=table.date_onset != None,
+                                     group_by=table.date_onset))
+        for date_onset, in cursor.fetchall():
+            cursor.execute(*table.update(
+                [table.epi_week_onset], [epiweek_str(date_onset)],
+                where=table.date_onset == date_onset))
+
+    @staticmethod
+    def _epi_week_values(values):
+        '''adds epi_week_onset to values if date_onset is being set'''
+        if 'date_onset' in values:
+            values = values.copy()
+            date_onset = values['date_onset']
+            values['epi_week_onset'] = (epiweek_str(date_onset)
+                                        if date_onset else None)
+        return values
 
     @classmethod
-    def get_patient_field(cls, instances, name):
-        return dict([(x.id, getattr(x.patient, name)) for x in instances])
+    def _sync_patient_fields(cls, where=None):
+        '''
+        copies the patient derived fields (PATIENT_PARTY_FIELDS) from the
+        party of the patient into the notifications in one UPDATE.
+        where is a function that takes (notification, patient, party)
+        tables and returns the condition that limits the update.
+        '''
+        pool = Pool()
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        patient = pool.get('gnuhealth.patient').__table__()
+        party = pool.get('party.party').__table__()
+        names = sorted(PATIENT_PARTY_FIELDS)
+        condition = ((table.patient == patient.id) &
+                     (patient.name == party.id))
+        if where is not None:
+            condition &= where(table, patient, party)
+        cursor.execute(*table.update(
+            [Column(table, n) for n in names],
+            [Column(party, PATIENT_PARTY_FIELDS[n]) for n in names],
+            from_=[patient, party], where=condition))
+
+    @classmethod
+    def sync_patient_fields(cls, ids=None, patients=None, parties=None):
+        '''
+        refreshes the patient derived fields of the notifications with
+        the given ids or of those for the given patient or party ids
+        '''
+        for key, values in [(0, ids), (1, patients), (2, parties)]:
+            if values is None:
+                continue
+            for sub_ids in grouped_slice(values):
+                sub_ids = list(sub_ids)
+                cls._sync_patient_fields(
+                    lambda *tables: reduce_ids(tables[key].id, sub_ids))
+
+    @classmethod
+    def _patient_party_tables(cls, tables):
+        '''
+        adds the joins to the patient and its party to tables, as used by
+        the order methods, and returns (patient, party)
+        '''
+        pool = Pool()
+        table, _ = tables[None]
+        patient_tables = tables.get('patient')
+        if patient_tables is None:
+            patient = pool.get('gnuhealth.patient').__table__()
+            patient_tables = {None: (patient, table.patient == patient.id)}
+            tables['patient'] = patient_tables
+        patient, _ = patient_tables[None]
+        party_tables = patient_tables.get('name')
+        if party_tables is None:
+            party = pool.get('party.party').__table__()
+            party_tables = {None: (party, patient.name == party.id)}
+            patient_tables['name'] = party_tables
+        party, _ = party_tables[None]
+        return patient, party
+
+    @classmethod
+    def _patient_join(cls):
+        '''
+        returns (join, table, party) where join is the notification table
+        joined to its patient and the party of the patient
+        '''
+        pool = Pool()
+        table = cls.__table__()
+        patient = pool.get('gnuhealth.patient').__table__()
+        party = pool.get('party.party').__table__()
+        join = table.join(patient, condition=table.patient == patient.id
+                          ).join(party, condition=patient.name == party.id)
+        return join, table, party
 
     @classmethod
     def get_patient_age(cls, instances, name):
         '''
-        Uses the age function in the database to calculate the age at 
-        the date specified.
-        :param: instance_refs - a list of tuples with (id, ref_date)
-        '''
-        c = Transaction().cursor
-        tbl = cls.__table__()
-        qry = "\n".join(
-            ["SET intervalstyle TO 'iso_8601';",
-             "SELECT a.id as id, btrim(lower("
-             "regexp_replace(AGE(a.date_onset, c.dob)::varchar, "
-             "'([YMD])', '\\1 ', 'g')), 'p ')  as showage ",
-             "from " + str(tbl) + " as a ",
-             " inner join gnuhealth_patient as b on a.patient=b.id",
-             " inner join party_party c on b.name=c.id"
-             " where a.id in %s ;"])
-        qry_parm = tuple(map(int, instances))
-        c.execute(qry, (qry_parm, ))
-        outx = c.fetchall()
-        outd = dict([x for x in outx])
-        return outd
-
-    @classmethod
-    def order_puid(cls, tables):
+        Uses the age function in the database to calculate the age at
+        the date of onset, formatted as e.g. 34y 2m 5d. Results are kept
+        for the rest of the transaction.
+        '''
+        cursor = Transaction().cursor
+        cache = transaction_cache('%s.age' % cls.__name__)
+        ids = map(int, instances)
+        missing = [x for x in ids if x not in cache]
+        join, table, party = cls._patient_join()
+        age = Age(table.date_onset, party.dob)
+        for sub_ids in grouped_slice(missing):
+            cursor.execute(*join.select(
+                table.id, Extract('YEAR', age), Extract('MONTH', age),
+                Extract('DAY', age),
+                where=reduce_ids(table.id, list(sub_ids))))
+            for id_, years, months, days in cursor.fetchall():
+                cache[id_] = format_age(years, months, days)
+        return dict([(x, cache.get(x)) for x in ids])
+
+    @classmethod
+    def search_patient_age(cls, name, clause):
+        '''
+        searches the age at onset in completed years, e.g. ('age', '<', 5).
+        like operators are treated as equality.
+        '''
+        _, operator, value = clause
+        if operator.endswith('like'):
+            operator = '!=' if operator.startswith('not') else '='
+
+        def to_years(val):
+            if val is None or isinstance(val, (int, long)):
+                return val
+            match = re.match(r'\s*%?(\d+)', unicode(val))
+            return int(match.group(1)) if match else None
+
+        join, table, party = cls._patient_join()
+        years = Extract('YEAR', Age(table.date_onset, party.dob))
+        if isinstance(value, (list, tuple)):
+            value = [x for x in map(to_years, value) if x is not None]
+            condition = SQL_OPERATORS[operator](years, value)
+        else:
+            value = to_years(value)
+            if value is None:
+                condition = years == None if operator == '=' else years != None
+            else:
+                condition = SQL_OPERATORS[operator](years, value)
+        return [('id', 'in', join.select(table.id, where=condition))]
+
+    @classmethod
+    def order_age(cls, tables):
         table, _ = tables[None]
-        return [Column(table, 'patient')]
-        # not really a UPI/PUID sort, but good enough
+        _, party = cls._patient_party_tables(tables)
+        return [Age(table.date_onset, party.dob)]
+
+    @staticmethod
+    def _short_comment_column(table):
+        '''the first 40 characters of comments, on one line'''
+        return Substring(Replace(Coalesce(table.comments, ''), '\n', ' '),
+                         1, 40)
 
     @classmethod
     def short_comment(cls, instances, name):
-        return dict(map(lambda x: (x.id,
-                    x.comments and ' '.join(x.comments.split('\n'))[:40] or ''),
-                    instances))
+        '''
+        cuts the comments down in the database so that only the preview
+        is fetched
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        column = cls._short_comment_column(table)
+        result = {}
+        for sub_ids in grouped_slice(map(int, instances)):
+            cursor.execute(*table.select(
+                table.id, column, where=reduce_ids(table.id, list(sub_ids))))
+            result.update(cursor.fetchall())
+        return result
+
+    @classmethod
+    def search_short_comment(cls, name, clause):
+        _, operator, value = clause
+        if value is None:
+            value = ''
+        table = cls.__table__()
+        column = cls._short_comment_column(table)
+        return [('id', 'in', table.select(
+            table.id, where=SQL_OPERATORS[operator](column, value)))]
 
     @classmethod
-    def search_patient_field(cls, field_name, clause):
-        return replace_clause_column(clause, 'patient.%s' % field_name)
+    def order_comments_short(cls, tables):
+        table, _ = tables[None]
+        return [cls._short_comment_column(table)]
 
     _rec_name = 'name'
     # @classmethod
@@ -222,7 +614,7 @@ class DiseaseNotification(ModelView, ModelSQL):
     @classmethod
     def search_rec_name(cls, field_name, clause):
         _, operand, val = clause
-        return ['OR', ('patient.puid', operand, val),
+        return ['OR', ('puid', operand, val),
                 ('name', operand, val)]
 
     @fields.depends('reporting_facility')
@@ -247,6 +639,10 @@ class DiseaseNotification(ModelView, ModelSQL):
         else:
             return {}
 
+    @fields.depends('date_onset')
+    def on_change_with_epi_week_onset(self):
+        return epiweek_str(self.date_onset) if self.date_onset else None
+
     @fields.depends('encounter')
     def on_change_with_date_seen(self):
         return self.encounter.start_time.date() if self.encounter else None
@@ -264,98 +660,574 @@ class DiseaseNotification(ModelView, ModelSQL):
     def default_active():
         return True
 
+    @staticmethod
+    def default_storage():
+        return 'hot'
+
+    @classmethod
+    def search(cls, domain, *args, **kwargs):
+        # archived notifications are left out unless the context asks for
+        # them or the domain is on storage, and the planner then skips the
+        # archive tables
+        if (not Transaction().context.get('archived')
+                and 'storage' not in domain_fields(domain)):
+            domain = [domain, ('storage', '=', 'hot')]
+        return super(DiseaseNotification, cls).search(domain, *args,
+                                                      **kwargs)
+
     @classmethod
     def create(cls, vlist):
-        pool = Pool()
-        Sequence = pool.get('ir.sequence')
-        Config = pool.get('gnuhealth.sequences')
-        config = Config(1)
-        vlist = [x.copy() for x in vlist]
+        vlist = [cls._epi_week_values(x.copy()) for x in vlist]
+        # names that are empty or only have the DIAG: prefix need a code
+        need_code = [x for x in vlist
+                     if not x.get('name') or x['name'].endswith(':')]
+        codes = iter(cls.reserve_codes(len(need_code)))
+        coded = []
+        initial_states = []
         for values in vlist:
-            val_name = values.get('name', '')
+            val_name = values.get('name') or ''
             if not val_name or val_name.endswith(':'):
-                newcode = Sequence.get_id(config.notification_sequence.id)
-                values['name'] = '%s%s' % (values['name'], newcode)
+                coded.append((values, val_name))
+                values['name'] = '%s%s' % (val_name, next(codes))
             elif ':' in val_name and not values.get('diagnosis', False):
                 values['name'] = val_name[val_name.index(':')+1:]
             if values.get('state_changes', False):
-                pass
+                initial_states.append(None)
             else:
-                values['state_changes'] = [
-                    ('create', [{
-                        'orig_state': None,
-                        'target_state': values['status'],
-                        'healthprof': values['healthprof']
-                     }])
-                ]
-        return super(DiseaseNotification, cls).create(vlist)
+                initial_states.append((None, values['status'],
+                                       values['healthprof']))
+        if coded and config.get('health_disease_notification', 'code_mode',
+                                default='sequence') == 'worker':
+            records = cls._create_worker_coded(vlist, coded)
+        else:
+            records = super(DiseaseNotification, cls).create(vlist)
+        cls.sync_patient_fields(ids=map(int, records))
+        CaseCount = Pool().get('gnuhealth.disease_notification.case_count')
+        CaseCount.add(map(int, records))
+        ReportCache = Pool().get(
+            'gnuhealth.disease_notification.report_cache')
+        ReportCache.invalidate_ids(map(int, records))
+        # nsc = Notification State Change
+        nsc = Pool().get('gnuhealth.disease_notification.statechange')
+        nsc.bulk_create([(rec.id, ) + state for rec, state
+                         in zip(records, initial_states) if state])
+        return records
+
+    @classmethod
+    def _create_worker_coded(cls, vlist, coded):
+        '''
+        creates vlist, in which coded are the (values, prefix) whose name
+        got a code of the worker code generator. A process that has been
+        running since before the slot sequence wrapped round shares its
+        slot with this one and may have issued the same codes: then this
+        process draws a new slot and codes them again.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        for attempt in range(WORKER_CODE_ATTEMPTS):
+            cursor.execute('SAVEPOINT notification_codes')
+            try:
+                records = super(DiseaseNotification, cls).create(vlist)
+            except Exception:
+                cursor.execute('ROLLBACK TO SAVEPOINT notification_codes')
+                cursor.execute(*table.select(
+                    table.name, where=table.name.in_(
+                        [x['name'] for x, _ in coded]), limit=1))
+                if (not cursor.fetchone()
+                        or attempt == WORKER_CODE_ATTEMPTS - 1):
+                    raise
+                codes = cls._code_generator(renew=True).generate(len(coded))
+                for (values, prefix), code in zip(coded, codes):
+                    values['name'] = '%s%s' % (prefix, code)
+            else:
+                cursor.execute('RELEASE SAVEPOINT notification_codes')
+                return records
+
+    @classmethod
+    def _notification_sequence(cls):
+        '''the id of the configured sequence, read once per transaction'''
+        cache = transaction_cache('%s.sequence' % cls.__name__)
+        if 'id' not in cache:
+            Config = Pool().get('gnuhealth.sequences')
+            cache['id'] = Config(1).notification_sequence.id
+        return cache['id']
+
+    @classmethod
+    def _code_generator(cls, renew=False):
+        '''
+        returns the code generator of this process, a new one with renew.
+        Its worker slot comes from a SQL sequence, which never blocks and
+        is not rolled back.
+        '''
+        cursor = Transaction().cursor
+        key = (cursor.database_name, os.getpid())
+        with CODE_GENERATOR_LOCK:
+            if renew:
+                CODE_GENERATORS.pop(key, None)
+            if key not in CODE_GENERATORS:
+                Sequence = Pool().get('ir.sequence')
+                sequence = Sequence(cls._notification_sequence())
+                cursor.execute('SELECT nextval(%s)', (WORKER_SLOT_SEQUENCE,))
+                slot, = cursor.fetchone()
+                kwargs = {}
+                if sequence.type in ('decimal timestamp',
+                                     'hexadecimal timestamp'):
+                    kwargs = {'offset': sequence.timestamp_offset,
+                              'rounding': sequence.timestamp_rounding}
+                CODE_GENERATORS[key] = CodeGenerator(
+                    slot, config.get('health_disease_notification', 'node',
+                                     default=''), **kwargs)
+            return CODE_GENERATORS[key]
+
+    @classmethod
+    def reserve_codes(cls, count):
+        '''
+        returns count new codes. With the default code_mode (sequence) the
+        codes come from the notification sequence: for the timestamp and
+        incremental types all of them are reserved at once (timestamps one
+        per tick of the sequence, so a block may wait for the clock),
+        other types fall back to one get_id per code. With code_mode set to
+        worker in the [health_disease_notification] section of trytond.conf
+        the codes are made by the process' CodeGenerator and never wait on
+        other transactions.
+        '''
+        if not count:
+            return []
+        if config.get('health_disease_notification', 'code_mode',
+                      default='sequence') == 'worker':
+            return cls._code_generator().generate(count)
+        pool = Pool()
+        Config = pool.get('gnuhealth.sequences')
+        # ir.sequence or ir.sequence.strict
+        Sequence = pool.get(Config.notification_sequence.model_name)
+        cursor = Transaction().cursor
+        sequence = Sequence(cls._notification_sequence())
+        table = Sequence.__table__()
+        if sequence.type in ('decimal timestamp', 'hexadecimal timestamp'):
+            # the block ends at the current timestamp, after the last one
+            # handed out, so that get_id, which hands out the current
+            # timestamp when it differs from the last one, never gives one
+            # of them again. The row stays locked until the end of the
+            # transaction.
+            cursor.execute('SELECT last_timestamp FROM "%s" WHERE id = %%s '
+                           'FOR UPDATE' % Sequence._table, (sequence.id, ))
+            last = cursor.fetchone()[0] or 0
+            now = Sequence._timestamp(sequence)
+            first = max(last + 1, now - count + 1)
+            if first + count - 1 > now:
+                time.sleep((first + count - 1 - now) *
+                           sequence.timestamp_rounding)
+            cursor.execute(*table.update(
+                [table.last_timestamp], [first + count - 1],
+                where=table.id == sequence.id))
+            numbers = xrange(first, first + count)
+            number_format = ('%X' if sequence.type == 'hexadecimal timestamp'
+                             else '%d')
+        elif (sequence.type == 'incremental' and sql_sequence
+                and not Sequence._strict):
+            cursor.execute('SELECT nextval(%s) FROM generate_series(1, %s)',
+                           (sequence._sql_sequence_name, count))
+            numbers = [x for x, in cursor.fetchall()]
+            number_format = '%%0%sd' % sequence.padding
+        elif sequence.type == 'incremental':
+            increment = sequence.number_increment
+            cursor.execute(*table.update(
+                [table.number_next_internal],
+                [table.number_next_internal + increment * count],
+                where=table.id == sequence.id,
+                returning=[table.number_next_internal]))
+            next_number, = cursor.fetchone()
+            numbers = xrange(next_number - increment * count, next_number,
+                             increment)
+            number_format = '%%0%sd' % sequence.padding
+        else:
+            return [Sequence.get_id(sequence.id) for _ in xrange(count)]
+        prefix = Sequence._process(sequence.prefix)
+        suffix = Sequence._process(sequence.suffix)
+        return ['%s%s%s' % (prefix, number_format % x, suffix)
+                for x in numbers]
+
+    @classmethod
+    def _current_healthprof(cls):
+        '''the health professional of the user, looked up once per
+        transaction'''
+        cache = transaction_cache('%s.healthprof' % cls.__name__)
+        user = Transaction().user
+        if user not in cache:
+            cache[user] = cls.default_healthprof()
+        return cache[user]
+
+    @classmethod
+    def _status_changes(cls, ids, newstate):
+        '''
+        returns [(id, old status)] for the notifications in ids whose
+        status differs from newstate, with one query per slice of ids
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        changes = []
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(
+                table.id, table.status,
+                where=reduce_ids(table.id, list(sub_ids)) &
+                ((table.status == None) | (table.status != newstate))))
+            changes.extend(cursor.fetchall())
+        return changes
 
     @classmethod
     def write(cls, records, values, *args):
         '''create a NotificationStateChange when the status changes'''
-        healthprof = DiseaseNotification.default_healthprof()
         to_make = []
+        to_sync = []
+        to_count = set()
+        to_invalidate = set()
         irecs = iter((records, values) + args)
+        args = []
         for recs, vals in zip(irecs, irecs):
+            cls._check_hot(map(int, recs))
+            vals = cls._epi_week_values(vals)
+            args.extend((recs, vals))
+            if set(CASE_COUNT_FIELDS).intersection(vals):
+                to_count.update(map(int, recs))
+            if set(REPORT_CACHE_FIELDS).intersection(vals):
+                to_invalidate.update(map(int, recs))
+            if 'date_onset' in vals or 'patient' in vals:
+                clear_transaction_cache('%s.age' % cls.__name__,
+                                        map(int, recs))
+            if 'patient' in vals:
+                to_sync.extend(map(int, recs))
             newstate = vals.get('status', False)
             if newstate:
-                for rec in recs:
-                    if rec.status != newstate:
-                        to_make.append({'notification': rec.id,
-                                        'orig_state': rec.status,
-                                        'target_state': newstate,
-                                        'healthprof': healthprof})
-        return_val = super(DiseaseNotification, cls).write(records, values,
-                                                           *args)
+                to_make.extend([(rec_id, oldstate, newstate)
+                                for rec_id, oldstate
+                                in cls._status_changes(map(int, recs),
+                                                       newstate)])
+        CaseCount = Pool().get('gnuhealth.disease_notification.case_count')
+        ReportCache = Pool().get(
+            'gnuhealth.disease_notification.report_cache')
+        CaseCount.remove(list(to_count))
+        # before and after, for the windows they leave and those they join
+        ReportCache.invalidate_ids(list(to_invalidate))
+        return_val = super(DiseaseNotification, cls).write(*args)
+        ReportCache.invalidate_ids(list(to_invalidate))
+        CaseCount.add(list(to_count))
+        if to_sync:
+            cls.sync_patient_fields(ids=to_sync)
         # nsc = Notification State Change
         if to_make:
+            healthprof = cls._current_healthprof()
             nsc = Pool().get('gnuhealth.disease_notification.statechange')
-            nsc.create(to_make)
+            nsc.bulk_create([x + (healthprof, ) for x in to_make])
         return return_val
 
+    @classmethod
+    def _check_hot(cls, ids):
+        '''raises an error when any of the notifications is archived'''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        names = []
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(
+                table.name, where=reduce_ids(table.id, list(sub_ids)) &
+                (table.storage == 'archive'), limit=10 - len(names)))
+            names.extend([x for x, in cursor.fetchall()])
+            if len(names) >= 10:
+                break
+        if names:
+            cls.raise_user_error('archived', (', '.join(names), ))
+
+    @classmethod
+    def delete(cls, records):
+        # the rows that reference archived notifications are in archive
+        # tables without foreign keys, they would be left behind
+        cls._check_hot(map(int, records))
+        CaseCount = Pool().get('gnuhealth.disease_notification.case_count')
+        ReportCache = Pool().get(
+            'gnuhealth.disease_notification.report_cache')
+        CaseCount.remove(map(int, records))
+        ReportCache.invalidate_ids(map(int, records))
+        super(DiseaseNotification, cls).delete(records)
+
     @classmethod
     def validate(cls, records):
-        now = {date: date.today(), datetime: datetime.now(), type(None): None}
+        '''
+        checks, with one query per slice of records, that the encounter
+        belongs to the patient and that none of the dates are in the future
+        '''
+        super(DiseaseNotification, cls).validate(records)
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        encounter = Pool().get('gnuhealth.encounter').__table__()
+        now = {'date': date.today(), 'datetime': datetime.now()}
         date_fields = ['date_onset', 'date_seen', 'date_notified',
                        'admission_date', 'date_of_death']
-        # we need to ensure that none of these fields are in the future
-        for rec in records:
-            if rec.encounter:
-                if rec.encounter.patient != rec.patient:
-                    cls.raise_user_error('Invalid encounter selected.'
-                                         'Different patient')
-            for fld in date_fields:
-                val = getattr(rec, fld)
-                if val and val > now[type(val)]:
-                    val_name = getattr(cls, fld).string
-                    cls.raise_user_error('%s cannot be in the future',
-                                         (val_name, ))
+        # one boolean column per check, NULL counts as passed
+        checks = [(encounter.id != None) &
+                  (encounter.patient != table.patient)]
+        for fld in date_fields:
+            checks.append(Column(table, fld) > now[getattr(cls, fld)._type])
+        any_failed = checks[0]
+        for check in checks[1:]:
+            any_failed |= check
+        failed = [[] for _ in checks]
+        join = table.join(encounter, 'LEFT',
+                          condition=table.encounter == encounter.id)
+        for sub_ids in grouped_slice(map(int, records)):
+            cursor.execute(*join.select(
+                table.name, *[Coalesce(x, False) for x in checks],
+                where=reduce_ids(table.id, list(sub_ids)) & any_failed))
+            for row in cursor.fetchall():
+                for names, check_failed in zip(failed, row[1:]):
+                    if check_failed:
+                        names.append(row[0])
+
+        def names_str(names):
+            return ', '.join(names[:10] + (['...'] if names[10:] else []))
+
+        if failed[0]:
+            cls.raise_user_error('invalid_encounter', (names_str(failed[0]), ))
+        for fld, names in zip(date_fields, failed[1:]):
+            if names:
+                cls.raise_user_error('date_in_future',
+                                     (getattr(cls, fld).string,
+                                      names_str(names)))
+
+    @classmethod
+    def reclassify(cls, records, status):
+        '''
+        sets status on the records that are neither in an end state nor
+        already in status. The state change rows are inserted from the
+        same rows with INSERT ... SELECT and the status is set with one
+        UPDATE per slice of ids, so no record is read into python.
+        Returns the number of notifications that changed.
+        '''
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        nsc = pool.get('gnuhealth.disease_notification.statechange')
+        CaseCount = pool.get('gnuhealth.disease_notification.case_count')
+        ReportCache = pool.get('gnuhealth.disease_notification.report_cache')
+        ModelAccess.check(cls.__name__, 'write')
+        ModelAccess.check(nsc.__name__, 'create')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        state_table = nsc.__table__()
+        user = Transaction().user
+        healthprof = cls._current_healthprof()
+        if healthprof is not None:
+            healthprof = int(healthprof)
+        change_date = nsc.default_change_date()
+        changed = 0
+        for sub_ids in grouped_slice(map(int, records)):
+            where = (reduce_ids(table.id, list(sub_ids)) &
+                     (table.storage == 'hot') &
+                     ~table.status.in_(NOTIFICATION_END_STATES) &
+                     (table.status != status))
+            cursor.execute(*state_table.insert(
+                [state_table.notification, state_table.orig_state,
+                 state_table.target_state, state_table.healthprof,
+                 state_table.change_date, state_table.create_uid,
+                 state_table.create_date],
+                table.select(table.id, table.status, Literal(status),
+                             Literal(healthprof), Literal(change_date),
+                             Literal(user), CurrentTimestamp(),
+                             where=where)))
+            CaseCount.count_changes(table, where, -1)
+            CaseCount.count_changes(table, where, 1, status=status)
+            ReportCache.invalidate(table, where)
+            cursor.execute(*table.update(
+                [table.status, table.write_uid, table.write_date],
+                [status, user, CurrentTimestamp()], where=where))
+            changed += cursor.rowcount
+        return changed
+
+    @classmethod
+    def _pivot_columns(cls, dimensions):
+        '''
+        returns (from item, notification table, [column]) of the
+        dimensions, joining the patient and address only when needed
+        '''
+        pool = Pool()
+        join = table = cls.__table__()
+        if set(dimensions).intersection(['parish', 'age_band']):
+            patient = pool.get('gnuhealth.patient').__table__()
+            party = pool.get('party.party').__table__()
+            join = join.join(patient, condition=table.patient == patient.id
+                             ).join(party, condition=patient.name == party.id)
+        if 'parish' in dimensions:
+            du = pool.get('gnuhealth.du').__table__()
+            join = join.join(du, 'LEFT', condition=party.du == du.id)
+        columns = []
+        for name in dimensions:
+            if name == 'parish':
+                column = du.subdivision
+            elif name == 'age_band':
+                years = Extract('YEAR', Age(table.date_onset, party.dob))
+                column = Case(*[(years >= x, x)
+                                for x in reversed(PIVOT_AGE_BANDS)])
+            elif name == 'week':
+                column = table.epi_week_onset
+            elif name == 'month':
+                column = ToChar(table.date_onset, 'YYYY-MM')
+            elif name == 'year':
+                column = Cast(Extract('YEAR', table.date_onset), 'INTEGER')
+            else:
+                column = Column(table, name)
+            columns.append(column)
+        return join, table, columns
+
+    @classmethod
+    def _pivot_labels(cls, name, values):
+        '''returns {value: label} of the values of dimension name'''
+        values = [x for x in set(values) if x is not None]
+        models = {'diagnosis': 'gnuhealth.pathology',
+                  'parish': 'country.subdivision',
+                  'reporting_facility': 'gnuhealth.institution'}
+        if name in models:
+            return cached_field_values(models[name], values)
+        elif name == 'status':
+            return cls._selection_labels('status_display')
+        elif name == 'sex':
+            return dict(SEX_OPTIONS)
+        elif name == 'age_band':
+            bounds = PIVOT_AGE_BANDS + (None, )
+            return dict([(x, '%d+' % x if y is None else
+                          '%d-%d' % (x, y - 1) if y - x > 1 else str(x))
+                         for x, y in zip(bounds, bounds[1:])])
+        return dict([(x, unicode(x)) for x in values])
+
+    @classmethod
+    def pivot(cls, dimensions, start_date=None, end_date=None,
+              diagnoses=None, statuses=None, rollup=False):
+        '''
+        counts the active notifications with onset from start_date to
+        end_date, both included, by dimensions (see PIVOT_DIMENSIONS) with
+        one aggregate query. With rollup the groups are rolled up from the
+        last dimension to the first, up to the grand total, by the same
+        query.
+        Returns {'dimensions': dimensions, 'columns': {dimension: [value],
+        'cases': [count]}, 'labels': {dimension: [(value, label)]}} where
+        the values of a row are at the same index in every column. With
+        rollup, columns also has 'rollup': the bit mask of the dimensions
+        rolled up in each row, the first dimension being the highest bit.
+        '''
+        ModelAccess = Pool().get('ir.model.access')
+        ModelAccess.check(cls.__name__, 'read')
+        for name in dimensions:
+            if name not in dict(PIVOT_DIMENSIONS):
+                cls.raise_user_error('invalid_pivot_dimension', (name, ))
+        cursor = Transaction().cursor
+        join, table, columns = cls._pivot_columns(dimensions)
+        where = table.active == True
+        if start_date:
+            where &= table.date_onset >= start_date
+        if end_date:
+            where &= table.date_onset <= end_date
+        if diagnoses:
+            where &= table.diagnosis.in_(map(int, diagnoses))
+        if statuses:
+            where &= table.status.in_(statuses)
+        select = columns + [Count(Literal(1))]
+        group_by = columns
+        if rollup and columns:
+            select.append(Grouping(*columns))
+            group_by = [Rollup(*columns)]
+        cursor.execute(*join.select(*select, where=where,
+                                    group_by=group_by or None))
+        rows = cursor.fetchall()
+        names = list(dimensions) + ['cases']
+        if rollup and columns:
+            names.append('rollup')
+        values = zip(*rows) if rows else [()] * len(names)
+        result = dict([(x, list(y)) for x, y in zip(names, values)])
+        return {
+            'dimensions': list(dimensions),
+            'columns': result,
+            'labels': dict([(x, sorted(cls._pivot_labels(
+                                x, result[x]).iteritems()))
+                            for x in dimensions]),
+        }
+
+    @classmethod
+    def _archive_years(cls, where):
+        '''returns {year reported: [id]} of the notifications matching
+        where'''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cursor.execute(*table.select(
+            table.id, Extract('YEAR', table.date_notified),
+            where=where(table)))
+        years = {}
+        for notification_id, year in cursor.fetchall():
+            years.setdefault(int(year), []).append(notification_id)
+        return years
+
+    @classmethod
+    def archive(cls, horizon=None):
+        '''
+        moves the inactive notifications and those reported before the
+        start of the year horizon years ago (default archive_horizon from
+        the [health_disease_notification] section of trytond.conf, or 5)
+        to the archive table of the year they were reported. The symptoms,
+        specimens, risk factors, travel history, state changes and any
+        other rows that reference them move along to archive tables of
+        their own. Returns the number of notifications archived.
+        '''
+        ModelAccess = Pool().get('ir.model.access')
+        ModelAccess.check(cls.__name__, 'write')
+        if horizon is None:
+            horizon = config.getint('health_disease_notification',
+                                    'archive_horizon', default=5)
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cutoff = datetime(date.today().year - horizon, 1, 1)
+        years = cls._archive_years(
+            lambda table: (table.storage == 'hot') &
+            ((table.active == False) | (table.date_notified < cutoff)))
+        archived = 0
+        for year, ids in years.iteritems():
+            check = ('storage = \'archive\' '
+                     'AND date_notified >= \'%d-01-01\' '
+                     'AND date_notified < \'%d-01-01\'' % (year, year + 1))
+            for sub_ids in grouped_slice(ids):
+                sub_ids = list(sub_ids)
+                cursor.execute(*table.update(
+                    [table.storage], ['archive'],
+                    where=reduce_ids(table.id, sub_ids)))
+                archived += len(archive.archive_rows(
+                    cursor, cls._table, sub_ids, year, check=check))
+        return archived
+
+    @classmethod
+    def restore(cls, records):
+        '''moves archived notifications, and the rows that reference
+        them, back to the current tables'''
+        ModelAccess = Pool().get('ir.model.access')
+        ModelAccess.check(cls.__name__, 'write')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        ids = map(int, records)
+        years = cls._archive_years(
+            lambda table: (table.storage == 'archive') &
+            table.id.in_(ids or [None]))
+        for year, year_ids in years.iteritems():
+            for sub_ids in grouped_slice(year_ids):
+                restored = archive.restore_rows(cursor, cls._table,
+                                                list(sub_ids), year)
+                if restored:
+                    cursor.execute(*table.update(
+                        [table.storage], ['hot'],
+                        where=reduce_ids(table.id, restored)))
 
     @classmethod
     def copy(cls, records, default=None):
         if default is None:
             default = {}
         default = default.copy()
-        default.update(diagnosis=None, state_changes=[])
+        default.update(diagnosis=None, state_changes=[], storage='hot')
         if 'name' in default:
             del default['name']
         return super(DiseaseNotification, cls).copy(records, default=default)
 
-    @classmethod
-    def epi_week(cls, instances, name):
-        def ewcalc(k):
-            return (k.id, epiweek_str(k.date_onset) if k.date_onset else '')
-        if name == 'epi_week_onset':
-            return dict(map(ewcalc, instances))
-
-    @classmethod
-    def get_selection_display(cls, instances, field_name):
-        real_field = field_name[:0 - len('_display')]
-        field_selections = cls._fields[real_field].selection
-        xdict = dict(filter(lambda x: x[0], field_selections))
-        return dict(map(lambda x: (x.id, xdict.get(getattr(x, real_field), '')),
-                    instances))
-
 
 class RiskFactorCondition(ModelSQL, ModelView):
     'Risk Factor Conditions'
@@ -369,7 +1241,8 @@ class RiskFactorCondition(ModelSQL, ModelView):
 
     @classmethod
     def get_rec_name(cls, records, name):
-        return dict([(x.id, x.pathology.rec_name) for x in records])
+        return dict([(x, y) for x, (y, ) in many2one_values(
+            cls, records, ['pathology']).iteritems()])
 
 
 class LabResultType(ModelSQL, ModelView):
@@ -388,7 +1261,7 @@ class LabResultType(ModelSQL, ModelView):
         cls._sql_constraints = [('code_uniq', 'UNIQUE(code)', 'unique_code')]
 
 
-class NotifiedSpecimen(ModelSQL, ModelView):
+class NotifiedSpecimen(SelectionDisplayMixin, ModelSQL, ModelView):
     'Disease Notification Sample'
 
     __name__ = 'gnuhealth.disease_notification.specimen'
@@ -416,12 +1289,60 @@ class NotifiedSpecimen(ModelSQL, ModelView):
                                  searcher='search_has_result')
     # lab_request = fields.Many2One('gnuhealth.patient.lab.test',
     #                               'Lab Test Request')
-    specimen_type_display = fields.Function(fields.Char('Sample Type'),
-                                            'get_selection_display')
-    lab_test_type_display = fields.Function(fields.Char('Test Type'),
-                                            'get_selection_display')
-    lab_result_state_display = fields.Function(fields.Char('Result State'),
-                                               'get_selection_display')
+    specimen_type_display = fields.Function(
+        fields.Char('Sample Type'), 'get_selection_display',
+        searcher='search_selection_display')
+    lab_test_type_display = fields.Function(
+        fields.Char('Test Type'), 'get_selection_display',
+        searcher='search_selection_display')
+    lab_result_state_display = fields.Function(
+        fields.Char('Result State'), 'get_selection_display',
+        searcher='search_selection_display')
+    order_specimen_type_display = order_selection_display(
+        'specimen_type_display')
+    order_lab_test_type_display = order_selection_display(
+        'lab_test_type_display')
+    order_lab_result_state_display = order_selection_display(
+        'lab_result_state_display')
+
+    @classmethod
+    def __setup__(cls):
+        super(NotifiedSpecimen, cls).__setup__()
+        cls.__rpc__.update({
+            'lab_backlog': RPC(),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        super(NotifiedSpecimen, cls).__register__(module_name)
+
+        # partial index on the specimens still waiting for their results
+        index_name = '%s_pending_index' % cls._table
+        cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                       (index_name,))
+        if not cursor.fetchone():
+            cursor.execute('CREATE INDEX "%s" ON "%s" '
+                           '(lab_sent_to, date_taken) WHERE %s' % (
+                               index_name, cls._table,
+                               cls._pending_condition_sql()))
+
+    @staticmethod
+    def _pending_condition_sql():
+        '''
+        the SQL predicate of the partial index on pending specimens. The
+        queries on pending specimens must use the same condition, see
+        _pending_condition, for the planner to pick up the index.
+        '''
+        return ('date_tested IS NULL OR lab_result_state IS NULL '
+                'OR lab_result_state = \'\'')
+
+    @staticmethod
+    def _pending_condition(table):
+        '''python-sql version of _pending_condition_sql'''
+        return ((table.date_tested == None)
+                | (table.lab_result_state == None)
+                | (table.lab_result_state == ''))
 
     @classmethod
     def get_has_result(cls, instances, name):
@@ -430,17 +1351,53 @@ class NotifiedSpecimen(ModelSQL, ModelView):
 
     @classmethod
     def search_has_result(cls, field_name, clause):
-        return [(And(Bool(Eval('date_tested')),
-                     Bool(Eval('lab_result_state'))),
-                 clause[1], clause[2])]
+        _, operator, value = clause
+        if (operator == '=') == bool(value):
+            return [('date_tested', '!=', None),
+                    ('lab_result_state', '!=', None),
+                    ('lab_result_state', '!=', '')]
+        return ['OR', ('date_tested', '=', None),
+                ('lab_result_state', '=', None),
+                ('lab_result_state', '=', '')]
 
     @classmethod
-    def get_selection_display(cls, instances, field_name):
-        real_field = field_name[:0-len('_display')]
-        field_selections = cls._fields[real_field].selection
-        xdict = dict(filter(lambda x: x[0], field_selections))
-        return dict(map(lambda x: (x.id, xdict.get(getattr(x, real_field), '')),
-                    instances))
+    def lab_backlog(cls, lab=None, buckets=LAB_BACKLOG_BUCKETS):
+        '''
+        returns the specimens still waiting for results, grouped by the lab
+        they were sent to and by age bucket. buckets are the lower bounds,
+        in days since the sample was taken, of the buckets. Each group is a
+        dict with the lab, the bucket label e.g. 4-7 days, the oldest
+        date_taken and the ids of its specimens, oldest first.
+        '''
+        ModelAccess = Pool().get('ir.model.access')
+        ModelAccess.check(cls.__name__, 'read')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        where = cls._pending_condition(table)
+        if lab is not None:
+            where &= table.lab_sent_to == lab
+        cursor.execute(*table.select(
+            table.id, table.lab_sent_to, table.date_taken, where=where,
+            order_by=[table.lab_sent_to.asc, table.date_taken.asc,
+                      table.id.asc]))
+
+        buckets = sorted(buckets)
+        labels = ['%d-%d days' % (x, y - 1)
+                  for x, y in zip(buckets, buckets[1:])]
+        labels.append('%d+ days' % buckets[-1])
+        today = date.today()
+        groups = {}
+        for specimen, lab_sent_to, date_taken in cursor.fetchall():
+            age = (today - date_taken).days
+            index = len([x for x in buckets[1:] if x <= age])
+            key = (lab_sent_to, index)
+            if key not in groups:
+                groups[key] = {'lab': lab_sent_to, 'bucket': labels[index],
+                               'oldest': date_taken, 'specimens': []}
+            groups[key]['specimens'].append(specimen)
+        # oldest buckets first within each lab
+        return [groups[x] for x in sorted(groups,
+                                          key=lambda x: (x[0], -x[1]))]
 
 
 class NotificationSymptom(ModelView, ModelSQL):
@@ -457,7 +1414,8 @@ class NotificationSymptom(ModelView, ModelSQL):
 
     @classmethod
     def get_rec_name(cls, records, name):
-        return dict([(x.id, x.pathology.rec_name) for x in records])
+        return dict([(x, y) for x, (y, ) in many2one_values(
+            cls, records, ['pathology']).iteritems()])
 
 
 class TravelHistory(ModelView, ModelSQL):
@@ -484,8 +1442,10 @@ class TravelHistory(ModelView, ModelSQL):
 
     @classmethod
     def get_rec_name(cls, records, name):
-        return dict([(x.id, '%s, %s' % (x.subdiv.name, x.country.name))
-                    for x in records])
+        return dict([(x, ', '.join(filter(None, y)))
+                     for x, y in many2one_values(
+                         cls, records, ['subdiv', 'country'], 'name'
+                         ).iteritems()])
 
 
 class NotificationStateChange(ModelSQL, ModelView):
@@ -503,9 +1463,1214 @@ class NotificationStateChange(ModelSQL, ModelView):
     change_date = fields.DateTime('Changed on')
     creator = fields.Function(fields.Char('Changed by'), 'get_creator_name')
 
-    def get_creator_name(self, name):
-        return self.healthprof.name.name
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        super(NotificationStateChange, cls).__register__(module_name)
+        table = TableHandler(cursor, cls, module_name)
+        # matches the order of the state_changes on the notification
+        table.index_action(['notification', 'create_date'], 'add')
+
+    @classmethod
+    def get_creator_name(cls, records, name):
+        pool = Pool()
+        HealthProf = pool.get('gnuhealth.healthprofessional')
+        Party = pool.get('party.party')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        healthprof = HealthProf.__table__()
+        party = Party.__table__()
+        join = table.join(healthprof, 'LEFT',
+                          condition=table.healthprof == healthprof.id
+                          ).join(party, 'LEFT',
+                                 condition=healthprof.name == party.id)
+        result = dict([(x.id, None) for x in records])
+        for sub_ids in grouped_slice(result.keys()):
+            cursor.execute(*join.select(
+                table.id, party.name,
+                where=reduce_ids(table.id, list(sub_ids))))
+            result.update(cursor.fetchall())
+        return result
 
     @staticmethod
     def default_change_date():
         return datetime.now()
+
+    @classmethod
+    def bulk_create(cls, rows):
+        '''
+        inserts the state changes in rows, tuples of (notification,
+        orig_state, target_state, healthprof), with multi-row INSERTs
+        instead of one create per record
+        '''
+        if not rows:
+            return
+        ModelAccess = Pool().get('ir.model.access')
+        ModelAccess.check(cls.__name__, 'create')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        user = Transaction().user
+        change_date = cls.default_change_date()
+
+        def to_id(value):
+            return int(value) if value is not None else None
+
+        for sub_rows in grouped_slice(rows):
+            cursor.execute(*table.insert(
+                [table.notification, table.orig_state, table.target_state,
+                 table.healthprof, table.change_date, table.create_uid,
+                 table.create_date],
+                [[to_id(notification), orig_state, target_state,
+                  to_id(healthprof), change_date, user, CurrentTimestamp()]
+                 for notification, orig_state, target_state, healthprof
+                 in sub_rows]))
+
+
+class NotificationCaseCount(ModelSQL):
+    '''
+    Notification case counts by diagnosis, epi week of onset, status and
+    reporting facility, of the active notifications. The counts are kept
+    by the notifications themselves: each create, write, delete or
+    reclassify that moves notifications between keys inserts rows with
+    the differences, so concurrent transactions never wait on the same
+    row. compact folds them into one row per key and rebuild recounts
+    everything from the notifications.
+    '''
+    __name__ = 'gnuhealth.disease_notification.case_count'
+    diagnosis = fields.Many2One('gnuhealth.pathology', 'Diagnosis',
+                                readonly=True)
+    epi_week = fields.Char('Epi. Week of onset', size=8, readonly=True)
+    status = fields.Selection(NOTIFICATION_STATES, 'Status', readonly=True)
+    reporting_facility = fields.Many2One('gnuhealth.institution',
+                                         'Reporting facility', readonly=True)
+    cases = fields.Integer('Cases', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(NotificationCaseCount, cls).__setup__()
+        cls.__rpc__.update({
+            'weekly_counts': RPC(),
+            'rebuild': RPC(readonly=False),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        created = not TableHandler.table_exist(cursor, cls._table)
+        super(NotificationCaseCount, cls).__register__(module_name)
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['epi_week', 'diagnosis'], 'add')
+        if created:
+            cls._rebuild()
+
+    @classmethod
+    def _key_columns(cls, table):
+        return [table.diagnosis, table.epi_week, table.status,
+                table.reporting_facility]
+
+    @classmethod
+    def count_changes(cls, notification, where, sign, status=None):
+        '''
+        adds (sign 1) or removes (sign -1) the active notifications in the
+        notification table that match where to or from the counts, with one
+        INSERT ... SELECT. Counts them under status instead of their own
+        when it is given.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        keys = [notification.diagnosis, notification.epi_week_onset,
+                notification.status, notification.reporting_facility]
+        columns = keys[:]
+        if status is not None:
+            columns[2] = Literal(status)
+            del keys[2]
+        columns.extend([Count(Literal(1)) * sign,
+                        Literal(Transaction().user), CurrentTimestamp()])
+        cursor.execute(*table.insert(
+            cls._key_columns(table) + [table.cases, table.create_uid,
+                                       table.create_date],
+            notification.select(*columns,
+                                where=where & (notification.active == True),
+                                group_by=keys)))
+
+    @classmethod
+    def add(cls, ids):
+        '''adds the notifications in ids to the counts'''
+        cls._count_ids(ids, 1)
+
+    @classmethod
+    def remove(cls, ids):
+        '''removes the notifications in ids from the counts'''
+        cls._count_ids(ids, -1)
+
+    @classmethod
+    def _count_ids(cls, ids, sign):
+        Notification = Pool().get('gnuhealth.disease_notification')
+        notification = Notification.__table__()
+        for sub_ids in grouped_slice(ids):
+            cls.count_changes(notification,
+                              reduce_ids(notification.id, list(sub_ids)),
+                              sign)
+
+    @classmethod
+    def compact(cls):
+        '''
+        replaces the rows of each key with a single row holding their sum.
+        The rows are deleted and summed by the same statement so that none
+        inserted meanwhile by other transactions is lost.
+        '''
+        cursor = Transaction().cursor
+        keys = 'diagnosis, epi_week, status, reporting_facility'
+        cursor.execute('WITH moved AS ('
+                       'DELETE FROM "%(table)s" RETURNING %(keys)s, cases) '
+                       'INSERT INTO "%(table)s" '
+                       '(%(keys)s, cases, create_uid, create_date) '
+                       'SELECT %(keys)s, SUM(cases), %%s, CURRENT_TIMESTAMP '
+                       'FROM moved GROUP BY %(keys)s '
+                       'HAVING SUM(cases) != 0' % {
+                           'table': cls._table, 'keys': keys},
+                       (Transaction().user,))
+
+    @classmethod
+    def rebuild(cls):
+        '''recounts all active notifications'''
+        ModelAccess = Pool().get('ir.model.access')
+        ModelAccess.check(cls.__name__, 'delete')
+        cls._rebuild()
+
+    @classmethod
+    def _rebuild(cls):
+        Notification = Pool().get('gnuhealth.disease_notification')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        notification = Notification.__table__()
+        # keeps the notifications from adding their differences until the
+        # recount is committed
+        cursor.execute('LOCK "%s" IN EXCLUSIVE MODE' % cls._table)
+        cursor.execute(*table.delete())
+        cls.count_changes(notification, Literal(True), 1)
+
+    @classmethod
+    def weekly_counts(cls, start_week=None, end_week=None, status=None,
+                      diagnoses=None):
+        '''
+        returns [{diagnosis, epi_week, cases}] for the epi weeks from
+        start_week to end_week (both included, as formatted by epiweek_str),
+        for the notifications in status and with one of diagnoses, if given
+        '''
+        ModelAccess = Pool().get('ir.model.access')
+        # the counts are of notifications, reading them takes both
+        ModelAccess.check(cls.__name__, 'read')
+        ModelAccess.check('gnuhealth.disease_notification', 'read')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        where = Literal(True)
+        if start_week:
+            where &= table.epi_week >= start_week
+        if end_week:
+            where &= table.epi_week <= end_week
+        if status:
+            where &= table.status == status
+        if diagnoses is not None:
+            where &= table.diagnosis.in_(map(int, diagnoses) or [None])
+        cases = Sum(table.cases)
+        cursor.execute(*table.select(
+            table.diagnosis, table.epi_week, cases, where=where,
+            group_by=[table.diagnosis, table.epi_week], having=cases != 0,
+            order_by=[table.diagnosis.asc, table.epi_week.asc]))
+        return [{'diagnosis': diagnosis, 'epi_week': epi_week,
+                 'cases': int(count)}
+                for diagnosis, epi_week, count in cursor.fetchall()]
+
+
+class OutbreakSignal(ModelSQL, ModelView):
+    '''
+    Outbreak Signal: a week in which the number of notifications of a
+    diagnosis, nationally or in a parish, was flagged by one of the
+    aberration detection methods
+    '''
+    __name__ = 'gnuhealth.disease_notification.signal'
+    diagnosis = fields.Many2One('gnuhealth.pathology', 'Diagnosis',
+                                required=True, readonly=True)
+    parish = fields.Many2One('country.subdivision', 'Parish', readonly=True,
+                             help='Empty for the national counts')
+    epi_week = fields.Char('Epi. Week', size=8, readonly=True)
+    week_start = fields.Date('Week starting', required=True, readonly=True,
+                             select=True)
+    method = fields.Selection(SIGNAL_METHODS, 'Method', required=True,
+                              readonly=True)
+    cases = fields.Integer('Cases', readonly=True)
+    statistic = fields.Float('Statistic', digits=(16, 2), readonly=True)
+    reviewed = fields.Boolean('Reviewed')
+    comment = fields.Text('Comment')
+
+    @classmethod
+    def __setup__(cls):
+        super(OutbreakSignal, cls).__setup__()
+        cls._order = [('week_start', 'DESC'), ('diagnosis', 'ASC')]
+        cls.__rpc__.update({
+            'detect': RPC(readonly=False),
+        })
+
+    @staticmethod
+    def default_reviewed():
+        return False
+
+    @classmethod
+    def count_matrix(cls, first_week, last_week, by_parish=False):
+        '''
+        returns (keys, counts) where counts has a row of weekly notification
+        counts for each (diagnosis, parish) in keys, from first_week to
+        last_week (as aberration.week_index). The week of a notification
+        is the week of onset or, failing that, the week it was reported.
+        parish is None unless by_parish.
+        '''
+        pool = Pool()
+        Notification = pool.get('gnuhealth.disease_notification')
+        Patient = pool.get('gnuhealth.patient')
+        Party = pool.get('party.party')
+        DU = pool.get('gnuhealth.du')
+        cursor = Transaction().cursor
+        notification = Notification.__table__()
+        patient = Patient.__table__()
+        party = Party.__table__()
+        du = DU.__table__()
+
+        onset = Coalesce(notification.date_onset,
+                         Cast(notification.date_notified, 'DATE'))
+        week = (onset - Literal(date.fromordinal(aberration.WEEK_ZERO))) / 7
+        parish = Literal(None)
+        join = notification
+        if by_parish:
+            join = join.join(patient, condition=notification.patient ==
+                             patient.id
+                             ).join(party, condition=patient.name == party.id
+                                    ).join(du, 'LEFT',
+                                           condition=party.du == du.id)
+            parish = du.subdivision
+        where = ((notification.active == True) &
+                 (notification.diagnosis != None) &
+                 ~notification.status.in_(SIGNAL_EXCLUDED_STATES) &
+                 (onset >= date.fromordinal(aberration.week_start(
+                     first_week))) &
+                 (onset < date.fromordinal(aberration.week_start(
+                     last_week + 1))))
+        group_by = [notification.diagnosis, week]
+        if by_parish:
+            group_by.append(parish)
+        cursor.execute(*join.select(notification.diagnosis, parish, week,
+                                    Count(Literal(1)), where=where,
+                                    group_by=group_by))
+        return aberration.count_matrix(
+            [(x[:2], x[2] - first_week, x[3]) for x in cursor.fetchall()],
+            last_week - first_week + 1)
+
+    @classmethod
+    def detect(cls, weeks=1, methods=None):
+        '''
+        runs the aberration detection methods (default all of them) on the
+        weekly counts by diagnosis and by diagnosis and parish, and stores
+        a signal for each week flagged among the last complete weeks.
+        Signals found before are kept as they are. Returns the number of
+        new signals.
+        '''
+        last_week = aberration.week_index(date.today()) - 1
+        first_week = last_week - weeks - SIGNAL_HISTORY_WEEKS + 1
+        to_create = []
+        for by_parish in (False, True):
+            keys, counts = cls.count_matrix(first_week, last_week, by_parish)
+            if not keys:
+                continue
+            flagged = aberration.detect(counts, methods,
+                                        first_week=counts.shape[1] - weeks)
+            for method, hits in flagged.iteritems():
+                for row, column, statistic in hits:
+                    diagnosis, parish = keys[row]
+                    if by_parish and parish is None:
+                        continue
+                    week_start = date.fromordinal(
+                        aberration.week_start(first_week + column))
+                    to_create.append({
+                        'diagnosis': diagnosis,
+                        'parish': parish,
+                        'epi_week': epiweek_str(week_start),
+                        'week_start': week_start,
+                        'method': method,
+                        'cases': int(counts[row, column]),
+                        'statistic': statistic,
+                    })
+        if not to_create:
+            return 0
+        found = cls.search_read(
+            [('week_start', '>=', min([x['week_start'] for x in to_create]))],
+            fields_names=['diagnosis', 'parish', 'week_start', 'method'])
+        known = set([(x['diagnosis'], x['parish'], x['week_start'],
+                      x['method']) for x in found])
+        to_create = [x for x in to_create
+                     if (x['diagnosis'], x['parish'], x['week_start'],
+                         x['method']) not in known]
+        cls.create(to_create)
+        return len(to_create)
+
+
+class NotificationCluster(ModelSQL, ModelView):
+    '''
+    Notification Cluster: a community or post office and a run of epi
+    weeks with more notifications of a diagnosis than expected, found by
+    the space-time permutation scan
+    '''
+    __name__ = 'gnuhealth.disease_notification.cluster'
+    diagnosis = fields.Many2One('gnuhealth.pathology', 'Diagnosis',
+                                required=True, readonly=True)
+    scan_type = fields.Selection(SCAN_TYPES, 'Scan', required=True,
+                                 readonly=True)
+    community = fields.Many2One('country.district_community', 'Community',
+                                readonly=True)
+    post_office = fields.Many2One('country.post_office', 'Post Office',
+                                  readonly=True)
+    start_week = fields.Date('First week starting', readonly=True)
+    end_week = fields.Date('Last week starting', readonly=True)
+    epi_weeks = fields.Char('Epi. Weeks', readonly=True)
+    cases = fields.Integer('Cases', readonly=True)
+    expected = fields.Float('Expected cases', digits=(16, 2), readonly=True)
+    llr = fields.Float('Log likelihood ratio', digits=(16, 2),
+                       readonly=True)
+    p_value = fields.Float('p-value', digits=(16, 4), readonly=True)
+    replications = fields.Integer('Replications', readonly=True)
+    notifications = fields.Many2Many(
+        'gnuhealth.disease_notification.cluster-notification', 'cluster',
+        'notification', 'Notifications', readonly=True)
+    reviewed = fields.Boolean('Reviewed')
+    comment = fields.Text('Comment')
+
+    @classmethod
+    def __setup__(cls):
+        super(NotificationCluster, cls).__setup__()
+        cls._order = [('create_date', 'DESC'), ('p_value', 'ASC')]
+        cls.__rpc__.update({
+            'run_scan': RPC(readonly=False),
+        })
+
+    @staticmethod
+    def default_reviewed():
+        return False
+
+    @classmethod
+    def _scan_cases(cls, first_week, last_week, diagnosis=None):
+        '''
+        returns [(diagnosis, notification, community, post office, week)]
+        for the notifications with a known community or post office whose
+        week (see OutbreakSignal.count_matrix) is between first_week and
+        last_week
+        '''
+        pool = Pool()
+        Notification = pool.get('gnuhealth.disease_notification')
+        Patient = pool.get('gnuhealth.patient')
+        Party = pool.get('party.party')
+        DU = pool.get('gnuhealth.du')
+        cursor = Transaction().cursor
+        notification = Notification.__table__()
+        patient = Patient.__table__()
+        party = Party.__table__()
+        du = DU.__table__()
+
+        onset = Coalesce(notification.date_onset,
+                         Cast(notification.date_notified, 'DATE'))
+        week = (onset - Literal(date.fromordinal(aberration.WEEK_ZERO))) / 7
+        join = notification.join(
+            patient, condition=notification.patient == patient.id
+            ).join(party, condition=patient.name == party.id
+                   ).join(du, condition=party.du == du.id)
+        where = ((notification.active == True) &
+                 (notification.storage == 'hot') &
+                 (notification.diagnosis != None) &
+                 ~notification.status.in_(SIGNAL_EXCLUDED_STATES) &
+                 ((du.district_community != None) |
+                  (du.post_office != None)) &
+                 (onset >= date.fromordinal(aberration.week_start(
+                     first_week))) &
+                 (onset < date.fromordinal(aberration.week_start(
+                     last_week + 1))))
+        if diagnosis is not None:
+            where &= notification.diagnosis == int(diagnosis)
+        cursor.execute(*join.select(
+            notification.diagnosis, notification.id, du.district_community,
+            du.post_office, week, where=where,
+            order_by=[notification.diagnosis.asc]))
+        return cursor.fetchall()
+
+    @classmethod
+    def run_scan(cls, diagnosis=None, weeks=52, max_length=4,
+                 prospective=True, replications=999, alpha=0.05):
+        '''
+        scans the notifications of the last weeks complete epi weeks, of
+        diagnosis or of each diagnosis in turn, for clusters of up to
+        max_length weeks. The zones are the communities and the post
+        offices. A prospective scan only looks for clusters still going on
+        in the last week. Stores the clusters with a p-value of at most
+        alpha and returns their number.
+        The replications run in this process unless scan_processes, from
+        the [health_disease_notification] section of trytond.conf, is more
+        than 1 (0 for one per CPU). A pool forks the server with its
+        database connections and the locks of its other threads, so it is
+        only for scans run from a script of their own.
+        '''
+        last_week = aberration.week_index(date.today()) - 1
+        first_week = last_week - weeks + 1
+        processes = config.getint('health_disease_notification',
+                                  'scan_processes', default=1) or None
+        to_create = []
+        cases = cls._scan_cases(first_week, last_week, diagnosis)
+        for pathology, rows in groupby(cases, key=lambda x: x[0]):
+            rows = list(rows)
+            places = sorted(set([x[2:4] for x in rows]))
+            index = dict([(x, i) for i, x in enumerate(places)])
+            location = [index[x[2:4]] for x in rows]
+            week = [x[4] - first_week for x in rows]
+            # each community (or bare post office) is a zone, and so is each
+            # post office with more than one community
+            zones = [[x] for x in range(len(places))]
+            post_offices = []
+            for post_office, members in groupby(
+                    sorted(range(len(places)), key=lambda x: places[x][1]),
+                    key=lambda x: places[x][1]):
+                members = list(members)
+                if post_office is not None and len(members) > 1:
+                    zones.append(members)
+                    post_offices.append(post_office)
+            clusters = scan.scan(location, week, zones, len(places), weeks,
+                                 max_length=max_length,
+                                 prospective=prospective,
+                                 replications=replications,
+                                 processes=processes)
+            for cluster in clusters:
+                if cluster['p_value'] > alpha:
+                    continue
+                zone = cluster['zone']
+                if zone < len(places):
+                    community, post_office = places[zone]
+                else:
+                    community = None
+                    post_office = post_offices[zone - len(places)]
+                members = set(zones[zone])
+                notifications = [
+                    x[1] for x, loc, wk in zip(rows, location, week)
+                    if loc in members and
+                    cluster['first_week'] <= wk <= cluster['last_week']]
+                start, end = [date.fromordinal(aberration.week_start(
+                    first_week + cluster[x])) for x in ('first_week',
+                                                        'last_week')]
+                epi_weeks = epiweek_str(start)
+                if end != start:
+                    epi_weeks = '%s - %s' % (epi_weeks, epiweek_str(end))
+                to_create.append({
+                    'diagnosis': pathology,
+                    'scan_type': ('prospective' if prospective
+                                  else 'retrospective'),
+                    'community': community,
+                    'post_office': post_office,
+                    'start_week': start,
+                    'end_week': end,
+                    'epi_weeks': epi_weeks,
+                    'cases': cluster['cases'],
+                    'expected': cluster['expected'],
+                    'llr': cluster['llr'],
+                    'p_value': cluster['p_value'],
+                    'replications': replications,
+                    'notifications': [('add', notifications)],
+                })
+        cls.create(to_create)
+        return len(to_create)
+
+
+class NotificationClusterMember(ModelSQL):
+    'Notification Cluster - Notification'
+    __name__ = 'gnuhealth.disease_notification.cluster-notification'
+    cluster = fields.Many2One('gnuhealth.disease_notification.cluster',
+                              'Cluster', required=True, select=True,
+                              ondelete='CASCADE')
+    notification = fields.Many2One('gnuhealth.disease_notification',
+                                   'Notification', required=True,
+                                   select=True, ondelete='CASCADE')
+
+
+class NotificationDuplicate(ModelSQL, ModelView):
+    '''
+    Possible Duplicate Notification: a pair of notifications that look
+    like the same case, waiting for review. The newer of the two is the
+    notification, the older the original.
+    '''
+    __name__ = 'gnuhealth.disease_notification.duplicate'
+    notification = fields.Many2One('gnuhealth.disease_notification',
+                                   'Notification', required=True,
+                                   readonly=True, select=True,
+                                   ondelete='CASCADE')
+    original = fields.Many2One('gnuhealth.disease_notification',
+                               'Possible duplicate of', required=True,
+                               readonly=True, select=True,
+                               ondelete='CASCADE')
+    score = fields.Float('Score', digits=(16, 2), readonly=True)
+    state = fields.Selection(DUPLICATE_STATES, 'State', required=True,
+                             readonly=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(NotificationDuplicate, cls).__setup__()
+        cls._order = [('score', 'DESC'), ('id', 'DESC')]
+        cls._sql_constraints = [
+            ('pair_uniq', 'UNIQUE(notification, original)',
+             'The pair of notifications must be unique.')]
+        cls._buttons.update({
+            'confirm': {'invisible': Eval('state') != 'pending'},
+            'dismiss': {'invisible': Eval('state') != 'pending'},
+        })
+        cls.__rpc__.update({
+            'find_duplicates': RPC(readonly=False),
+        })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @classmethod
+    @ModelView.button
+    def confirm(cls, duplicates):
+        '''sets the notifications to Duplicate, Discard'''
+        Notification = Pool().get('gnuhealth.disease_notification')
+        cls.write(duplicates, {'state': 'duplicate'})
+        Notification.write(list(set([x.notification for x in duplicates])),
+                           {'status': 'delete'})
+
+    @classmethod
+    @ModelView.button
+    def dismiss(cls, duplicates):
+        cls.write(duplicates, {'state': 'distinct'})
+
+    @classmethod
+    def _dedup_records(cls, where):
+        '''
+        returns the notifications that match where as the records of
+        dedup: (id, normalised patient name, dob, diagnosis, onset)
+        '''
+        pool = Pool()
+        Notification = pool.get('gnuhealth.disease_notification')
+        Patient = pool.get('gnuhealth.patient')
+        Party = pool.get('party.party')
+        cursor = Transaction().cursor
+        notification = Notification.__table__()
+        patient = Patient.__table__()
+        party = Party.__table__()
+        onset = Coalesce(notification.date_onset,
+                         Cast(notification.date_notified, 'DATE'))
+        join = notification.join(
+            patient, condition=notification.patient == patient.id
+            ).join(party, condition=patient.name == party.id)
+        cursor.execute(*join.select(
+            notification.id, party.name, party.lastname, party.dob,
+            notification.diagnosis, onset,
+            where=where(notification, onset) &
+            (notification.active == True) &
+            (notification.storage == 'hot') &
+            (notification.status != 'delete')))
+        return [(x[0], dedup.normalize_name(' '.join(filter(None, x[1:3]))))
+                + x[3:] for x in cursor.fetchall()]
+
+    @classmethod
+    def find_duplicates(cls, days=2):
+        '''
+        queues the possible duplicates among the notifications created or
+        changed in the last days, or in all of them when days is None.
+        Only the notifications with the same diagnosis and onsets close
+        enough to share a block of dedup are read. Returns the number of
+        pairs queued.
+        '''
+        Notification = Pool().get('gnuhealth.disease_notification')
+        cursor = Transaction().cursor
+        notification = Notification.__table__()
+        margin = timedelta(days=2 * dedup.ONSET_WINDOW)
+        pairs = {}
+        if days is None:
+            cursor.execute(*notification.select(
+                notification.diagnosis, group_by=[notification.diagnosis]))
+            diagnoses = [x for x, in cursor.fetchall()]
+            new_ids = None
+        else:
+            since = datetime.now() - timedelta(days=days)
+            new = cls._dedup_records(
+                lambda table, onset: (table.create_date >= since) |
+                (table.write_date >= since))
+            new_ids = set([x[0] for x in new])
+            diagnoses = set([x[3] for x in new])
+
+        for diagnosis in diagnoses:
+            def where(table, onset):
+                if diagnosis is None:
+                    condition = table.diagnosis == None
+                else:
+                    condition = table.diagnosis == diagnosis
+                if new_ids is not None:
+                    onsets = [x[4] for x in new if x[3] == diagnosis]
+                    condition &= ((onset >= min(onsets) - margin) &
+                                  (onset <= max(onsets) + margin))
+                return condition
+            pairs.update(dedup.find_pairs(cls._dedup_records(where),
+                                          new_ids))
+        if not pairs:
+            return 0
+
+        table = cls.__table__()
+        known = set()
+        for sub_pairs in grouped_slice(pairs.keys()):
+            sub_pairs = list(sub_pairs)
+            cursor.execute(*table.select(
+                table.original, table.notification,
+                where=table.notification.in_([x[1] for x in sub_pairs])))
+            known.update(cursor.fetchall())
+        cls.create([{'original': original, 'notification': notification_id,
+                     'score': score}
+                    for (original, notification_id), score
+                    in pairs.iteritems()
+                    if (original, notification_id) not in known])
+        return len(pairs) - len(known.intersection(pairs))
+
+
+class ReportCache(ModelSQL):
+    '''
+    Results of reports kept for the next run with the same parameters, see
+    CachedReportMixin in reports.py. An entry covers the notifications
+    reported from its start date to before its end date and is dropped by
+    the create, write, reclassify or delete of any of them. The least
+    recently used entries make way once the results take more than
+    report_cache_size megabytes.
+
+    The drops are also logged, by transaction, in REPORT_CACHE_LOG: a
+    transaction cannot drop the entries that runs in progress have yet to
+    commit, so an entry is only handed back when the snapshot it was
+    computed from saw every drop of its window since.
+    '''
+    __name__ = 'gnuhealth.disease_notification.report_cache'
+    report = fields.Char('Report', required=True, readonly=True)
+    key = fields.Char('Key', size=40, required=True, readonly=True)
+    start_date = fields.DateTime('From', required=True, readonly=True)
+    end_date = fields.DateTime('Until', required=True, readonly=True)
+    result_type = fields.Char('Type', readonly=True)
+    result = fields.Binary('Result', readonly=True)
+    result_name = fields.Char('Name', readonly=True)
+    direct_print = fields.Boolean('Direct print', readonly=True)
+    size = fields.Integer('Size', readonly=True)
+    last_used = fields.DateTime('Last used', readonly=True)
+    txid = fields.BigInteger('Transaction', readonly=True)
+    snapshot = fields.Char('Snapshot', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        super(ReportCache, cls).__register__(module_name)
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['report', 'key'], 'add')
+        table.index_action(['start_date', 'end_date'], 'add')
+        # entries without a snapshot can not be checked against the log
+        cursor.execute('DELETE FROM "%s" WHERE snapshot IS NULL' % cls._table)
+        if not TableHandler.table_exist(cursor, REPORT_CACHE_LOG):
+            # no dates is a drop of every entry
+            cursor.execute('CREATE TABLE "%s" (txid BIGINT NOT NULL, '
+                           'start_date TIMESTAMP, end_date TIMESTAMP, '
+                           'logged TIMESTAMP NOT NULL DEFAULT NOW())' %
+                           REPORT_CACHE_LOG)
+            cursor.execute('CREATE INDEX "%s_logged" ON "%s" (logged)' % (
+                REPORT_CACHE_LOG, REPORT_CACHE_LOG))
+
+    @staticmethod
+    def make_key(report, params):
+        '''
+        returns the key of report run with params, a dict, by the current
+        user: the record rules and the company decide what they read
+        '''
+        transaction = Transaction()
+        return hashlib.sha1(json.dumps(
+            [report, transaction.language, transaction.user,
+             transaction.context.get('company'), sorted(params.items())],
+            default=str)).hexdigest()
+
+    @staticmethod
+    def current_snapshot():
+        '''
+        returns (transaction id, snapshot) of the current transaction, to
+        be taken before the result is computed and passed on to put
+        '''
+        cursor = Transaction().cursor
+        cursor.execute('SELECT txid_current(), '
+                       'txid_current_snapshot()::text')
+        return cursor.fetchone()
+
+    @classmethod
+    def get(cls, report, key):
+        '''
+        returns the cached result, (type, data, direct print, name), of
+        report for key or None
+        '''
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cursor.execute('SELECT id, result_type, result, direct_print, '
+                       'result_name, last_used FROM "%s" AS cache '
+                       'WHERE report = %%s AND key = %%s AND NOT %s '
+                       'ORDER BY id DESC LIMIT 1' % (
+                           cls._table, cls._stale_sql()), (report, key))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        # marked used at most once a minute, and not at all when another
+        # run holds the row: NOWAIT fails at once where the update would
+        # wait for the other transaction, so that runs of the same report
+        # do not wait on each other
+        if row[5] is None or row[5] < datetime.now() - timedelta(minutes=1):
+            cursor.execute('SAVEPOINT report_cache_used')
+            try:
+                cursor.execute('SELECT id FROM "%s" WHERE id = %%s '
+                               'FOR UPDATE NOWAIT' % cls._table, (row[0], ))
+                cursor.execute(*table.update([table.last_used],
+                                             [CurrentTimestamp()],
+                                             where=table.id == row[0]))
+                cursor.execute('RELEASE SAVEPOINT report_cache_used')
+            except DatabaseOperationalError:
+                cursor.execute('ROLLBACK TO SAVEPOINT report_cache_used')
+        return tuple(row[1:5])
+
+    @staticmethod
+    def _stale_sql():
+        '''
+        returns the SQL condition on the entries, as cache, that a drop of
+        their window was logged that their snapshot did not see. The drops
+        of the transaction that computed the entry are seen by it.
+        '''
+        return ('(cache.snapshot IS NULL OR EXISTS (SELECT 1 FROM "%s" AS log '
+                'WHERE (log.start_date IS NULL OR '
+                '(log.start_date < cache.end_date '
+                'AND log.end_date >= cache.start_date)) '
+                'AND log.txid != cache.txid '
+                'AND NOT txid_visible_in_snapshot(log.txid, '
+                'cache.snapshot::txid_snapshot)))' % REPORT_CACHE_LOG)
+
+    @classmethod
+    def put(cls, report, key, start_date, end_date, result, snapshot=None):
+        '''
+        keeps result, as returned by Report.execute, for report and key.
+        It covers the notifications reported from start_date to before
+        end_date. snapshot, as returned by current_snapshot, is the one
+        the result was computed from, the current one by default.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        result_type, data, direct_print, name = result
+        limit = config.getint('health_disease_notification',
+                              'report_cache_size', default=50) * 1024 * 1024
+        if len(data) > limit:
+            return
+        txid, snapshot = snapshot or cls.current_snapshot()
+        cursor.execute(*table.delete(
+            where=(table.report == report) & (table.key == key)))
+        cursor.execute(*table.insert(
+            [table.report, table.key, table.start_date, table.end_date,
+             table.result_type, table.result, table.result_name,
+             table.direct_print, table.size, table.last_used,
+             table.txid, table.snapshot,
+             table.create_uid, table.create_date],
+            [[report, key, start_date, end_date, result_type, data, name,
+              direct_print, len(data), CurrentTimestamp(), txid, snapshot,
+              Transaction().user, CurrentTimestamp()]]))
+        cls.evict(limit)
+        cls.prune()
+
+    @classmethod
+    def evict(cls, limit):
+        '''
+        deletes the least recently used entries beyond the first limit
+        bytes of results
+        '''
+        cursor = Transaction().cursor
+        cursor.execute('DELETE FROM "%(table)s" WHERE id IN ('
+                       'SELECT id FROM (SELECT id, SUM(size) OVER ('
+                       'ORDER BY last_used DESC, id DESC) AS total '
+                       'FROM "%(table)s") AS used WHERE total > %%s)' % {
+                           'table': cls._table}, (limit,))
+
+    @classmethod
+    def prune(cls):
+        '''
+        drops the logged drops older than REPORT_CACHE_LOG_AGE, and first
+        the entries they make stale
+        '''
+        cursor = Transaction().cursor
+        logged = datetime.now() - REPORT_CACHE_LOG_AGE
+        cursor.execute('DELETE FROM "%s" AS cache WHERE %s' % (
+            cls._table, cls._stale_sql().replace(
+                'WHERE', 'WHERE log.logged < %s AND', 1)), (logged,))
+        cursor.execute('DELETE FROM "%s" WHERE logged < %%s' %
+                       REPORT_CACHE_LOG, (logged,))
+
+    @classmethod
+    def invalidate(cls, notification, where):
+        '''
+        drops the entries that cover any of the notifications in the
+        notification table that match where
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cache = cls.__table__()
+        log = Table(REPORT_CACHE_LOG)
+        cursor.execute(*log.insert(
+            [log.txid, log.start_date, log.end_date],
+            notification.select(
+                TxidCurrent(), Min(notification.date_notified),
+                Max(notification.date_notified), where=where,
+                having=Count(Literal(1)) > 0)))
+        covered = cache.join(
+            notification,
+            condition=(notification.date_notified >= cache.start_date) &
+            (notification.date_notified < cache.end_date))
+        cursor.execute(*table.delete(where=table.id.in_(
+            covered.select(cache.id, where=where))))
+
+    @classmethod
+    def invalidate_ids(cls, ids):
+        '''drops the entries that cover the notifications in ids'''
+        Notification = Pool().get('gnuhealth.disease_notification')
+        notification = Notification.__table__()
+        for sub_ids in grouped_slice(ids):
+            cls.invalidate(notification,
+                           reduce_ids(notification.id, list(sub_ids)))
+
+    @classmethod
+    def clear(cls):
+        '''drops all the entries'''
+        cursor = Transaction().cursor
+        log = Table(REPORT_CACHE_LOG)
+        cursor.execute(*log.insert([log.txid], [[TxidCurrent()]]))
+        cursor.execute(*cls.__table__().delete())
+
+
+class ReportJob(ModelSQL, ModelView):
+    '''
+    Report Job: a report asked for by a user and rendered out of band by
+    the worker threads that the Run Report Jobs scheduled action starts.
+    The file is kept on the job for the user to download. A user can have
+    at most report_job_user_queue jobs queued or running at once, and the
+    workers of a server run at most report_job_user_running of them at a
+    time.
+    '''
+    __name__ = 'gnuhealth.disease_notification.report_job'
+    name = fields.Char('Report', required=True, readonly=True)
+    report = fields.Char('Report name', required=True, readonly=True)
+    user = fields.Many2One('res.user', 'User', required=True, readonly=True,
+                           select=True)
+    record_ids = fields.Text('Records', readonly=True)
+    data = fields.Text('Data', readonly=True)
+    language = fields.Char('Language', readonly=True)
+    state = fields.Selection(REPORT_JOB_STATES, 'State', required=True,
+                             readonly=True, select=True, sort=False)
+    progress = fields.Integer('Progress', readonly=True)
+    started = fields.DateTime('Started', readonly=True)
+    finished = fields.DateTime('Finished', readonly=True)
+    file = fields.Binary('File', filename='file_name', readonly=True)
+    file_name = fields.Char('File name', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ReportJob, cls).__setup__()
+        cls._order = [('id', 'DESC')]
+        cls._error_messages.update({
+            'too_many_jobs': 'You already have %s reports waiting or '
+                             'running. Try again once one of them is done.',
+            'stalled': 'The report did not finish within %s minutes.',
+        })
+        cls._buttons.update({
+            'cancel': {'invisible': Eval('state') != 'queued'},
+        })
+        cls.__rpc__.update({
+            'run_jobs': RPC(readonly=False),
+        })
+
+    @staticmethod
+    def default_state():
+        return 'queued'
+
+    @staticmethod
+    def default_progress():
+        return 0
+
+    @staticmethod
+    def default_user():
+        return Transaction().user
+
+    @classmethod
+    @ModelView.button
+    def cancel(cls, jobs):
+        # the users may not write their jobs, the search keeps to theirs
+        jobs = cls.search([('id', 'in', map(int, jobs)),
+                           ('state', '=', 'queued')])
+        with Transaction().set_user(0):
+            cls.write(jobs, {'state': 'cancelled',
+                             'finished': datetime.now()})
+
+    @classmethod
+    def enqueue(cls, report, ids, data):
+        '''
+        queues a run of report, a report name, for the records with ids and
+        data and returns the job
+        '''
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        transaction = Transaction()
+        limit = config.getint('health_disease_notification',
+                              'report_job_user_queue', default=3)
+        if cls.search([('user', '=', transaction.user),
+                       ('state', 'in', ['queued', 'running'])],
+                      count=True) >= limit:
+            cls.raise_user_error('too_many_jobs', (limit, ))
+        action_reports = ActionReport.search([('report_name', '=', report)],
+                                             limit=1)
+        values = {
+            'name': action_reports[0].name if action_reports else report,
+            'report': report,
+            'user': transaction.user,
+            'record_ids': json.dumps(map(int, ids or [])),
+            'data': json.dumps(data, cls=JSONEncoder),
+            'language': transaction.language,
+        }
+        # only the server creates jobs, the worker runs them as their user
+        with transaction.set_user(0):
+            job, = cls.create([values])
+        return cls(job.id)
+
+    @classmethod
+    def report_progress(cls, done, total):
+        '''
+        records that the report job being run has done done of total steps,
+        at most every few seconds. Does nothing outside of report jobs.
+        '''
+        job_id = Transaction().context.get('report_job')
+        if not job_id or not total:
+            return
+        now = time.time()
+        with _REPORT_JOB_LOCK:
+            if now - _REPORT_JOB_PROGRESS.get(job_id, 0) < 5:
+                return
+            _REPORT_JOB_PROGRESS[job_id] = now
+        table = cls.__table__()
+        # committed on a cursor of its own so that the user sees it while
+        # the report runs
+        with Transaction().new_cursor():
+            cursor = Transaction().cursor
+            cursor.execute(*table.update(
+                [table.progress], [min(99, 100 * done // total)],
+                where=table.id == job_id))
+            cursor.commit()
+
+    @classmethod
+    def run(cls, jobs):
+        '''renders the reports of jobs and keeps the files on them'''
+        pool = Pool()
+        for job in jobs:
+            Report = pool.get(job.report, type='report')
+            data = json.loads(job.data, object_hook=JSONDecoder())
+            with Transaction().set_context(report_job=job.id,
+                                           language=job.language):
+                result_type, content, _, name = Report.execute(
+                    json.loads(job.record_ids), data)
+            values = {
+                'state': 'done',
+                'progress': 100,
+                'finished': datetime.now(),
+                'file_name': '%s.%s' % (name, result_type),
+                }
+            # None when the report attached the file itself
+            if content is not None:
+                values['file'] = content
+            with Transaction().set_user(0):
+                cls.write([job], values)
+            with _REPORT_JOB_LOCK:
+                _REPORT_JOB_PROGRESS.pop(job.id, None)
+
+    @classmethod
+    def attach(cls, job_id, fileobj):
+        '''
+        keeps the content of fileobj as the file of the job with job_id.
+        It is read and sent to the database REPORT_JOB_CHUNK bytes at a
+        time and put together there.
+        '''
+        cursor = Transaction().cursor
+        chunks = Table('report_job_chunks')
+        cursor.execute('CREATE TEMP TABLE "%s" (id SERIAL PRIMARY KEY, '
+                       'data BYTEA) ON COMMIT DROP' % chunks._name)
+        for data in iter(lambda: fileobj.read(REPORT_JOB_CHUNK), ''):
+            cursor.execute(*chunks.insert([chunks.data],
+                                          [[buffer(data)]]))
+        cursor.execute('UPDATE "%s" SET file = (SELECT COALESCE('
+                       'STRING_AGG(data, \'\' ORDER BY id), \'\') '
+                       'FROM "%s") WHERE id = %%s' % (
+                           cls._table, chunks._name), (job_id,))
+        cursor.execute('DROP TABLE "%s"' % chunks._name)
+
+    @classmethod
+    def run_jobs(cls):
+        '''
+        starts worker threads, up to report_job_workers for the database,
+        to run the queued jobs. The workers stop when the queue is empty.
+        Also fails the jobs that ran for more than report_job_timeout
+        minutes and deletes the jobs finished more than report_job_keep
+        days ago.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        timeout = config.getint('health_disease_notification',
+                                'report_job_timeout', default=120)
+        keep = config.getint('health_disease_notification',
+                             'report_job_keep', default=7)
+        now = datetime.now()
+        # their worker died with the server or is stuck
+        cursor.execute(*table.update(
+            [table.state, table.finished, table.error],
+            ['failed', now, cls.raise_user_error('stalled', (timeout, ),
+                                                 raise_exception=False)],
+            where=(table.state == 'running') &
+            (table.started < now - timedelta(minutes=timeout))))
+        cursor.execute(*table.delete(
+            where=table.state.in_(['done', 'failed', 'cancelled']) &
+            (table.finished < now - timedelta(keep))))
+        database = cursor.database_name
+        workers = config.getint('health_disease_notification',
+                                'report_job_workers', default=2)
+        with _REPORT_JOB_LOCK:
+            alive = [x for x in _REPORT_JOB_WORKERS.get(database, [])
+                     if x.is_alive()]
+            for _ in range(workers - len(alive)):
+                worker = threading.Thread(target=cls._work,
+                                          args=(database, ))
+                worker.daemon = True
+                worker.start()
+                alive.append(worker)
+            _REPORT_JOB_WORKERS[database] = alive
+
+    @classmethod
+    def _claim(cls):
+        '''
+        marks the oldest queued job of a user with less than
+        report_job_user_running jobs running as running, commits and
+        returns (id, user) or None. The claims of all the workers are
+        serialised by an advisory lock, taken in a transaction of its own
+        so that the running jobs are counted with the claims the other
+        workers committed meanwhile.
+        '''
+        cursor = Transaction().cursor
+        running = config.getint('health_disease_notification',
+                                'report_job_user_running', default=1)
+        lock = 'SELECT pg_advisory_%%s(\'"%s"\'::regclass::oid::int)' % (
+            cls._table)
+        cursor.execute(lock % 'lock')
+        cursor.commit()
+        try:
+            cursor.execute('SELECT id, "user" FROM "%(table)s" AS job '
+                           'WHERE state = \'queued\' AND (SELECT COUNT(*) '
+                           'FROM "%(table)s" WHERE state = \'running\' '
+                           'AND "user" = job."user") < %%s '
+                           'ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED' % {
+                               'table': cls._table}, (running, ))
+            row = cursor.fetchone()
+            if row:
+                table = cls.__table__()
+                cursor.execute(*table.update(
+                    [table.state, table.started, table.progress],
+                    ['running', datetime.now(), 0],
+                    where=table.id == row[0]))
+            cursor.commit()
+        except Exception:
+            cursor.rollback()
+            raise
+        finally:
+            cursor.execute(lock % 'unlock')
+            cursor.commit()
+        return row
+
+    @classmethod
+    def _work(cls, database):
+        '''runs queued jobs, in transactions of their own, until none
+        is left'''
+        while True:
+            with Transaction().start(database, 0):
+                claimed = cls._claim()
+            if not claimed:
+                return
+            job_id, user = claimed
+            try:
+                with Transaction().start(database, user) as transaction:
+                    cls.run([cls(job_id)])
+                    transaction.cursor.commit()
+            except Exception, exception:
+                logger.error('report job %s failed', job_id, exc_info=True)
+                error = getattr(exception, 'message', None) or repr(exception)
+                with Transaction().start(database, 0) as transaction:
+                    cls.write([cls(job_id)], {'state': 'failed',
+                                              'finished': datetime.now(),
+                                              'error': unicode(error)})
+                    transaction.cursor.commit()
+
+
+class Party:
+    __metaclass__ = PoolMeta
+    __name__ = 'party.party'
+
+    @classmethod
+    def write(cls, *args):
+        super(Party, cls).write(*args)
+        party_fields = set(PATIENT_PARTY_FIELDS.values())
+        actions = iter(args)
+        to_sync = []
+        for parties, values in zip(actions, actions):
+            if party_fields.intersection(values):
+                to_sync.extend(map(int, parties))
+            if 'dob' in values:
+                # the ages are kept by notification, not by party
+                clear_transaction_cache('gnuhealth.disease_notification.age')
+        if to_sync:
+            Notification = Pool().get('gnuhealth.disease_notification')
+            Notification.sync_patient_fields(parties=to_sync)
+
+
+class Pathology:
+    __metaclass__ = PoolMeta
+    __name__ = 'gnuhealth.pathology'
+
+    @classmethod
+    def write(cls, *args):
+        super(Pathology, cls).write(*args)
+        actions = iter(args)
+        for pathologies, values in zip(actions, actions):
+            if 'name' in values or 'code' in values:
+                # the cached reports show the diagnoses by name and code
+                ReportCache = Pool().get(
+                    'gnuhealth.disease_notification.report_cache')
+                ReportCache.clear()
+                break
+
+
+class Patient:
+    __metaclass__ = PoolMeta
+    __name__ = 'gnuhealth.patient'
+
+    @classmethod
+    def write(cls, *args):
+        super(Patient, cls).write(*args)
+        actions = iter(args)
+        to_sync = []
+        for patients, values in zip(actions, actions):
+            if 'name' in values:
+                to_sync.extend(map(int, patients))
+        if to_sync:
+            clear_transaction_cache('gnuhealth.disease_notification.age')
+            Notification = Pool().get('gnuhealth.disease_notification')
+            Notification.sync_patient_fields(patients=to_sync)
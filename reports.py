@@ -1,69 +1,113 @@
 
 
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+import mmap
+import tempfile
 import pytz
 from trytond.pyson import Eval, PYSONEncoder, Date
 from trytond.transaction import Transaction
 from trytond.pool import Pool
 from trytond.report import Report
-from itertools import groupby
+from itertools import groupby, count
 from trytond.model import ModelView, fields
 from trytond.wizard import (Wizard, StateView, StateTransition, Button,
                             StateAction)
 from collections import OrderedDict, Counter, defaultdict
+from sql import Join, Literal, Table
+from sql.aggregate import Count
+from sql.functions import Age, Extract
+from trytond.config import config
+from trytond.rpc import RPC
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.modules.health_jamaica import tryton_utils as utils
-from .models import NOTIFICATION_STATES
+from .models import NOTIFICATION_STATES, SEX_OPTIONS, PIVOT_DIMENSIONS
+from .symptoms import SYMPTOMS, SYMPTOM_CODES
+from .spreadsheet import WRITERS
+from .utils import cached_field_values, format_age, epi_week_calendar
 
 __all__ = ['RawDataReport', 'CaseCountReport', 'CaseCountStartModel',
-           'CaseCountWizard']
+           'CaseCountWizard', 'PivotStartModel', 'PivotWizard',
+           'PivotReport', 'ExportStartModel', 'ExportJobWizard']
+
+
+class SymptomRow(object):
+    '''
+    The symptoms of a notification in the raw data export: row[code] is
+    Yes for the symptoms of the catalogue, other the codes of the rest.
+    '''
+    __slots__ = ('codes', 'other')
+
+    def __init__(self, codes=(), other=u''):
+        self.codes = frozenset(codes)
+        self.other = other
+
+    def __getitem__(self, code):
+        return u'Yes' if code in self.codes else u''
+
+
+EMPTY_ROW = SymptomRow()
+# notifications fetched at a time by the streaming export
+EXPORT_CHUNK = 2000
+# the columns of the export that hold ids and the models they are names of
+EXPORT_LINKS = [
+    ('community', 'country.district_community'),
+    ('post_office', 'country.post_office'),
+    ('parish', 'country.subdivision'),
+    ('occupation', 'gnuhealth.occupation'),
+    ('facility', 'gnuhealth.institution'),
+    ('diagnosis', 'gnuhealth.pathology'),
+]
+_EXPORT_CURSORS = count()
+
+
+def symptom_matrix(ids):
+    '''
+    returns {notification id: SymptomRow} for the notifications with ids
+    that have symptoms, from one query per slice of ids
+    '''
+    pool = Pool()
+    Symptom = pool.get('gnuhealth.disease_notification.symptom')
+    Pathology = pool.get('gnuhealth.pathology')
+    symptom = Symptom.__table__()
+    pathology = Pathology.__table__()
+    cursor = Transaction().cursor
+    catalogue = set(SYMPTOM_CODES)
+    codes = defaultdict(set)
+    for sub_ids in grouped_slice(ids):
+        cursor.execute(*Join(symptom, pathology,
+                             condition=symptom.pathology == pathology.id
+                             ).select(symptom.name, pathology.code,
+                                      where=reduce_ids(symptom.name,
+                                                       sub_ids)))
+        for notification, code in cursor.fetchall():
+            codes[notification].add(code)
+    return dict([(x, SymptomRow(y.intersection(catalogue),
+                                u', '.join(sorted(y.difference(catalogue)))))
+                 for x, y in codes.iteritems()])
 
 
 class RawDataReport(Report):
     'Disease Notification Spreadsheet Export'
     __name__ = 'health_disease_notification.rawdata'
 
+    @classmethod
+    def symptom_list(cls):
+        '''returns [(code, heading)] of the symptom columns'''
+        Pathology = Pool().get('gnuhealth.pathology')
+        missing = [x for x, y in SYMPTOMS if not y]
+        names = {}
+        if missing:
+            names = dict([(x.code, x.name) for x in Pathology.search(
+                [('code', 'in', missing)])])
+        return [(x, y or names.get(x, x)) for x, y in SYMPTOMS]
+
     @classmethod
     def parse(cls, report, records, data, localcontext):
-        symptoms = [("R19.7", "Diarrhoea, unspecified"),
-                    ("R53.1", "Asthenia (generalized weakness)"),
-                    ("R29.5", "Joint pain or stiffness (arthralgia)"),
-                    ("R29.7", "Joint swelling "),
-                    ("R60.2", "Periarticular oedema"),
-                    ("R52.3", "Muscle pain"),
-                    ("R52.4", "Back pain"),
-                    ("R11.1", "Vomitting"),
-                    ("R50.9", "Fever, unspecified "),
-                    ("R05", "Cough"),
-                    ("R06.0", "Dyspnoea "),
-                    ("R06.2", "Wheezing"),
-                    ("R07.4", "Chest pain"),
-                    ("R60.0", "Swelling of feet"),
-                    ("R56.0", "Convulsions, not elsewhere classified"),
-                    ("R07.0", "Pain in throat (sore throat)"),
-                    ("R21", "Rash"),
-                    ("R68.6", "Non-purulent conjunctivitis "),
-                    ("R68.7", "Conjunctival hyperaemia"),
-                    ("R51", "Headache"),
-                    ("R53", "Malaise and fatigue"),
-                    ("R17", "Jaundice"),
-                    ("R29.1", "Meningeal irritation "),
-                    ("R40", "Altered consciousness/somnolence "),
-                    ("R40.1", "Stupor"),
-                    ("R26", "Paralysis"),
-                    ("R04.2", "Cough with Haemorrhage "),
-                    ("R58", "Haemorrhage"),
-                    ("R04.4", "Epistaxis")]
-        default_symptoms = defaultdict(lambda: u'')
-        ordered_symptoms = defaultdict(default_symptoms.copy)
-        other_symptoms = default_symptoms.copy()
-        symptom_set = set([x for x, _ in symptoms])
+        ordered_symptoms = symptom_matrix([x.id for x in records])
         for rec in records:
-            my_symptoms = set([x.pathology.code for x in rec.symptoms])
-            my_yeses = my_symptoms.intersection(symptom_set)
-            my_others = my_symptoms.difference(symptom_set)
-            ordered_symptoms[rec.id].update([(r, u'Yes') for r in my_yeses])
-            if my_others:
-                other_symptoms[rec.id] = u', '.join(sorted(my_others))
+            ordered_symptoms.setdefault(rec.id, EMPTY_ROW)
+        other_symptoms = dict([(x, y.other) for x, y in
+                               ordered_symptoms.iteritems()])
         # This value represents the number days from 0000-00-00 to 1900-01-02
         # xldate = 693594
         # xldate = lambda val: val.toordinal() - 693594 if val else None
@@ -71,13 +115,325 @@ class RawDataReport(Report):
         # 42449 is the xldate for March 20, 2016
         localcontext.update(
             ordered_symptoms=ordered_symptoms,
-            symptom_list=symptoms,
+            symptom_list=cls.symptom_list(),
             xldate=xldate,
             other_symptoms=other_symptoms)
 
         return super(RawDataReport, cls).parse(report, records, data,
                                                localcontext)
 
+    @classmethod
+    def execute(cls, ids, data):
+        '''
+        streams the export to a csv, xlsx or ods file, without the
+        template, when data has that format or when there are at least
+        export_stream_rows notifications. The file is handed back as is, or
+        kept on the report job that runs the export, without being read
+        into memory.
+        '''
+        export_format = data.get('format')
+        if not export_format and len(ids) >= config.getint(
+                'health_disease_notification', 'export_stream_rows',
+                default=5000):
+            export_format = config.get('health_disease_notification',
+                                       'export_format', default='ods')
+        if not export_format:
+            return super(RawDataReport, cls).execute(ids, data)
+        ActionReport = Pool().get('ir.action.report')
+        cls.check_access()
+        action_report, = ActionReport.search(
+            [('report_name', '=', cls.__name__)], limit=1)
+        ReportJob = Pool().get('gnuhealth.disease_notification.report_job')
+        job_id = Transaction().context.get('report_job')
+        output = tempfile.TemporaryFile()
+        try:
+            cls.export(ids, export_format, output)
+            output.flush()
+            if job_id:
+                output.seek(0)
+                ReportJob.attach(job_id, output)
+                content = None
+            else:
+                # the pages of the file, not a copy of them
+                content = buffer(mmap.mmap(output.fileno(), 0,
+                                           access=mmap.ACCESS_READ))
+        finally:
+            output.close()
+        return (export_format, content, action_report.direct_print,
+                action_report.name)
+
+    @classmethod
+    def export(cls, ids, export_format, fileobj):
+        '''
+        writes the export of the notifications with ids to fileobj in
+        export_format (see spreadsheet.WRITERS) and returns the number of
+        notifications written
+        '''
+        ReportJob = Pool().get('gnuhealth.disease_notification.report_job')
+        writer = WRITERS[export_format](fileobj, 'Raw Data')
+        for row in cls.export_rows(ids):
+            writer.writerow(row)
+            if writer.rows % EXPORT_CHUNK == 0:
+                ReportJob.report_progress(writer.rows, len(ids))
+        writer.close()
+        return writer.rows - 1
+
+    @classmethod
+    def export_heading(cls):
+        return ([u'Code', u'Tracking Code', u'UPI', u'Last name',
+                 u'First Name', u'Sex', u'Age', u'Date of Birth',
+                 u'Street/Lot Number', u'Street', u'District/ Community',
+                 u'Post Office', u'Parish', u'Occupational Group',
+                 u'Reporting Institution', u'Date Reported',
+                 u'Date of Onset', u'Epi Week Of Onset', u'Overseas Travel'] +
+                [u'%s [%s]' % (y, x) for x, y in cls.symptom_list()] +
+                [u'Other Symptoms', u'Risk Factors & Other Illnesses',
+                 u'Date Sample Taken', u'Sample Type', u'Hospitalised',
+                 u'Suspected Diagnosis', u'Status', u'Lab Test Type',
+                 u'Lab Result', u'Deceased', u'Comments'])
+
+    @classmethod
+    def _export_query(cls, ids_table):
+        '''
+        returns (column names, query) of the notifications with their ids
+        in ids_table
+        '''
+        pool = Pool()
+        Notification = pool.get('gnuhealth.disease_notification')
+        DU = pool.get('gnuhealth.du')
+        join, table, party = Notification._patient_join()
+        du = DU.__table__()
+        join = join.join(du, 'LEFT', condition=party.du == du.id)
+        join = join.join(ids_table, condition=table.id == ids_table.id)
+        age = Age(table.date_onset, party.dob)
+        columns = [
+            ('id', table.id),
+            ('code', table.name),
+            ('tracking_code', table.tracking_code),
+            ('puid', table.puid),
+            ('lastname', party.lastname),
+            ('firstname', party.name),
+            ('sex', table.sex),
+            ('years', Extract('YEAR', age)),
+            ('months', Extract('MONTH', age)),
+            ('days', Extract('DAY', age)),
+            ('dob', party.dob),
+            ('streetbis', du.streetbis),
+            ('street_num', du.address_street_num),
+            ('street', du.street),
+            ('community', du.district_community),
+            ('post_office', du.post_office),
+            ('parish', du.subdivision),
+            ('occupation', party.occupation),
+            ('facility', table.reporting_facility),
+            ('facility_other', table.reporting_facility_other),
+            ('date_notified', table.date_notified),
+            ('date_onset', table.date_onset),
+            ('epi_week', table.epi_week_onset),
+            ('travel', table.hx_travel),
+            ('hospitalized', table.hospitalized),
+            ('diagnosis', table.diagnosis),
+            ('status', table.status),
+            ('deceased', table.deceased),
+            ('comments', Notification._short_comment_column(table)),
+        ]
+        return [x for x, _ in columns], join.select(
+            *[y.as_(x) for x, y in columns],
+            order_by=[table.date_onset.desc, table.id.desc])
+
+    @classmethod
+    def export_rows(cls, ids, chunk=EXPORT_CHUNK):
+        '''
+        yields the heading and the rows of the export of the notifications
+        with ids. The notifications are fetched through a cursor declared in
+        the database, chunk at a time, and their symptoms, risk factors and
+        specimens are read for each chunk, so memory does not grow with the
+        number of notifications. The ids are joined from a temporary table
+        rather than spelled out in the query.
+        '''
+        cursor = Transaction().cursor
+        yield cls.export_heading()
+        # a new name each time, a cursor left open by an export that was
+        # not read to the end lives as long as the transaction
+        cursor_name = 'rawdata_export_%d' % _EXPORT_CURSORS.next()
+        ids_table = Table('%s_ids' % cursor_name)
+        cursor.execute('CREATE TEMP TABLE "%s" (id INTEGER PRIMARY KEY) '
+                       'ON COMMIT DROP' % ids_table._name)
+        for sub_ids in grouped_slice(sorted(set(ids))):
+            cursor.execute(*ids_table.insert(
+                [ids_table.id], [[x] for x in sub_ids]))
+        cursor.execute('ANALYZE "%s"' % ids_table._name)
+        names, query = cls._export_query(ids_table)
+        sql, params = tuple(query)
+        cursor.execute('DECLARE %s NO SCROLL CURSOR FOR %s' % (
+            cursor_name, sql), params)
+        while True:
+            cursor.execute('FETCH FORWARD %s FROM %s' % (chunk, cursor_name))
+            records = [dict(zip(names, x)) for x in cursor.fetchall()]
+            if not records:
+                break
+            for row in cls._export_chunk(records):
+                yield row
+        cursor.execute('CLOSE %s' % cursor_name)
+        cursor.execute('DROP TABLE "%s"' % ids_table._name)
+
+    @classmethod
+    def _export_chunk(cls, records):
+        pool = Pool()
+        Notification = pool.get('gnuhealth.disease_notification')
+        Specimen = pool.get('gnuhealth.disease_notification.specimen')
+        ids = [x['id'] for x in records]
+        symptoms = symptom_matrix(ids)
+        risk_factors = cls._risk_factor_codes(ids)
+        specimens = cls._first_specimens(ids)
+        names = dict([(x, cached_field_values(y, [r[x] for r in records]))
+                      for x, y in EXPORT_LINKS])
+        sexes = dict(SEX_OPTIONS)
+        states = Notification._selection_labels('status_display')
+        specimen_labels = [None] + [
+            Specimen._selection_labels(x) for x in (
+                'specimen_type_display', 'lab_test_type_display',
+                'lab_result_state_display')]
+        yes_no = lambda val: u'Yes' if val else u'No'
+        for rec in records:
+            row = symptoms.get(rec['id'], EMPTY_ROW)
+            specimen = [
+                x if labels is None else labels.get(x, u'')
+                for labels, x in zip(specimen_labels,
+                                     specimens.get(rec['id'], [None] * 4))]
+            street = (u'#%s, ' % rec['streetbis'] if rec['streetbis']
+                      else u'') + (rec['street_num'] or u'')
+            yield ([rec['code'], rec['tracking_code'], rec['puid'],
+                    rec['lastname'], rec['firstname'],
+                    sexes.get(rec['sex'], u''),
+                    format_age(rec['years'], rec['months'], rec['days']),
+                    rec['dob'], street, rec['street'],
+                    names['community'][rec['community']],
+                    names['post_office'][rec['post_office']],
+                    names['parish'][rec['parish']],
+                    names['occupation'][rec['occupation']],
+                    names['facility'][rec['facility']] or
+                    rec['facility_other'],
+                    rec['date_notified'], rec['date_onset'],
+                    rec['epi_week'], yes_no(rec['travel'])] +
+                   [row[x] for x in SYMPTOM_CODES] +
+                   [row.other, u', '.join(risk_factors.get(rec['id'], [])),
+                    specimen[0], specimen[1], yes_no(rec['hospitalized']),
+                    names['diagnosis'][rec['diagnosis']] or u'',
+                    states.get(rec['status'], u''), specimen[2], specimen[3],
+                    yes_no(rec['deceased']), rec['comments']])
+
+    @staticmethod
+    def _risk_factor_codes(ids):
+        '''returns {notification id: [codes of its risk factors]}'''
+        pool = Pool()
+        RiskFactor = pool.get('gnuhealth.disease_notification.risk_disease')
+        Pathology = pool.get('gnuhealth.pathology')
+        risk_factor = RiskFactor.__table__()
+        pathology = Pathology.__table__()
+        cursor = Transaction().cursor
+        cursor.execute(*risk_factor.join(
+            pathology, condition=risk_factor.pathology == pathology.id
+            ).select(risk_factor.notification, pathology.code,
+                     where=reduce_ids(risk_factor.notification, ids),
+                     order_by=[risk_factor.notification, risk_factor.id]))
+        return dict([(x, [y[1] for y in group]) for x, group in
+                     groupby(cursor.fetchall(), lambda x: x[0])])
+
+    @staticmethod
+    def _first_specimens(ids):
+        '''
+        returns {notification id: (date taken, type, test type, result
+        state)} of the first specimen of each notification
+        '''
+        Specimen = Pool().get('gnuhealth.disease_notification.specimen')
+        specimen = Specimen.__table__()
+        cursor = Transaction().cursor
+        cursor.execute(*specimen.select(
+            specimen.notification, specimen.date_taken,
+            specimen.specimen_type, specimen.lab_test_type,
+            specimen.lab_result_state,
+            where=reduce_ids(specimen.notification, ids),
+            order_by=[specimen.notification, specimen.id]))
+        result = {}
+        for values in cursor.fetchall():
+            result.setdefault(values[0], values[1:])
+        return result
+
+
+class ExportStartModel(ModelView):
+    '''Spreadsheet export format'''
+    __name__ = 'gnuhealth.disease_notification.report.export_start'
+
+    output_format = fields.Selection([('ods', 'OpenDocument (ods)'),
+                                      ('xlsx', 'Excel (xlsx)'),
+                                      ('csv', 'CSV')], 'Format',
+                                     required=True, sort=False)
+
+    @staticmethod
+    def default_output_format():
+        return config.get('health_disease_notification', 'export_format',
+                          default='ods')
+
+
+class ExportJobWizard(Wizard):
+    '''queues the spreadsheet export of the selected notifications'''
+    __name__ = 'health_disease_notification.export_job_wizard'
+    start = StateView(
+        'gnuhealth.disease_notification.report.export_start',
+        'health_disease_notification.view_form-export_start',
+        [Button('Cancel', 'end', 'tryton-cancel'),
+         Button('Run in background', 'queue', 'tryton-ok', default=True)])
+    queue = StateAction('health_disease_notification.actwin-report_job')
+
+    def do_queue(self, action):
+        ReportJob = Pool().get('gnuhealth.disease_notification.report_job')
+        ReportJob.enqueue('health_disease_notification.rawdata',
+                          Transaction().context.get('active_ids', []),
+                          {'format': self.start.output_format})
+        return action, {}
+
+
+class CachedReportMixin(object):
+    '''
+    Keeps the results of the report in the report cache, see
+    gnuhealth.disease_notification.report_cache, and returns them to later
+    runs with the same parameters until a notification they cover changes.
+    Reports implement cache_params.
+    '''
+
+    @classmethod
+    def __setup__(cls):
+        super(CachedReportMixin, cls).__setup__()
+        # the runs that miss the cache fill it
+        cls.__rpc__['execute'] = RPC(readonly=False)
+
+    @classmethod
+    def cache_params(cls, ids, data):
+        '''
+        returns (params, start date, end date) of a run: the parameters
+        the result depends on, as a dict, and the window of the dates
+        reported of the notifications it reads. None is not cached.
+        '''
+        return None
+
+    @classmethod
+    def execute(cls, ids, data):
+        ReportCache = Pool().get('gnuhealth.disease_notification.report_cache')
+        cache_params = cls.cache_params(ids, data)
+        if cache_params is None:
+            return super(CachedReportMixin, cls).execute(ids, data)
+        params, start_date, end_date = cache_params
+        cls.check_access()
+        key = ReportCache.make_key(cls.__name__, params)
+        result = ReportCache.get(cls.__name__, key)
+        if result is None:
+            snapshot = ReportCache.current_snapshot()
+            result = super(CachedReportMixin, cls).execute(ids, data)
+            ReportCache.put(cls.__name__, key, start_date, end_date, result,
+                            snapshot)
+        return result
+
 
 class CaseCountStartModel(ModelView):
     '''Notification date range (of onset)'''
@@ -104,15 +460,26 @@ class CaseCountWizard(Wizard):
         'gnuhealth.disease_notification.report.case_count_start',
         'health_disease_notification.view_form-case_count_start',
         [Button('Cancel', 'end', 'tryton-cancel'),
+         Button('Run in background', 'queue', 'tryton-go-next'),
          Button('Generate report', 'generate_report', 'tryton-ok',
                 default=True)])
     generate_report = StateAction(
         'health_disease_notification.reptnotif_case_count')
+    queue = StateAction('health_disease_notification.actwin-report_job')
 
     def transition_generate_report(self):
         return 'end'
 
     def do_generate_report(self, action):
+        return action, self._report_data()
+
+    def do_queue(self, action):
+        ReportJob = Pool().get('gnuhealth.disease_notification.report_job')
+        ReportJob.enqueue('health_disease_notification.case_count', [],
+                          self._report_data())
+        return action, {}
+
+    def _report_data(self):
         data = {'start_date': self.start.on_or_after,
                 'end_date': self.start.on_or_after,
                 'state': self.start.state}
@@ -126,31 +493,59 @@ class CaseCountWizard(Wizard):
         #     self.start.raise_user_error('required_institution')
         #     return 'start'
 
-        return action, data
+        return data
 
 
-class CaseCountReport(Report):
+class CaseCountReport(CachedReportMixin, Report):
     '''
     Case Count Report (by Epi Week)
     '''
     __name__ = 'health_disease_notification.case_count'
 
     @classmethod
-    def parse(cls, report, records, data, localcontext):
-        pool = Pool()
+    def _window(cls, data):
+        '''
+        returns the epi weeks of the report and the start and end of the
+        window of dates reported it counts
+        '''
         tz = utils.get_timezone()
-        start_week = utils.get_epi_week(data['start_date'])
-        start_date = utils.get_start_of_day(start_week[0], tz)
-        end_week = utils.get_epi_week(data['end_date'])
-        end_date = utils.get_start_of_next_day(end_week[1], tz)
-        all_weeks = [utils.epiweek_str(start_week)]
-        if start_week[2:] != end_week[2:]:
-            adder = 1
-            while (start_date + timedelta(7 * adder)) < end_date:
-                all_weeks.append(
-                    utils.epiweek_str(start_date + timedelta(7 * adder)))
-                adder += 1
-            all_weeks.append(utils.epiweek_str(end_week))
+        calendar = epi_week_calendar(data['start_date'], data['end_date'])
+        start_date = utils.get_start_of_day(calendar[0][0], tz)
+        end_date = utils.get_start_of_next_day(calendar[-1][0] +
+                                               timedelta(6), tz)
+        return calendar, start_date, end_date
+
+    @classmethod
+    def cache_params(cls, ids, data):
+        calendar, start_date, end_date = cls._window(data)
+        return ({'start_week': calendar[0][1], 'end_week': calendar[-1][1],
+                 'state': data.get('state') or None}, start_date, end_date)
+
+    @classmethod
+    def count_cases(cls, start_date, end_date, status=None):
+        '''
+        returns [(diagnosis, epi week of onset, cases)] of the active
+        notifications reported from start_date to before end_date, with
+        status if given, counted by the database
+        '''
+        Notification = Pool().get('gnuhealth.disease_notification')
+        table = Notification.__table__()
+        cursor = Transaction().cursor
+        where = ((table.date_notified >= start_date) &
+                 (table.date_notified < end_date) &
+                 (table.active == True))
+        if status:
+            where &= table.status == status
+        cursor.execute(*table.select(
+            table.diagnosis, table.epi_week_onset, Count(Literal(1)),
+            where=where,
+            group_by=[table.diagnosis, table.epi_week_onset]))
+        return cursor.fetchall()
+
+    @classmethod
+    def parse(cls, report, records, data, localcontext):
+        calendar, start_date, end_date = cls._window(data)
+        all_weeks = [x for _, x in calendar]
 
         empty_weeks = dict(zip(all_weeks, [0] * len(all_weeks)))
         status_dict = dict(NOTIFICATION_STATES)
@@ -161,23 +556,14 @@ class CaseCountReport(Report):
             query_status = False
             selected_status = 'All'
 
-        search_domain = [('date_notified', '>=', start_date),
-                         ('date_notified', '<', end_date)]
-        if query_status:
-            search_domain.append(('status', '=', query_status))
-        notifi_model = pool.get('gnuhealth.disease_notification')
-        notification_ids = notifi_model.search(
-            search_domain, order=[('diagnosis', 'ASC'), ('date_onset', 'ASC')])
-        notifications = notifi_model.read(
-            notification_ids,
-            fields_names=['diagnosis.name', 'date_onset', 'name',
-                          'epi_week_onset', 'diagnosis'])
+        cells = cls.count_cases(start_date, end_date, query_status)
+        diseases = cached_field_values('gnuhealth.pathology',
+                                       [x for x, _, _ in cells], 'name')
         counts = {}
         epi_weeks = Counter(empty_weeks.copy())
-        for pathology, pnotif in groupby(notifications,
-                                         lambda x: x['diagnosis.name']):
-            counts.setdefault(pathology, Counter(empty_weeks.copy())).update(
-                Counter([x['epi_week_onset'] for x in pnotif]))
+        for diagnosis, epi_week, cases in cells:
+            counts.setdefault(diseases[diagnosis],
+                              Counter(empty_weeks.copy()))[epi_week] += cases
         count_out = []
         for p, c in counts.items():
             epi_weeks.update(c)
@@ -194,6 +580,195 @@ class CaseCountReport(Report):
         return super(CaseCountReport, cls).parse(report, records, data,
                                                  localcontext)
 
+class PivotStartModel(ModelView):
+    '''Notification counts by'''
+    __name__ = 'gnuhealth.disease_notification.report.pivot_start'
+
+    on_or_after = fields.Date('Onset from', required=True)
+    on_or_before = fields.Date('Onset to', required=True)
+    row_dimension = fields.Selection(PIVOT_DIMENSIONS, 'Rows', required=True,
+                                     sort=False)
+    subrow_dimension = fields.Selection([(None, '')] + PIVOT_DIMENSIONS,
+                                        'Then rows by', sort=False)
+    column_dimension = fields.Selection([(None, '')] + PIVOT_DIMENSIONS,
+                                        'Columns', sort=False)
+    state = fields.Selection(NOTIFICATION_STATES[:-1], 'State',
+                             sort=False)
+    subtotals = fields.Boolean('Subtotals')
+    output_format = fields.Selection([('ods', 'OpenDocument (ods)'),
+                                      ('xlsx', 'Excel (xlsx)'),
+                                      ('csv', 'CSV')], 'Format',
+                                     required=True, sort=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(PivotStartModel, cls).__setup__()
+        cls.state.selection[0] = (None, 'All States')
+        cls._error_messages.update({
+            'same_dimension': 'Count by "%s" only once',
+        })
+
+    @staticmethod
+    def default_on_or_after():
+        return date.today() - timedelta(7 * 12)
+
+    @staticmethod
+    def default_on_or_before():
+        return date.today()
+
+    @staticmethod
+    def default_row_dimension():
+        return 'diagnosis'
+
+    @staticmethod
+    def default_column_dimension():
+        return 'week'
+
+    @staticmethod
+    def default_output_format():
+        return 'ods'
+
+
+class PivotWizard(Wizard):
+    __name__ = 'health_disease_notification.pivot_wizard'
+    start = StateView(
+        'gnuhealth.disease_notification.report.pivot_start',
+        'health_disease_notification.view_form-pivot_start',
+        [Button('Cancel', 'end', 'tryton-cancel'),
+         Button('Run in background', 'queue', 'tryton-go-next'),
+         Button('Generate report', 'generate_report', 'tryton-ok',
+                default=True)])
+    generate_report = StateAction(
+        'health_disease_notification.reptnotif_pivot')
+    queue = StateAction('health_disease_notification.actwin-report_job')
+
+    def transition_generate_report(self):
+        return 'end'
+
+    def do_generate_report(self, action):
+        return action, self._report_data()
+
+    def do_queue(self, action):
+        ReportJob = Pool().get('gnuhealth.disease_notification.report_job')
+        ReportJob.enqueue('health_disease_notification.pivot', [],
+                          self._report_data())
+        return action, {}
+
+    def _report_data(self):
+        rows = [x for x in (self.start.row_dimension,
+                            self.start.subrow_dimension) if x]
+        dimensions = rows + [x for x in [self.start.column_dimension] if x]
+        for name in dimensions:
+            if dimensions.count(name) > 1:
+                self.start.raise_user_error(
+                    'same_dimension', (dict(PIVOT_DIMENSIONS)[name], ))
+        data = {'start_date': self.start.on_or_after,
+                'end_date': self.start.on_or_before,
+                'rows': rows,
+                'column': self.start.column_dimension,
+                'state': self.start.state,
+                'subtotals': self.start.subtotals,
+                'format': self.start.output_format}
+        return data
+
+
+class PivotReport(Report):
+    '''
+    Notification counts by any of PIVOT_DIMENSIONS, as a table written with
+    the spreadsheet writers
+    '''
+    __name__ = 'health_disease_notification.pivot'
+
+    @classmethod
+    def execute(cls, ids, data):
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        Notification = pool.get('gnuhealth.disease_notification')
+        cls.check_access()
+        action_report, = ActionReport.search(
+            [('report_name', '=', cls.__name__)], limit=1)
+        column = data.get('column')
+        # the column first so that rolling up the rows gives its totals
+        dimensions = [x for x in [column] if x] + data['rows']
+        result = Notification.pivot(
+            dimensions, data['start_date'], data['end_date'],
+            statuses=[data['state']] if data.get('state') else None,
+            rollup=data.get('subtotals', False))
+        output = tempfile.TemporaryFile()
+        try:
+            writer = WRITERS[data['format']](output, 'Counts')
+            for row in cls.crosstab(result, data['rows'], column):
+                writer.writerow(row)
+            writer.close()
+            output.seek(0)
+            content = output.read()
+        finally:
+            output.close()
+        return (data['format'], buffer(content), action_report.direct_print,
+                action_report.name)
+
+    @staticmethod
+    def _sort_value(name, value, labels):
+        if value is None:
+            return (1, None)
+        if name in ('age_band', 'week', 'month', 'year'):
+            return (0, value)
+        return (0, labels.get(value, value))
+
+    @classmethod
+    def crosstab(cls, result, rows, column=None):
+        '''
+        yields the heading and the rows of a table of result, as returned
+        by DiseaseNotification.pivot, with a row for each group of the rows
+        dimensions and a column for each value of column. Subtotals, when
+        result has them, follow their group and the totals come last.
+        '''
+        dimensions = result['dimensions']
+        columns = result['columns']
+        labels = dict([(x, dict(y)) for x, y in
+                       result['labels'].iteritems()])
+        rolled_up = columns.get('rollup', [0] * len(columns['cases']))
+        bits = dict([(x, 1 << (len(dimensions) - 1 - i))
+                     for i, x in enumerate(dimensions)])
+        cells = {}
+        column_values = set()
+        for index, cases in enumerate(columns['cases']):
+            if column and rolled_up[index] & bits[column]:
+                continue
+            key = tuple([(bool(rolled_up[index] & bits[x]),
+                          columns[x][index]) for x in rows])
+            value = columns[column][index] if column else None
+            column_values.add(value)
+            cells.setdefault(key, {})[value] = cases
+        column_values = sorted(column_values, key=lambda x: cls._sort_value(
+            column, x, labels.get(column, {})))
+
+        def label(name, value):
+            if value is None:
+                return u'Not given'
+            return labels[name].get(value, value)
+
+        dimension_names = dict(PIVOT_DIMENSIONS)
+        if column:
+            yield ([dimension_names[x] for x in rows] +
+                   [label(column, x) for x in column_values] + [u'Total'])
+        else:
+            yield [dimension_names[x] for x in rows] + [u'Cases']
+        for key in sorted(cells, key=lambda k: [
+                (x[0], cls._sort_value(name, x[1], labels[name]))
+                for name, x in zip(rows, k)]):
+            heading = []
+            for name, (rolled, value) in zip(rows, key):
+                if not rolled:
+                    heading.append(label(name, value))
+                elif u'Total' in heading:
+                    heading.append(u'')
+                else:
+                    heading.append(u'Total')
+            counts = [cells[key].get(x, 0) for x in column_values]
+            yield heading + counts + ([sum(counts)] if column else [])
+
+
 class Notifications(Report):
     """Definition of class for custom report"""
     __name__ = 'gnuhealth.disease_notifications.report'
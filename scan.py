@@ -0,0 +1,168 @@
+'''
+Space-time permutation scan statistic (Kulldorff et al. 2005).
+
+The cases are given as two arrays of the same length, the location (an
+index into the locations) and the week (0 for the first week of the study
+period) of each case. Zones are sets of locations, e.g. a community or all
+the communities of a post office. A cylinder is a zone over a window of
+consecutive weeks; prospective scans only look at the windows that end with
+the last week.
+
+The expected count of a cylinder comes from the margins: cases in its zone
+times cases in its weeks over all cases. Its significance comes from Monte
+Carlo replications that shuffle the weeks between the cases, which keeps
+both margins, run in a pool of processes. Each replication has its own
+seed so the results do not depend on the number of processes.
+'''
+import multiprocessing
+
+import numpy as np
+
+_WORKER = {}
+
+
+def zone_matrix(zones, locations):
+    '''returns the 0/1 matrix of zones (lists of location indexes)'''
+    matrix = np.zeros((len(zones), locations))
+    for row, members in enumerate(zones):
+        matrix[row, list(members)] = 1
+    return matrix
+
+
+def count_table(location, week, locations, weeks):
+    '''returns the counts of the cases by location and week'''
+    return np.bincount(location * weeks + week,
+                       minlength=locations * weeks).reshape(
+                           (locations, weeks)).astype(float)
+
+
+def _windows(table, max_length, prospective):
+    '''
+    returns the sums of table over the windows of 1 to max_length weeks,
+    as a list (one per length) of arrays with a column per last week
+    '''
+    weeks = table.shape[1]
+    totals = np.hstack([np.zeros((table.shape[0], 1)),
+                        np.cumsum(table, axis=1)])
+    windows = []
+    for length in range(1, min(max_length, weeks) + 1):
+        if prospective:
+            windows.append(totals[:, weeks:] - totals[:, weeks - length:
+                                                       weeks - length + 1])
+        else:
+            windows.append(totals[:, length:] - totals[:, :-length])
+    return windows
+
+
+def log_likelihood_ratio(cases, expected, total):
+    '''
+    returns the poisson log likelihood ratio of each cylinder with cases
+    observed out of expected, 0 where there are no more than expected
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inside = cases * np.log(cases / expected)
+        outside = np.where(total > cases, (total - cases) *
+                           np.log((total - cases) / (total - expected)), 0)
+        llr = inside + outside
+    return np.where(cases > expected, llr, 0)
+
+
+def _max_llr(zones, table, expected, total, max_length, prospective):
+    windows = _windows(zones.dot(table), max_length, prospective)
+    return max([log_likelihood_ratio(x, y, total).max()
+                for x, y in zip(windows, expected)])
+
+
+def _init_worker(state):
+    _WORKER.clear()
+    _WORKER.update(state)
+
+
+def _replicate(seeds):
+    '''returns the maximum llr of the replication of each of seeds'''
+    state = _WORKER
+    maxima = []
+    for seed in seeds:
+        random = np.random.RandomState(seed)
+        table = count_table(state['location'],
+                            random.permutation(state['week']),
+                            state['locations'], state['weeks'])
+        maxima.append(_max_llr(state['zones'], table, state['expected'],
+                               state['total'], state['max_length'],
+                               state['prospective']))
+    return maxima
+
+
+def scan(location, week, zones, locations, weeks, max_length=4,
+         prospective=False, replications=999, max_clusters=10,
+         processes=None, seed=None):
+    '''
+    runs the scan and returns its clusters, most likely first, as dicts
+    with the zone (index into zones), the first and last week, the cases,
+    the expected cases, the log likelihood ratio (llr) and the p-value.
+    Secondary clusters are the next most likely cylinders in zones that
+    share no location with a cluster before them.
+    processes is the size of the process pool (default one per CPU, 1 runs
+    the replications in this process).
+    '''
+    location = np.asarray(location, dtype=int)
+    week = np.asarray(week, dtype=int)
+    total = float(len(location))
+    if not total:
+        return []
+    zones_matrix = zone_matrix(zones, locations)
+    table = count_table(location, week, locations, weeks)
+    baseline = np.outer(table.sum(axis=1), table.sum(axis=0)) / total
+    expected = _windows(zones_matrix.dot(baseline), max_length, prospective)
+    observed = _windows(zones_matrix.dot(table), max_length, prospective)
+
+    # candidate cylinders, best first
+    candidates = []
+    for length, (cases, mean) in enumerate(zip(observed, expected), 1):
+        llr = log_likelihood_ratio(cases, mean, total)
+        for zone, column in zip(*np.nonzero(llr > 0)):
+            last = weeks - 1 if prospective else column + length - 1
+            candidates.append((llr[zone, column], zone, last - length + 1,
+                               last, cases[zone, column],
+                               mean[zone, column]))
+    candidates.sort(key=lambda x: -x[0])
+    clusters = []
+    used = set()
+    for llr, zone, first, last, cases, mean in candidates:
+        if len(clusters) >= max_clusters:
+            break
+        if used.intersection(zones[zone]):
+            continue
+        used.update(zones[zone])
+        clusters.append({'zone': int(zone), 'first_week': int(first),
+                         'last_week': int(last), 'cases': int(cases),
+                         'expected': float(mean), 'llr': float(llr)})
+    if not clusters or not replications:
+        return clusters
+
+    state = {'location': location, 'week': week, 'zones': zones_matrix,
+             'locations': locations, 'weeks': weeks, 'expected': expected,
+             'total': total, 'max_length': max_length,
+             'prospective': prospective}
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1,
+                                                size=replications)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes > 1:
+        # a few jobs per process evens out the load
+        size = max(1, replications // (processes * 4))
+        jobs = [seeds[x:x + size] for x in range(0, replications, size)]
+        pool = multiprocessing.Pool(processes, _init_worker, (state,))
+        try:
+            maxima = sum(pool.map(_replicate, jobs), [])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(state)
+        maxima = _replicate(seeds)
+    maxima = np.array(maxima)
+    for cluster in clusters:
+        cluster['p_value'] = float((maxima >= cluster['llr']).sum() + 1) / (
+            replications + 1)
+    return clusters
@@ -42,7 +42,8 @@ for key in ('depends', 'extras_depend', 'xml'):
 requires = [
     'trytond' + tryton_version,
     'proteus' + tryton_version,
-    'trytond_health_jamaica' + jmversion
+    'trytond_health_jamaica' + jmversion,
+    'numpy'
 ]
 
 setup(
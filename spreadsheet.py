@@ -0,0 +1,309 @@
+'''
+Spreadsheet writers that stream rows to a file.
+
+Each writer takes a file object opened for writing in binary mode and is
+given the rows one at a time with writerow, so that only the current row is
+held in memory. The XLSX and ODS writers put the sheet in a temporary file
+and zip it, in chunks, into the file object on close. Cells may be unicode
+or byte strings, numbers, dates, datetimes or None.
+'''
+import os
+import re
+import csv
+import codecs
+import zipfile
+import tempfile
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+
+# characters that are not allowed in XML 1.0
+_INVALID_XML = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_EXCEL_EPOCH = datetime(1899, 12, 30)
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return '%d' % value
+
+
+def _text(value):
+    if not isinstance(value, unicode):
+        value = str(value).decode('utf-8')
+    return escape(_INVALID_XML.sub(u'', value)).encode('utf-8')
+
+
+class SpreadsheetWriter(object):
+    extension = None
+    mimetype = None
+
+    def __init__(self, fileobj, sheet_name='Sheet1'):
+        self.fileobj = fileobj
+        self.sheet_name = sheet_name
+        self.rows = 0
+
+    def writerow(self, values):
+        self.rows += 1
+        self._writerow(values)
+
+    def _writerow(self, values):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvWriter(SpreadsheetWriter):
+    extension = 'csv'
+    mimetype = 'text/csv'
+
+    def __init__(self, fileobj, sheet_name='Sheet1'):
+        super(CsvWriter, self).__init__(fileobj, sheet_name)
+        # the byte order mark tells Excel the file is UTF-8
+        fileobj.write(codecs.BOM_UTF8)
+        self.writer = csv.writer(fileobj)
+
+    @staticmethod
+    def _cell(value):
+        if value is None:
+            return ''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(value, date):
+            return value.isoformat()
+        return str(value)
+
+    def _writerow(self, values):
+        self.writer.writerow([self._cell(x) for x in values])
+
+
+class _ZippedWriter(SpreadsheetWriter):
+    '''writes the sheet to a temporary file that is zipped on close'''
+    sheet_path = None
+
+    def __init__(self, fileobj, sheet_name='Sheet1'):
+        super(_ZippedWriter, self).__init__(fileobj, sheet_name)
+        handle, self.sheet_file = tempfile.mkstemp(suffix='.xml')
+        self.sheet = os.fdopen(handle, 'wb')
+        self.sheet.write(self.sheet_head())
+
+    def sheet_head(self):
+        raise NotImplementedError
+
+    def sheet_tail(self):
+        raise NotImplementedError
+
+    def parts(self):
+        '''returns [(path, content)] of the other files of the package'''
+        raise NotImplementedError
+
+    def close(self):
+        if self.sheet is None:
+            return
+        try:
+            self.sheet.write(self.sheet_tail())
+            self.sheet.close()
+            package = zipfile.ZipFile(self.fileobj, 'w', zipfile.ZIP_DEFLATED,
+                                      allowZip64=True)
+            for path, content in self.parts():
+                if path == 'mimetype':
+                    package.writestr(zipfile.ZipInfo(path), content)
+                else:
+                    package.writestr(path, content, zipfile.ZIP_DEFLATED)
+            package.write(self.sheet_file, self.sheet_path)
+            package.close()
+        finally:
+            self.sheet = None
+            os.remove(self.sheet_file)
+
+
+class XlsxWriter(_ZippedWriter):
+    extension = 'xlsx'
+    mimetype = ('application/vnd.openxmlformats-officedocument.'
+                'spreadsheetml.sheet')
+    sheet_path = 'xl/worksheets/sheet1.xml'
+    # cell styles, see styles.xml
+    DATE_STYLE = 1
+    DATETIME_STYLE = 2
+
+    def sheet_head(self):
+        return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/'
+                'spreadsheetml/2006/main"><sheetData>')
+
+    def sheet_tail(self):
+        return '</sheetData></worksheet>'
+
+    def _cell(self, value):
+        if value is None or value == '':
+            return '<c/>'
+        if isinstance(value, bool):
+            return '<c t="b"><v>%d</v></c>' % value
+        if isinstance(value, (int, long, float)):
+            return '<c><v>%s</v></c>' % _number(value)
+        if isinstance(value, datetime):
+            delta = value - _EXCEL_EPOCH
+            return '<c s="%d"><v>%r</v></c>' % (
+                self.DATETIME_STYLE,
+                delta.days + delta.seconds / 86400.0)
+        if isinstance(value, date):
+            return '<c s="%d"><v>%d</v></c>' % (
+                self.DATE_STYLE,
+                value.toordinal() - _EXCEL_EPOCH.toordinal())
+        return '<c t="inlineStr"><is><t xml:space="preserve">%s</t></is>' \
+            '</c>' % _text(value)
+
+    def _writerow(self, values):
+        self.sheet.write('<row>%s</row>' % ''.join(
+            [self._cell(x) for x in values]))
+
+    def parts(self):
+        ns = 'http://schemas.openxmlformats.org/'
+        return [
+            ('[Content_Types].xml',
+             '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+             '<Types xmlns="%(ns)spackage/2006/content-types">'
+             '<Default Extension="rels" ContentType="application/'
+             'vnd.openxmlformats-package.relationships+xml"/>'
+             '<Default Extension="xml" ContentType="application/xml"/>'
+             '<Override PartName="/xl/workbook.xml" ContentType="application/'
+             'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"'
+             '/><Override PartName="/xl/worksheets/sheet1.xml" ContentType='
+             '"application/vnd.openxmlformats-officedocument.spreadsheetml.'
+             'worksheet+xml"/><Override PartName="/xl/styles.xml" '
+             'ContentType="application/vnd.openxmlformats-officedocument.'
+             'spreadsheetml.styles+xml"/></Types>' % {'ns': ns}),
+            ('_rels/.rels',
+             '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+             '<Relationships xmlns="%(ns)spackage/2006/relationships">'
+             '<Relationship Id="rId1" Type="%(ns)sofficeDocument/2006/'
+             'relationships/officeDocument" Target="xl/workbook.xml"/>'
+             '</Relationships>' % {'ns': ns}),
+            ('xl/workbook.xml',
+             '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+             '<workbook xmlns="%(ns)sspreadsheetml/2006/main" xmlns:r='
+             '"%(ns)sofficeDocument/2006/relationships"><sheets>'
+             '<sheet name="%(name)s" sheetId="1" r:id="rId1"/></sheets>'
+             '</workbook>' % {'ns': ns, 'name': _text(self.sheet_name)}),
+            ('xl/_rels/workbook.xml.rels',
+             '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+             '<Relationships xmlns="%(ns)spackage/2006/relationships">'
+             '<Relationship Id="rId1" Type="%(ns)sofficeDocument/2006/'
+             'relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+             '<Relationship Id="rId2" Type="%(ns)sofficeDocument/2006/'
+             'relationships/styles" Target="styles.xml"/>'
+             '</Relationships>' % {'ns': ns}),
+            # built in number formats 14 (date) and 22 (date and time)
+            ('xl/styles.xml',
+             '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+             '<styleSheet xmlns="%(ns)sspreadsheetml/2006/main">'
+             '<fonts count="1"><font><sz val="11"/><name val="Calibri"/>'
+             '</font></fonts><fills count="2"><fill><patternFill '
+             'patternType="none"/></fill><fill><patternFill '
+             'patternType="gray125"/></fill></fills>'
+             '<borders count="1"><border><left/><right/><top/><bottom/>'
+             '<diagonal/></border></borders>'
+             '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" '
+             'fillId="0" borderId="0"/></cellStyleXfs><cellXfs count="3">'
+             '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+             '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" '
+             'applyNumberFormat="1"/>'
+             '<xf numFmtId="22" fontId="0" fillId="0" borderId="0" xfId="0" '
+             'applyNumberFormat="1"/></cellXfs><cellStyles count="1">'
+             '<cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+             '</styleSheet>' % {'ns': ns}),
+        ]
+
+
+class OdsWriter(_ZippedWriter):
+    extension = 'ods'
+    mimetype = 'application/vnd.oasis.opendocument.spreadsheet'
+    sheet_path = 'content.xml'
+
+    def sheet_head(self):
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<office:document-content '
+            'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+            'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" '
+            'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+            'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+            'xmlns:number="urn:oasis:names:tc:opendocument:xmlns:'
+            'datastyle:1.0" office:version="1.2">'
+            '<office:automatic-styles>'
+            '<number:date-style style:name="N1"><number:year/>'
+            '<number:text>-</number:text><number:month number:style="long"/>'
+            '<number:text>-</number:text><number:day number:style="long"/>'
+            '</number:date-style>'
+            '<number:date-style style:name="N2"><number:year/>'
+            '<number:text>-</number:text><number:month number:style="long"/>'
+            '<number:text>-</number:text><number:day number:style="long"/>'
+            '<number:text> </number:text><number:hours number:style="long"/>'
+            '<number:text>:</number:text>'
+            '<number:minutes number:style="long"/></number:date-style>'
+            '<style:style style:name="date" style:family="table-cell" '
+            'style:data-style-name="N1"/>'
+            '<style:style style:name="datetime" style:family="table-cell" '
+            'style:data-style-name="N2"/>'
+            '</office:automatic-styles><office:body><office:spreadsheet>'
+            '<table:table table:name="%s">' % _text(self.sheet_name))
+
+    def sheet_tail(self):
+        return ('</table:table></office:spreadsheet></office:body>'
+                '</office:document-content>')
+
+    @staticmethod
+    def _cell(value):
+        if value is None or value == '':
+            return '<table:table-cell/>'
+        if isinstance(value, bool):
+            return ('<table:table-cell office:value-type="boolean" '
+                    'office:boolean-value="%s"><text:p>%s</text:p>'
+                    '</table:table-cell>' % (str(value).lower(),
+                                             str(value).upper()))
+        if isinstance(value, (int, long, float)):
+            return ('<table:table-cell office:value-type="float" '
+                    'office:value="%s"><text:p>%s</text:p>'
+                    '</table:table-cell>' % ((_number(value),) * 2))
+        if isinstance(value, datetime):
+            return ('<table:table-cell table:style-name="datetime" '
+                    'office:value-type="date" office:date-value="%s">'
+                    '</table:table-cell>' % value.strftime(
+                        '%Y-%m-%dT%H:%M:%S'))
+        if isinstance(value, date):
+            return ('<table:table-cell table:style-name="date" '
+                    'office:value-type="date" office:date-value="%s">'
+                    '</table:table-cell>' % value.isoformat())
+        return ('<table:table-cell office:value-type="string"><text:p>%s'
+                '</text:p></table:table-cell>' % _text(value))
+
+    def _writerow(self, values):
+        self.sheet.write('<table:table-row>%s</table:table-row>' % ''.join(
+            [self._cell(x) for x in values]))
+
+    def parts(self):
+        return [
+            # first and stored, see the OpenDocument packaging spec
+            ('mimetype', self.mimetype),
+            ('META-INF/manifest.xml',
+             '<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:'
+             'opendocument:xmlns:manifest:1.0" manifest:version="1.2">'
+             '<manifest:file-entry manifest:full-path="/" manifest:version='
+             '"1.2" manifest:media-type="%s"/>'
+             '<manifest:file-entry manifest:full-path="content.xml" '
+             'manifest:media-type="text/xml"/>'
+             '</manifest:manifest>' % self.mimetype),
+        ]
+
+
+WRITERS = dict([(x.extension, x) for x in (CsvWriter, XlsxWriter,
+                                           OdsWriter)])
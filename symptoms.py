@@ -0,0 +1,42 @@
+'''
+The catalogue of signs and symptoms that get a column of their own in the
+raw data export. Other symptoms are listed together by code. The codes are
+those of the case report forms, whose columns tools/arbo_import.py maps
+itself.
+'''
+
+# (pathology code, column heading) in column order. A heading of None is
+# taken from the name of the pathology.
+SYMPTOMS = [
+    ('R19.7', 'Diarrhoea, unspecified'),
+    ('R53.1', 'Asthenia (generalized weakness)'),
+    ('R29.5', 'Joint pain or stiffness (arthralgia)'),
+    ('R29.7', 'Joint swelling'),
+    ('R60.2', 'Periarticular oedema'),
+    ('R52.3', 'Muscle pain'),
+    ('R52.4', 'Back pain'),
+    ('R11.1', 'Vomiting'),
+    ('R50.9', 'Fever, unspecified'),
+    ('R05', 'Cough'),
+    ('R06.0', 'Dyspnoea'),
+    ('R06.2', 'Wheezing'),
+    ('R07.4', 'Chest pain'),
+    ('R60.0', 'Swelling of feet'),
+    ('R56.0', 'Convulsions, not elsewhere classified'),
+    ('R07.0', 'Pain in throat (sore throat)'),
+    ('R21', 'Rash'),
+    ('R68.6', 'Non-purulent conjunctivitis'),
+    ('R68.7', 'Conjunctival hyperaemia'),
+    ('R51', 'Headache'),
+    ('R51.1', None),
+    ('R53', 'Malaise and fatigue'),
+    ('R17', 'Jaundice'),
+    ('R29.1', 'Meningeal irritation'),
+    ('R40', 'Altered consciousness/somnolence'),
+    ('R40.1', 'Stupor'),
+    ('R26', 'Paralysis'),
+    ('R04.2', 'Cough with Haemorrhage'),
+    ('R58', 'Haemorrhage'),
+    ('R04.0', 'Epistaxis'),
+]
+SYMPTOM_CODES = [x for x, _ in SYMPTOMS]
@@ -5,8 +5,9 @@ import os
 import sys
 import doctest
 import unittest
+import threading
 import coverage
-from datetime import (datetime, timedelta)
+from datetime import (datetime, date, timedelta)
 from trytond.tests.test_tryton import (test_view, test_depends, install_module,
                                        POOL, DB_NAME, USER,
                                        CONTEXT)
@@ -15,7 +16,7 @@ import trytond.tests.test_tryton
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError #, UserWarning
 # from trytond.pool import Pool
-from psycopg2 import ProgrammingError
+from psycopg2 import ProgrammingError, IntegrityError
 # from .test_utils import (create_party, create_health_professional,
 #                          create_user)
 from .database_config import set_up_datebase
@@ -169,6 +170,31 @@ class HealthDiseaseNotificationTestCase(unittest.TestCase):
             COV.save()
             COV.html_report()
 
+    def test_notification_age_follows_dob(self):
+        """Tests that the age is worked out again once the dob changes"""
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            party_patient = patient.name
+
+            notification, = self.notification.create([{'date_notified':datetime.now(),
+                                                       'date_onset':date(2010, 6, 1),
+                                                       'patient':patient.id,
+                                                       'status':'waiting',
+                                                       'healthprof':healthprof.id}])
+            self.party.write([party_patient], {'dob': date(2000, 6, 1)})
+            before = self.notification.get_patient_age([notification], 'age')
+            self.party.write([party_patient], {'dob': date(1990, 6, 1)})
+            after = self.notification.get_patient_age([notification], 'age')
+            self.assertNotEqual(before[notification.id],
+                                after[notification.id])
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
     def test_notification_age_none(self):
         """Tests if get_patient_age returns a value for age"""
 
@@ -193,6 +219,362 @@ class HealthDiseaseNotificationTestCase(unittest.TestCase):
             COV.save()
             COV.html_report()
 
+    def test_notification_age_search_order(self):
+        """Tests that age can be searched and ordered in the database"""
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+
+            notification, = self.notification.create([{'date_notified':datetime.now(),
+                                                       'date_onset':datetime.now().date(),
+                                                       'name':'Code',
+                                                       'patient':patient.id,
+                                                       'status':'waiting',
+                                                       'healthprof':healthprof.id}])
+
+            if patient.name.dob:
+                found = self.notification.search([('age', '>=', '0')])
+                self.assertTrue(notification in found)
+                found = self.notification.search([('age', '<', 0)])
+                self.assertFalse(notification in found)
+            else:
+                found = self.notification.search([('age', '=', None)])
+                self.assertTrue(notification in found)
+            ordered = self.notification.search([], order=[('age', 'ASC')])
+            self.assertTrue(notification in ordered)
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_epi_week_onset_stored(self):
+        """Tests that epi_week_onset follows date_onset and is searchable"""
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+            from trytond.modules.health_jamaica.tryton_utils import epiweek_str
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            onset = datetime.now().date() - timedelta(days=21)
+
+            notification, = self.notification.create([{'date_notified':datetime.now(),
+                                                       'date_onset':onset,
+                                                       'name':'Code',
+                                                       'patient':patient.id,
+                                                       'status':'waiting',
+                                                       'healthprof':healthprof.id}])
+            self.assertEqual(notification.epi_week_onset, epiweek_str(onset))
+            self.assertTrue(notification in self.notification.search(
+                [('epi_week_onset', '=', epiweek_str(onset))]))
+
+            self.notification.write([notification], {'date_onset': None})
+            self.assertEqual(notification.epi_week_onset, None)
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_patient_fields_match_patient(self):
+        """Tests that sex and puid are read from the patient's party"""
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+
+            notification, = self.notification.create([{'date_notified':datetime.now(),
+                                                       'name':'Code',
+                                                       'patient':patient.id,
+                                                       'status':'waiting',
+                                                       'healthprof':healthprof.id}])
+            values, = self.notification.read([notification.id],
+                                             ['sex', 'puid'])
+            self.assertEqual(values['sex'], patient.name.sex)
+            self.assertEqual(values['puid'], patient.name.ref)
+
+            new_sex = 'f' if patient.name.sex != 'f' else 'm'
+            self.party.write([patient.name], {'sex': new_sex})
+            self.assertTrue(notification in self.notification.search(
+                [('sex', '=', new_sex)]))
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_comments_short_computed_in_sql(self):
+        """Tests that comments_short is the 40 character one line preview"""
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            comments = 'Risk Factors: none\nOther Symptoms:\n' + 'x' * 100
+
+            notification, = self.notification.create([{'date_notified':datetime.now(),
+                                                       'comments':comments,
+                                                       'name':'Code',
+                                                       'patient':patient.id,
+                                                       'status':'waiting',
+                                                       'healthprof':healthprof.id}])
+            self.assertEqual(notification.comments_short,
+                             ' '.join(comments.split('\n'))[:40])
+            self.assertTrue(notification in self.notification.search(
+                [('comments_short', 'ilike', '%none Other%')]))
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_child_rec_names(self):
+        """Tests the batched rec_name of symptoms, risk factors and travel"""
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            diagnosis, = self.pathology.search([('code', '=', 'R46')])
+            country = POOL.get('country.country').create([{'name': 'Testland',
+                                                           'code': 'TL'}])[0]
+
+            notification, = self.notification.create([{'date_notified':datetime.now(),
+                                                       'name':'Code',
+                                                       'patient':patient.id,
+                                                       'status':'waiting',
+                                                       'healthprof':healthprof.id}])
+            symptoms = self.symptom.create([{'pathology':diagnosis.id,
+                                             'name': notification.id}] * 3)
+            risk_factor, = self.risk_factors.create([{'pathology':diagnosis.id,
+                                                      'notification': notification.id}])
+            travel, = self.hx_locations.create([{'country':country.id,
+                                                 'notification': notification.id}])
+
+            self.assertEqual(set([x.rec_name for x in symptoms]),
+                             set([diagnosis.rec_name]))
+            self.assertEqual(risk_factor.rec_name, diagnosis.rec_name)
+            self.assertEqual(travel.rec_name, 'Testland')
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_symptom_matrix(self):
+        """Tests the symptom rows of the raw data export"""
+        from trytond.modules.health_disease_notification.reports import (
+            symptom_matrix)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            rash, = self.pathology.search([('code', '=', 'R21')])
+            other, = self.pathology.search([('code', '=', 'R46')])
+
+            with_symptoms, without = self.notification.create(
+                [{'date_notified':datetime.now(), 'name':'',
+                  'patient':patient.id, 'status':'waiting',
+                  'healthprof':healthprof.id}] * 2)
+            self.symptom.create([{'pathology':rash.id,
+                                  'name': with_symptoms.id},
+                                 {'pathology':other.id,
+                                  'name': with_symptoms.id}])
+
+            rows = symptom_matrix([with_symptoms.id, without.id])
+            self.assertEqual(rows.keys(), [with_symptoms.id])
+            row = rows[with_symptoms.id]
+            self.assertEqual(row['R21'], u'Yes')
+            self.assertEqual(row['R51'], u'')
+            self.assertEqual(row.other, u'R46')
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_streaming_export(self):
+        """Tests that the streaming export has a row per notification"""
+        import csv
+        import tempfile
+        report = POOL.get('health_disease_notification.rawdata',
+                          type='report')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            rash, = self.pathology.search([('code', '=', 'R21')])
+
+            notifications = self.notification.create(
+                [{'date_notified':datetime.now(), 'name':'',
+                  'patient':patient.id, 'status':'waiting',
+                  'healthprof':healthprof.id, 'hospitalized': True}] * 3)
+            self.symptom.create([{'pathology':rash.id,
+                                  'name': notifications[0].id}])
+
+            output = tempfile.TemporaryFile()
+            self.assertEqual(report.export(map(int, notifications), 'csv',
+                                           output), 3)
+            output.seek(3)
+            rows = list(csv.reader(output))
+            heading = rows[0]
+            self.assertEqual(len(rows), 4)
+            self.assertTrue(all([len(x) == len(heading) for x in rows]))
+            rash_column = heading.index('Rash [R21]')
+            self.assertEqual(sorted([x[rash_column] for x in rows[1:]]),
+                             ['', '', 'Yes'])
+            self.assertEqual(set([x[heading.index('Hospitalised')]
+                                  for x in rows[1:]]), set(['Yes']))
+
+            # the file itself is handed back
+            _, content, _, _ = report.execute(map(int, notifications),
+                                              {'format': 'csv'})
+            self.assertEqual(len(str(content).splitlines()), 4)
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_specimen_has_result_and_lab_backlog(self):
+        """Tests the has_result searcher and the lab backlog"""
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            today = date.today()
+
+            notification, = self.notification.create([{'date_notified':datetime.now(),
+                                                       'name':'Code',
+                                                       'patient':patient.id,
+                                                       'status':'waiting',
+                                                       'healthprof':healthprof.id}])
+            tested, pending, old = self.specimens.create([
+                {'notification': notification.id, 'specimen_type': 'urine',
+                 'date_taken': today, 'lab_sent_to': 'Test Lab',
+                 'date_tested': today, 'lab_result_state': 'neg'},
+                {'notification': notification.id, 'specimen_type': 'urine',
+                 'date_taken': today, 'lab_sent_to': 'Test Lab'},
+                {'notification': notification.id, 'specimen_type': 'urine',
+                 'date_taken': today - timedelta(days=20),
+                 'lab_sent_to': 'Test Lab', 'date_tested': today}])
+
+            specimens = [tested, pending, old]
+            domain = [('notification', '=', notification.id)]
+            self.assertEqual(self.specimens.search(
+                domain + [('has_result', '=', True)]), [tested])
+            self.assertEqual(sorted(self.specimens.search(
+                domain + [('has_result', '=', False)])), sorted([pending, old]))
+            self.assertEqual([x.has_result for x in specimens],
+                             [True, False, False])
+
+            backlog = self.specimens.lab_backlog(lab='Test Lab')
+            self.assertEqual([(x['bucket'], x['specimens']) for x in backlog],
+                             [('15+ days', [old.id]),
+                              ('0-3 days', [pending.id])])
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_archive_and_restore(self):
+        """
+           Tests that archived notifications leave the searches but can
+           still be read with their symptoms, not changed, and that they
+           come back
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            diagnosis, = self.pathology.search([('code', '=', 'R46')])
+
+            notification, = self.notification.create([{'date_notified':datetime.now(),
+                                                       'name':'Code',
+                                                       'patient':patient.id,
+                                                       'status':'waiting',
+                                                       'healthprof':healthprof.id}])
+            symptom, = self.symptom.create([{'pathology':diagnosis.id,
+                                             'name': notification.id}])
+            self.notification.write([notification], {'active': False})
+            self.assertTrue(self.notification.archive() >= 1)
+
+            domain = [('id', '=', notification.id)]
+            with Transaction().set_context(active_test=False):
+                self.assertEqual(self.notification.search(domain), [])
+                with Transaction().set_context(archived=True):
+                    self.assertEqual(self.notification.search(domain),
+                                     [notification])
+            archived = self.notification(notification.id)
+            self.assertEqual(archived.storage, 'archive')
+            self.assertEqual([x.id for x in archived.symptoms], [symptom.id])
+            self.assertRaises(UserError, self.notification.write,
+                              [archived], {'status': 'suspected'})
+            self.assertRaises(UserError, self.notification.delete,
+                              [archived])
+            self.assertEqual(self.notification.reclassify([archived],
+                                                          'suspected'), 0)
+
+            self.notification.restore([archived])
+            with Transaction().set_context(active_test=False):
+                self.assertEqual(self.notification.search(domain),
+                                 [notification])
+            self.assertEqual(self.notification(notification.id).storage,
+                             'hot')
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_bulk_create_reserves_unique_codes(self):
+        """Tests that one create gets a distinct code for every notification"""
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            diagnosis, = self.pathology.search([('code', '=', 'A00')])
+
+            vlist = [{'date_notified':datetime.now(),
+                      'name':'A00:' if i % 2 else '',
+                      'diagnosis':diagnosis.id if i % 2 else None,
+                      'patient':patient.id,
+                      'status':'waiting',
+                      'healthprof':healthprof.id} for i in range(50)]
+            notifications = self.notification.create(vlist)
+            names = [x.name for x in notifications]
+            self.assertEqual(len(set(names)), 50)
+            self.assertTrue(all(x.startswith('A00:') for x in names[1::2]))
+            self.assertFalse(any(x.endswith(':') for x in names))
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_future_dates_are_rejected(self):
+        """Tests that validation names the notifications dated in the future"""
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+
+            try:
+                self.notification.create([{'date_notified':datetime.now(),
+                                           'date_onset':(datetime.now() +
+                                                         timedelta(days=2)).date(),
+                                           'name':'Future',
+                                           'patient':patient.id,
+                                           'status':'waiting',
+                                           'healthprof':healthprof.id}])
+            except UserError, error:
+                self.assertTrue('Future' in unicode(error))
+            else:
+                self.fail('Did not see UserError for date of onset in the future')
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
     def test_patient_is_required(self):
         """
            Tests to make sure patient always has to be attached to a 
@@ -371,6 +753,30 @@ class HealthDiseaseNotificationTestCase(unittest.TestCase):
             COV.save()
             COV.html_report()
 
+    def test_status_display_search_order(self):
+        """Tests that status_display can be searched and sorted in SQL"""
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+
+            notification, = self.notification.create([{'date_notified':datetime.now(),
+                                                       'name':'Code',
+                                                       'patient':patient.id,
+                                                       'status':'waiting',
+                                                       'healthprof':healthprof.id}])
+
+            self.assertEqual(notification.status_display,
+                             'Awaiting Classification')
+            found = self.notification.search(
+                [('status_display', '=', 'Awaiting Classification')],
+                order=[('status_display', 'ASC')])
+            self.assertTrue(notification in found)
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
     def test_diagnosis_type(self):
         """Tests if notification diagnosis is type gnuhealth.pathology"""
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
@@ -699,6 +1105,316 @@ class NotificationStateChangeTestCase(unittest.TestCase):
             COV.save()
             COV.html_report()
 
+    def test_write_status_records_state_changes(self):
+        """
+           Tests that a status write records one state change per
+           notification whose status actually changed
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+
+            notifications = self.notification.create([{'date_notified':datetime.now(),
+                                                       'patient':patient,
+                                                       'status':status,
+                                                       'healthprof':healthprof}
+                                                      for status in ['waiting', 'waiting',
+                                                                     'suspected']])
+            self.notification.write(notifications, {'status': 'suspected'})
+            changes = self.notification_state.search(
+                [('notification', 'in', [x.id for x in notifications]),
+                 ('orig_state', '!=', None)])
+            self.assertEqual(len(changes), 2)
+            for change in changes:
+                self.assertEqual(change.orig_state, 'waiting')
+                self.assertEqual(change.target_state, 'suspected')
+            created = self.notification_state.search(
+                [('notification', 'in', [x.id for x in notifications]),
+                 ('orig_state', '=', None)])
+            self.assertEqual(len(created), 3)
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_reclassify_in_bulk(self):
+        """
+           Tests that reclassify skips end states, reports the number of
+           changed notifications and records their state changes
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+
+            notifications = self.notification.create([{'date_notified':datetime.now(),
+                                                       'patient':patient,
+                                                       'status':status,
+                                                       'healthprof':healthprof}
+                                                      for status in ['waiting', 'waiting',
+                                                                     'suspected',
+                                                                     'confirmed']])
+            changed = self.notification.reclassify(notifications, 'suspected')
+            self.assertEqual(changed, 2)
+            statuses = [x['status'] for x in self.notification.read(
+                [x.id for x in notifications], ['status'])]
+            self.assertEqual(sorted(statuses),
+                             ['confirmed', 'suspected', 'suspected',
+                              'suspected'])
+            changes = self.notification_state.search(
+                [('notification', 'in', [x.id for x in notifications]),
+                 ('target_state', '=', 'suspected'),
+                 ('orig_state', '=', 'waiting')])
+            self.assertEqual(len(changes), 2)
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_case_counts_follow_notifications(self):
+        """
+           Tests that the case counts follow create, write, reclassify and
+           delete and that compact and rebuild keep them
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+            case_count = POOL.get('gnuhealth.disease_notification.case_count')
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            diagnosis, = POOL.get('gnuhealth.pathology').search(
+                [('code', '=', 'R46')])
+            onset = datetime.now().date()
+            week = self.notification._epi_week_values(
+                {'date_onset': onset})['epi_week_onset']
+
+            def counts():
+                return dict([(x['epi_week'], x['cases'])
+                             for x in case_count.weekly_counts(
+                                 week, week, status='waiting',
+                                 diagnoses=[diagnosis])])
+
+            before = counts().get(week, 0)
+            notifications = self.notification.create([{'date_notified':datetime.now(),
+                                                       'date_onset':onset,
+                                                       'diagnosis':diagnosis,
+                                                       'patient':patient,
+                                                       'status':'waiting',
+                                                       'healthprof':healthprof}
+                                                      for _ in range(3)])
+            self.assertEqual(counts().get(week, 0), before + 3)
+            self.notification.write(notifications[:1], {'status':'suspected'})
+            self.assertEqual(counts().get(week, 0), before + 2)
+            self.notification.reclassify(notifications[1:2], 'suspected')
+            self.assertEqual(counts().get(week, 0), before + 1)
+            self.notification.delete(notifications[2:])
+            self.assertEqual(counts().get(week, 0), before)
+
+            all_counts = case_count.weekly_counts()
+            case_count.compact()
+            self.assertEqual(case_count.weekly_counts(), all_counts)
+            case_count.rebuild()
+            self.assertEqual(case_count.weekly_counts(), all_counts)
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_case_count_report_counts(self):
+        """Tests the grouped counts and the epi weeks of the report"""
+        from trytond.modules.health_disease_notification.utils import (
+            epi_week_calendar)
+        report = POOL.get('health_disease_notification.case_count',
+                          type='report')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            diagnosis, = POOL.get('gnuhealth.pathology').search(
+                [('code', '=', 'R46')])
+            now = datetime.now()
+            onset = now.date()
+            week = self.notification._epi_week_values(
+                {'date_onset': onset})['epi_week_onset']
+            start, end = now - timedelta(1), now + timedelta(1)
+
+            def cases():
+                return dict([((x, y), z) for x, y, z in report.count_cases(
+                    start, end, 'waiting')]).get((diagnosis.id, week), 0)
+
+            before = cases()
+            notifications = self.notification.create([{'date_notified':now,
+                                                       'date_onset':onset,
+                                                       'diagnosis':diagnosis,
+                                                       'patient':patient,
+                                                       'status':'waiting',
+                                                       'healthprof':healthprof}
+                                                      for _ in range(3)])
+            self.assertEqual(cases(), before + 3)
+            self.notification.write(notifications[:1], {'active': False})
+            self.assertEqual(cases(), before + 2)
+
+            calendar = epi_week_calendar(date(2015, 12, 20), date(2016, 3, 1))
+            self.assertEqual(calendar[-1][1],
+                             self.notification._epi_week_values(
+                                 {'date_onset': date(2016, 3, 1)}
+                             )['epi_week_onset'])
+            self.assertTrue(all([(y[0] - x[0]).days == 7 for x, y in
+                                 zip(calendar, calendar[1:])]))
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_pivot_counts(self):
+        """Tests the counts and roll ups of the notification pivot"""
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            diagnosis, = POOL.get('gnuhealth.pathology').search(
+                [('code', '=', 'R46')])
+            onset = date(2001, 2, 14)
+            self.notification.create([{'date_notified': datetime.now(),
+                                       'date_onset': onset,
+                                       'diagnosis': diagnosis,
+                                       'patient': patient,
+                                       'status': status,
+                                       'healthprof': healthprof}
+                                      for status in ['waiting', 'waiting',
+                                                     'suspected']])
+            result = self.notification.pivot(['status', 'month'], onset,
+                                             onset, rollup=True)
+            columns = result['columns']
+            cells = dict([((x, y, z), c) for x, y, z, c in zip(
+                columns['status'], columns['month'], columns['rollup'],
+                columns['cases'])])
+            self.assertEqual(cells[('waiting', '2001-02', 0)], 2)
+            self.assertEqual(cells[('suspected', '2001-02', 0)], 1)
+            self.assertEqual(cells[('waiting', None, 1)], 2)
+            self.assertEqual(cells[(None, None, 3)], 3)
+            self.assertIn('waiting', dict(result['labels']['status']))
+
+            result = self.notification.pivot(['diagnosis'], onset, onset,
+                                             statuses=['suspected'])
+            self.assertEqual(result['columns'], {'diagnosis': [diagnosis.id],
+                                                 'cases': [1]})
+            self.assertRaises(UserError, self.notification.pivot, ['name'])
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_report_job_runs_queued_report(self):
+        """Tests that a queued report keeps its file and the queue limit"""
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+            report_job = POOL.get('gnuhealth.disease_notification.report_job')
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            notifications = self.notification.create(
+                [{'date_notified': datetime.now(),
+                  'patient': patient,
+                  'status': 'waiting',
+                  'healthprof': healthprof} for _ in range(2)])
+            job = report_job.enqueue('health_disease_notification.rawdata',
+                                     notifications, {'format': 'csv'})
+            self.assertEqual(job.state, 'queued')
+            report_job.run([job])
+            job = report_job(job.id)
+            self.assertEqual(job.state, 'done')
+            self.assertEqual(job.progress, 100)
+            self.assertTrue(job.file_name.endswith('.csv'))
+            # heading and two notifications
+            self.assertEqual(len(str(job.file).splitlines()), 3)
+
+            self.assertRaises(UserError, lambda: [
+                report_job.enqueue('health_disease_notification.case_count',
+                                   [], {'start_date': date.today(),
+                                        'end_date': date.today(),
+                                        'state': None})
+                for _ in range(10)])
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_report_cache_follows_notifications(self):
+        """
+           Tests that cached reports are dropped by changes to the
+           notifications they cover only, and the least recently used first
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+            report_cache = POOL.get(
+                'gnuhealth.disease_notification.report_cache')
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            now = datetime.now()
+            key = report_cache.make_key('test', {'state': None})
+            self.assertEqual(key, report_cache.make_key('test',
+                                                        {'state': None}))
+            report_cache.put('test', key, now - timedelta(1),
+                             now + timedelta(1),
+                             ('ods', buffer('counts'), False, 'Test'))
+            self.assertEqual(str(report_cache.get('test', key)[1]), 'counts')
+
+            values = {'date_notified':now - timedelta(3), 'name':'Code',
+                      'patient':patient, 'status':'waiting',
+                      'healthprof':healthprof}
+            notification, = self.notification.create([values])
+            self.assertNotEqual(report_cache.get('test', key), None)
+            self.notification.write([notification],
+                                    {'date_notified': now})
+            self.assertEqual(report_cache.get('test', key), None)
+
+            for name in ('old', 'new'):
+                report_cache.put('test', name, now, now + timedelta(1),
+                                 ('ods', buffer(name * 10), False, name))
+            report_cache.evict(30)
+            self.assertEqual(report_cache.get('test', 'old'), None)
+            self.assertNotEqual(report_cache.get('test', 'new'), None)
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
+    def test_report_cache_skips_unseen_changes(self):
+        """
+           Tests that cached reports computed without seeing a change to the
+           notifications they cover, or to a diagnosis, are not handed back
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            COV.start()
+            report_cache = POOL.get(
+                'gnuhealth.disease_notification.report_cache')
+
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            now = datetime.now()
+            values = {'date_notified':now, 'name':'Code',
+                      'patient':patient, 'status':'waiting',
+                      'healthprof':healthprof}
+            self.notification.create([values])
+            result = ('ods', buffer('counts'), False, 'Test')
+            # a snapshot of another transaction that saw nothing yet
+            report_cache.put('test', 'unseen', now - timedelta(1),
+                             now + timedelta(1), result, (0, '1:1:'))
+            self.assertEqual(report_cache.get('test', 'unseen'), None)
+            report_cache.put('test', 'seen', now - timedelta(1),
+                             now + timedelta(1), result)
+            self.assertNotEqual(report_cache.get('test', 'seen'), None)
+
+            diagnosis, = POOL.get('gnuhealth.pathology').search(
+                [('code', '=', 'R21')])
+            POOL.get('gnuhealth.pathology').write([diagnosis],
+                                                  {'name': 'Rash'})
+            self.assertEqual(report_cache.get('test', 'seen'), None)
+            COV.stop()
+            COV.save()
+            COV.html_report()
+
     def test_health_prof_name_is_string(self):
         """
            Testing for string in gnuhealth.disease_notification.statechange
@@ -722,6 +1438,8 @@ class NotificationStateChangeTestCase(unittest.TestCase):
                   'target_state':'waiting'
                  }])
             self.assertTrue(notification_state.healthprof.name.name, type(str))
+            self.assertEqual(notification_state.creator,
+                             healthprof.name.name)
             COV.stop()
             COV.save()
             COV.html_report()
@@ -757,6 +1475,239 @@ class GnuHealthSequencesTestCase(unittest.TestCase):
             COV.save()
             COV.html_report()
 
+class NotificationCodeTestCase(unittest.TestCase):
+    """Tests the worker code_mode for notification codes"""
+
+    def setUp(self):
+        pool = POOL
+        self.patient = pool.get('gnuhealth.patient')
+        self.notification = pool.get('gnuhealth.disease_notification')
+        self.healthprof = pool.get('gnuhealth.healthprofessional')
+
+    def test_generator_codes_unique_across_threads(self):
+        """
+           Tests that generators with different slots never hand out the
+           same code, however many threads use them at once
+        """
+        from ..utils import CodeGenerator
+        generators = [CodeGenerator(slot) for slot in range(4)]
+        codes = []
+
+        def make_codes(generator):
+            """generate codes in small batches"""
+            for _ in range(200):
+                codes.extend(generator.generate(5))
+
+        threads = [threading.Thread(target=make_codes, args=(x, ))
+                   for x in generators * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(codes), 4 * 4 * 200 * 5)
+        self.assertEqual(len(set(codes)), len(codes))
+        self.assertTrue(max(len(x) for x in codes) <= 24 - len('A00.0:'))
+
+    def test_generator_slot_width(self):
+        """Tests that the slot always takes two characters and never wraps"""
+        from ..utils import CodeGenerator, WORKER_SLOTS
+        self.assertTrue(CodeGenerator(0).generate()[0].endswith('00'))
+        self.assertTrue(CodeGenerator(WORKER_SLOTS - 1).generate()[0]
+                        .endswith('ZZ'))
+        self.assertRaises(ValueError, CodeGenerator, WORKER_SLOTS)
+
+    def test_parallel_create_without_unique_violations(self):
+        """
+           Stress test: many transactions create and commit notifications
+           at the same time and none of them hits the name_uniq constraint
+        """
+        from trytond.config import config
+        if not config.has_section('health_disease_notification'):
+            config.add_section('health_disease_notification')
+        config.set('health_disease_notification', 'code_mode', 'worker')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            healthprof, = self.healthprof.search([('id', '=', '1')])
+            patient, = self.patient.search([('id', '=', '1')])
+            values = {'date_notified': datetime.now(),
+                      'patient': patient.id,
+                      'status': 'waiting',
+                      'healthprof': healthprof.id}
+        violations = []
+        created = []
+
+        def create_notifications():
+            """create and commit a few small batches"""
+            for _ in range(10):
+                with Transaction().start(DB_NAME, USER,
+                                         context=CONTEXT) as transaction:
+                    try:
+                        records = self.notification.create(
+                            [values.copy() for _ in range(5)])
+                        created.extend([x.name for x in records])
+                        transaction.cursor.commit()
+                    except IntegrityError:
+                        violations.append(1)
+                        transaction.cursor.rollback()
+
+        try:
+            threads = [threading.Thread(target=create_notifications)
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            config.set('health_disease_notification', 'code_mode',
+                       'sequence')
+        self.assertEqual(violations, [])
+        self.assertEqual(len(created), 8 * 10 * 5)
+        self.assertEqual(len(set(created)), len(created))
+
+class AberrationTestCase(unittest.TestCase):
+    """Tests the aberration detection methods on synthetic counts"""
+
+    def setUp(self):
+        import numpy
+        from trytond.modules.health_disease_notification import aberration
+        self.aberration = aberration
+        random = numpy.random.RandomState(42)
+        self.counts = random.poisson(3, (20, 6 * 52)).astype(float)
+        # an outbreak in the last week of series 7
+        self.counts[7, -1] = 40
+
+    def test_rolling_baseline(self):
+        """Tests the rolling baseline against a plain mean and sd"""
+        mean, sd = self.aberration._rolling_baseline(self.counts, 3, 7)
+        week = 100
+        baseline = self.counts[:, week - 9:week - 2]
+        self.assertTrue(abs(mean[:, week] - baseline.mean(1)).max() < 1e-9)
+        self.assertTrue(abs(sd[:, week] - baseline.std(1, ddof=1)).max()
+                        < 1e-9)
+
+    def test_outbreak_flagged_by_every_method(self):
+        """Tests that each method flags the outbreak in the last week"""
+        weeks = self.counts.shape[1]
+        flagged = self.aberration.detect(self.counts, first_week=weeks - 1)
+        for method in self.aberration.METHODS:
+            self.assertTrue((7, weeks - 1) in
+                            [x[:2] for x in flagged[method]], method)
+
+    def test_week_index(self):
+        """Tests that epi weeks start on Sunday"""
+        self.assertEqual(self.aberration.week_index(date(2016, 1, 2)),
+                         self.aberration.week_index(date(2015, 12, 27)))
+        self.assertEqual(self.aberration.week_index(date(2016, 1, 3)),
+                         self.aberration.week_index(date(2016, 1, 2)) + 1)
+
+
+class ScanTestCase(unittest.TestCase):
+    """Tests the space-time permutation scan on synthetic notifications"""
+
+    def setUp(self):
+        import numpy
+        from trytond.modules.health_disease_notification import scan
+        self.scan = scan
+        random = numpy.random.RandomState(7)
+        # 40 communities, the first 10 in one post office, 20 weeks
+        self.zones = [[x] for x in range(40)] + [range(10)]
+        self.location = numpy.concatenate([random.randint(0, 40, 2000),
+                                           numpy.repeat(3, 60)])
+        self.week = numpy.concatenate([random.randint(0, 20, 2000),
+                                       random.randint(18, 20, 60)])
+
+    def test_outbreak_is_most_likely_cluster(self):
+        """Tests that the injected outbreak comes out on top"""
+        for prospective in (False, True):
+            clusters = self.scan.scan(self.location, self.week, self.zones,
+                                      40, 20, prospective=prospective,
+                                      replications=99, processes=1, seed=0)
+            cluster = clusters[0]
+            self.assertEqual(cluster['zone'], 3)
+            self.assertEqual(cluster['last_week'], 19)
+            self.assertTrue(cluster['p_value'] <= 0.01)
+
+    def test_process_pool_matches(self):
+        """Tests that the replications give the same p-values in a pool"""
+        kwargs = {'replications': 40, 'seed': 3}
+        alone = self.scan.scan(self.location, self.week, self.zones, 40, 20,
+                               processes=1, **kwargs)
+        pooled = self.scan.scan(self.location, self.week, self.zones, 40, 20,
+                                processes=2, **kwargs)
+        self.assertEqual([x['p_value'] for x in alone],
+                         [x['p_value'] for x in pooled])
+
+
+class DedupTestCase(unittest.TestCase):
+    """Tests the blocking and scoring of duplicate notifications"""
+
+    def setUp(self):
+        from trytond.modules.health_disease_notification import dedup
+        self.dedup = dedup
+        name = dedup.normalize_name
+        self.records = [
+            (1, name('Mary Brown'), date(1980, 1, 1), 5, date(2016, 3, 1)),
+            (2, name('Brown, Marie'), date(1980, 1, 1), 5, date(2016, 3, 9)),
+            (3, name('Mary Brown'), date(1981, 1, 1), 5, date(2016, 3, 20)),
+            (4, name('Mary Brown'), date(1980, 1, 1), 6, date(2016, 3, 1)),
+            (5, name('Paul Green'), date(1980, 1, 1), 5, date(2016, 3, 1))]
+
+    def test_normalize_name(self):
+        """Tests that case, accents, punctuation and order are ignored"""
+        self.assertEqual(self.dedup.normalize_name(u"O'Brien, Mary-Ann"),
+                         self.dedup.normalize_name(u'M\xe1ry Ann OBrien'))
+
+    def test_find_pairs(self):
+        """Tests that only similar notifications of a diagnosis pair up"""
+        self.assertEqual(sorted(self.dedup.find_pairs(self.records)),
+                         [(1, 2), (1, 3)])
+
+    def test_find_pairs_of_new(self):
+        """Tests that only the pairs with new notifications come out"""
+        self.assertEqual(sorted(self.dedup.find_pairs(self.records,
+                                                      new_ids=set([3]))),
+                         [(1, 3)])
+
+
+class SpreadsheetTestCase(unittest.TestCase):
+    """Tests the streaming spreadsheet writers"""
+
+    def setUp(self):
+        from trytond.modules.health_disease_notification import spreadsheet
+        self.spreadsheet = spreadsheet
+        self.rows = [[u'Code', u'Caf\xe9 <&>'],
+                     [u'A1', 12, 3.5, date(2016, 3, 20), None]]
+
+    def write(self, extension):
+        import tempfile
+        output = tempfile.TemporaryFile()
+        writer = self.spreadsheet.WRITERS[extension](output)
+        for row in self.rows:
+            writer.writerow(row)
+        writer.close()
+        output.seek(0)
+        return output
+
+    def test_csv(self):
+        """Tests that the csv export is UTF-8 with a byte order mark"""
+        self.assertEqual(self.write('csv').read(),
+                         '\xef\xbb\xbfCode,Caf\xc3\xa9 <&>\r\n'
+                         'A1,12,3.5,2016-03-20,\r\n')
+
+    def test_zipped(self):
+        """Tests that the xlsx and ods sheets are complete and escaped"""
+        import zipfile
+        from xml.dom import minidom
+        for extension, sheet in (('xlsx', 'xl/worksheets/sheet1.xml'),
+                                 ('ods', 'content.xml')):
+            package = zipfile.ZipFile(self.write(extension))
+            content = package.read(sheet)
+            minidom.parseString(content)
+            self.assertIn('Caf\xc3\xa9 &lt;&amp;&gt;', content)
+            self.assertEqual(content.count('<row>' if extension == 'xlsx'
+                                           else '<table:table-row>'), 2)
+        self.assertEqual(package.namelist()[0], 'mimetype')
+
+
 def suite():
     """Adding test cases to suite of tests in tryton"""
 
@@ -771,6 +1722,21 @@ def suite():
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
         GnuHealthSequencesTestCase))
 
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        NotificationCodeTestCase))
+
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        AberrationTestCase))
+
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        ScanTestCase))
+
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        DedupTestCase))
+
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        SpreadsheetTestCase))
+
     suite.addTests(doctest.DocFileSuite('test_models.rst',
                                         setUp=None, tearDown=None, 
                                         encoding='utf-8', 
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''
+Times the counts of the case count report on synthetic notifications.
+
+    python case_count_benchmark.py database [trytond.conf]
+
+Notifications are added to the database, 2000 a week going back from
+today, up to each of SIZES, and the report counts those of the last 4 weeks.
+Everything happens in one transaction that is rolled back at the end. The
+notifications of the report window are the same at every size, so the time
+should stay flat from 10k to 2M notifications.
+'''
+from __future__ import print_function
+import sys
+import time
+from datetime import datetime, timedelta
+
+SIZES = [10000, 100000, 500000, 2000000]
+PER_WEEK = 2000
+WEEKS = 4
+
+
+def add_notifications(cursor, first, last):
+    '''adds synthetic notifications first to last - 1, rows go back in time'''
+    cursor.execute('SELECT id FROM gnuhealth_patient ORDER BY id LIMIT 1')
+    patient, = cursor.fetchone()
+    cursor.execute('SELECT id FROM gnuhealth_pathology ORDER BY id LIMIT 20')
+    diagnoses = [x for x, in cursor.fetchall()]
+    # the epi weeks are iso weeks, which is close enough for timing
+    cursor.execute(
+        'INSERT INTO gnuhealth_disease_notification (create_uid, '
+        'create_date, name, patient, status, active, storage, diagnosis, '
+        'date_notified, date_onset, epi_week_onset) '
+        'SELECT 0, now(), \'BENCH\' || g, %s, '
+        '(ARRAY[\'suspected\', \'confirmed\', \'discarded\'])[1 + g %% 3], '
+        'true, \'hot\', (%s::int[])[1 + g %% %s], d, d::date - 3, '
+        'to_char(d - interval \'3 days\', \'IYYY/IW\') '
+        'FROM (SELECT g, now() - (g / %s) * interval \'7 days\' '
+        '- random() * interval \'7 days\' AS d '
+        'FROM generate_series(%s, %s) AS g) AS s',
+        (patient, diagnoses, len(diagnoses), PER_WEEK, first, last - 1))
+    cursor.execute('ANALYZE gnuhealth_disease_notification')
+
+
+def main(database, config_file=None):
+    from trytond.config import config
+    config.update_etc(config_file)
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(database)
+    pool.init()
+    with Transaction().start(database, 0) as transaction:
+        cursor = transaction.cursor
+        report = pool.get('health_disease_notification.case_count',
+                          type='report')
+        end_date = datetime.now()
+        start_date = end_date - timedelta(7 * WEEKS)
+        previous = 0
+        try:
+            for size in SIZES:
+                add_notifications(cursor, previous, size)
+                previous = size
+                start = time.time()
+                cells = report.count_cases(start_date, end_date)
+                elapsed = time.time() - start
+                print('%8d notifications: %d cases in %d cells, %.3fs' % (
+                    size, sum([x[2] for x in cells]), len(cells), elapsed))
+        finally:
+            cursor.rollback()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
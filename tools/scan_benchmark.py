@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+'''
+Times the space-time permutation scan on synthetic notifications.
+
+    python scan_benchmark.py [notifications] [replications] [processes]
+
+The cases are spread at random over 800 communities in 100 post offices
+and 52 weeks, with an outbreak of 600 extra cases in one community over the
+last 4 weeks, which the scan should find with the smallest p-value.
+'''
+from __future__ import print_function
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import scan  # noqa
+
+COMMUNITIES = 800
+POST_OFFICES = 100
+WEEKS = 52
+OUTBREAK = (5, 600)
+
+
+def synthetic(notifications, seed=1):
+    '''returns location, week and zones of the synthetic notifications'''
+    random = np.random.RandomState(seed)
+    post_office = random.randint(0, POST_OFFICES, COMMUNITIES)
+    community, extra = OUTBREAK
+    location = np.concatenate([
+        random.randint(0, COMMUNITIES, notifications),
+        np.repeat(community, extra)])
+    week = np.concatenate([random.randint(0, WEEKS, notifications),
+                           random.randint(WEEKS - 4, WEEKS, extra)])
+    zones = [[x] for x in range(COMMUNITIES)]
+    zones.extend([list(np.nonzero(post_office == x)[0])
+                  for x in range(POST_OFFICES)])
+    return location, week, zones
+
+
+def main(notifications=500000, replications=999, processes=None):
+    location, week, zones = synthetic(notifications)
+    for prospective in (False, True):
+        start = time.time()
+        clusters = scan.scan(location, week, zones, COMMUNITIES, WEEKS,
+                             prospective=prospective,
+                             replications=replications, processes=processes,
+                             seed=0)
+        elapsed = time.time() - start
+        cluster = clusters[0]
+        print('%s scan of %d notifications, %d replications: %.1fs' % (
+            'prospective' if prospective else 'retrospective',
+            len(location), replications, elapsed))
+        print('  most likely cluster: zone %(zone)d, weeks %(first_week)d '
+              'to %(last_week)d, %(cases)d cases for %(expected).1f '
+              'expected, p = %(p_value).4f' % cluster)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,241 @@
+'''Helpers shared by the disease notification models, reports and wizards'''
+import time
+import threading
+from datetime import date, timedelta
+from weakref import WeakKeyDictionary
+from sql import operators, Column, Expression
+from sql.functions import Function
+from trytond.pool import Pool
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+from trytond.modules.health_jamaica.tryton_utils import (get_epi_week,
+                                                         epiweek_str)
+
+# maps domain operators to their python-sql counterparts for use in the
+# searchers of function fields
+SQL_OPERATORS = {
+    '=': operators.Equal,
+    '!=': operators.NotEqual,
+    'like': operators.Like,
+    'ilike': operators.ILike,
+    'not like': operators.NotLike,
+    'not ilike': operators.NotILike,
+    'in': operators.In,
+    'not in': operators.NotIn,
+    '<=': operators.LessEqual,
+    '>=': operators.GreaterEqual,
+    '<': operators.Less,
+    '>': operators.Greater,
+}
+
+_TRANSACTION_CACHES = WeakKeyDictionary()
+# {year: [(first day, epiweek_str)]} of the epi weeks starting in year
+_EPI_WEEK_CALENDAR = {}
+_EPI_WEEK_LOCK = threading.Lock()
+
+
+def transaction_cache(name):
+    '''
+    returns a dict, identified by name, that lives only as long as the
+    cursor of the current transaction. Use it for values that are
+    expensive to compute but may not be shared between transactions.
+    '''
+    cursor = Transaction().cursor
+    caches = _TRANSACTION_CACHES.setdefault(cursor, {})
+    return caches.setdefault(name, {})
+
+
+def clear_transaction_cache(name, keys=None):
+    '''removes keys (or everything) from the named transaction cache'''
+    cache = transaction_cache(name)
+    if keys is None:
+        cache.clear()
+    else:
+        for key in keys:
+            cache.pop(key, None)
+
+
+def cached_field_values(model_name, ids, field_name='rec_name'):
+    '''
+    returns {id: field_name} for the records of model_name in ids. Values
+    are kept, per language, for the rest of the transaction so that only
+    records not seen before are read, all with one read.
+    '''
+    cache = transaction_cache('field_values.%s.%s.%s' % (
+        model_name, field_name, Transaction().language))
+    missing = [x for x in set(ids) if x is not None and x not in cache]
+    if missing:
+        Model = Pool().get(model_name)
+        for values in Model.read(missing, [field_name]):
+            cache[values['id']] = values[field_name]
+    return dict([(x, cache.get(x)) for x in ids])
+
+
+def many2one_values(Model, records, field_names, target_field='rec_name'):
+    '''
+    returns {record id: [target_field of the record in each Many2One of
+    field_names]}. The links are read for all records with one query per
+    slice of ids and the targets with cached_field_values.
+    '''
+    cursor = Transaction().cursor
+    table = Model.__table__()
+    ids = map(int, records)
+    links = {}
+    for sub_ids in grouped_slice(ids):
+        cursor.execute(*table.select(
+            table.id, *[Column(table, x) for x in field_names],
+            where=reduce_ids(table.id, list(sub_ids))))
+        links.update([(x[0], x[1:]) for x in cursor.fetchall()])
+    values = {}
+    for index, field_name in enumerate(field_names):
+        target = getattr(Model, field_name).model_name
+        values[field_name] = cached_field_values(
+            target, [x[index] for x in links.itervalues()], target_field)
+    return dict([(x, [values[f].get(links[x][i]) if x in links else None
+                      for i, f in enumerate(field_names)])
+                 for x in ids])
+
+
+def domain_fields(domain):
+    '''returns the names of the fields that domain has clauses on'''
+    names = set()
+    if (len(domain) >= 3 and isinstance(domain[0], basestring)
+            and domain[0] not in ('AND', 'OR')
+            and isinstance(domain[1], basestring)):
+        names.add(domain[0].split('.')[0])
+        return names
+    for clause in domain:
+        if isinstance(clause, (list, tuple)):
+            names.update(domain_fields(clause))
+    return names
+
+
+def _epi_weeks_of_year(year):
+    with _EPI_WEEK_LOCK:
+        if year not in _EPI_WEEK_CALENDAR:
+            weeks = []
+            day = get_epi_week(date(year, 1, 1))[0]
+            if day.year < year:
+                day += timedelta(7)
+            while day.year == year:
+                weeks.append((day, epiweek_str(day)))
+                day += timedelta(7)
+            _EPI_WEEK_CALENDAR[year] = weeks
+        return _EPI_WEEK_CALENDAR[year]
+
+
+def epi_week_calendar(start_date, end_date):
+    '''
+    returns [(first day, epiweek_str)] of the epi weeks from the one of
+    start_date to the one of end_date, both included. The weeks of a year
+    are worked out once per process.
+    '''
+    first = get_epi_week(start_date)[0]
+    last = get_epi_week(end_date)[0]
+    return [x for year in range(first.year, last.year + 1)
+            for x in _epi_weeks_of_year(year) if first <= x[0] <= last]
+
+
+class Rollup(Expression):
+    '''
+    ROLLUP (expressions) for the GROUP BY of a select (PostgreSQL 9.5 and
+    later): the groups of all the expressions, then of all but the last
+    and so on down to the grand total
+    '''
+    __slots__ = ('expressions',)
+
+    def __init__(self, *expressions):
+        super(Rollup, self).__init__()
+        self.expressions = expressions
+
+    def __str__(self):
+        return 'ROLLUP (%s)' % ', '.join(map(str, self.expressions))
+
+    @property
+    def params(self):
+        params = ()
+        for expression in self.expressions:
+            params += expression.params
+        return params
+
+
+class Replace(Function):
+    '''REPLACE(string, from, to): string with every from replaced by to'''
+    __slots__ = ()
+    _function = 'REPLACE'
+
+
+class TxidCurrent(Function):
+    '''TXID_CURRENT(): the id of the current transaction'''
+    __slots__ = ()
+    _function = 'TXID_CURRENT'
+
+
+class Grouping(Function):
+    '''
+    the bit mask of the arguments that are rolled up in the current row,
+    the first argument is the highest bit
+    '''
+    __slots__ = ()
+    _function = 'GROUPING'
+
+
+def format_age(years, months, days):
+    '''
+    formats the components of an interval as returned by the AGE function
+    the way the iso_8601 intervalstyle would, e.g. 34y 2m 5d
+    '''
+    if years is None:
+        return None
+    parts = [(int(v), u) for v, u in [(years, 'y'), (months, 'm'),
+                                      (days, 'd')] if v]
+    if not parts:
+        return '0d'
+    return ' '.join(['%d%s' % x for x in parts])
+
+
+# characters of the worker slot in the codes of CodeGenerator
+SLOT_WIDTH = 2
+WORKER_SLOTS = 36 ** SLOT_WIDTH
+
+
+def base36(number):
+    '''returns the non-negative integer number in base 36, upper case'''
+    digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    out = ''
+    while True:
+        number, rem = divmod(number, 36)
+        out = digits[rem] + out
+        if not number:
+            return out
+
+
+class CodeGenerator(object):
+    '''
+    Generates compact, roughly time ordered codes without touching a
+    shared counter. A code is the timestamp (in ticks of rounding seconds
+    since offset) in hexadecimal, followed by the node and a two character
+    worker slot that together identify the process that issued it. The
+    generator never issues the same tick twice, so codes stay unique as
+    long as no two live processes share a node and slot. slot is from 0
+    to WORKER_SLOTS - 1.
+    '''
+
+    def __init__(self, slot, node='', offset=1325412420.0, rounding=0.1):
+        if not 0 <= slot < WORKER_SLOTS:
+            raise ValueError('worker slot %s does not fit in %s characters'
+                             % (slot, SLOT_WIDTH))
+        self.suffix = '%s%s' % (node, base36(slot).rjust(SLOT_WIDTH, '0'))
+        self.offset = offset
+        self.rounding = rounding
+        self.last = 0
+        self.lock = threading.Lock()
+
+    def generate(self, count=1):
+        '''returns count new codes'''
+        with self.lock:
+            now = int((time.time() - self.offset) / self.rounding)
+            first = max(now, self.last + 1)
+            self.last = first + count - 1
+        return ['%X%s' % (x, self.suffix) for x in xrange(first,
+                                                           first + count)]
@@ -1,11 +1,14 @@
 
 from datetime import datetime
-from trytond.wizard import StateAction
+from trytond.model import ModelView, fields
+from trytond.wizard import (Wizard, StateAction, StateView, StateTransition,
+                            Button)
 from trytond.transaction import Transaction
 from trytond.pool import Pool
-from trytond.pyson import PYSONEncoder
+from trytond.pyson import PYSONEncoder, Eval, Bool
 from trytond.modules.health_encounter.wizard import OneEncounterWizard
 from trytond.modules.health_jamaica.tryton_utils import localtime
+from .models import NOTIFICATION_STATES, NOTIFICATION_END_STATES
 
 class NotifyFromEncounter(OneEncounterWizard):
     'Disease Notification from Encounter'
@@ -44,3 +47,102 @@ class NotifyFromEncounter(OneEncounterWizard):
             })
 
         return action, rd
+
+
+class ReclassifyStart(ModelView):
+    'Reclassify Notifications'
+    __name__ = 'gnuhealth.disease_notification.reclassify.start'
+
+    selected_only = fields.Boolean(
+        'Selected notifications only',
+        help='Reclassify the notifications selected in the list instead of '
+        'those matching the filters below')
+    diagnosis = fields.Many2One(
+        'gnuhealth.pathology', 'Suspected Diagnosis',
+        states={'invisible': Bool(Eval('selected_only'))})
+    status = fields.Selection(
+        [x for x in NOTIFICATION_STATES if x[0] not in NOTIFICATION_END_STATES],
+        'Current Status', sort=False,
+        states={'invisible': Bool(Eval('selected_only'))})
+    on_or_after = fields.Date(
+        'Onset on or after',
+        states={'invisible': Bool(Eval('selected_only'))})
+    on_or_before = fields.Date(
+        'Onset on or before',
+        states={'invisible': Bool(Eval('selected_only'))})
+    target_status = fields.Selection(
+        [x for x in NOTIFICATION_STATES if x[0]], 'New Status',
+        required=True, sort=False)
+
+
+class ReclassifyDone(ModelView):
+    'Reclassify Notifications'
+    __name__ = 'gnuhealth.disease_notification.reclassify.done'
+
+    changed = fields.Integer('Notifications reclassified', readonly=True)
+
+
+class ReclassifyWizard(Wizard):
+    'Reclassify Notifications'
+    __name__ = 'gnuhealth.disease_notification.reclassify'
+
+    start = StateView(
+        'gnuhealth.disease_notification.reclassify.start',
+        'health_disease_notification.view_form-reclassify_start',
+        [Button('Cancel', 'end', 'tryton-cancel'),
+         Button('Reclassify', 'reclassify', 'tryton-ok', default=True)])
+    reclassify = StateTransition()
+    done = StateView(
+        'gnuhealth.disease_notification.reclassify.done',
+        'health_disease_notification.view_form-reclassify_done',
+        [Button('Close', 'end', 'tryton-close', default=True)])
+
+    @classmethod
+    def __setup__(cls):
+        super(ReclassifyWizard, cls).__setup__()
+        cls._error_messages.update({
+            'no_selection': 'No notifications are selected.',
+            'no_filter': 'Set at least one filter, reclassifying every '
+            'notification is not allowed.',
+        })
+
+    @staticmethod
+    def _selected_ids():
+        context = Transaction().context
+        if context.get('active_model') == 'gnuhealth.disease_notification':
+            return context.get('active_ids') or []
+        return []
+
+    def default_start(self, fields):
+        return {'selected_only': bool(self._selected_ids())}
+
+    def get_domain(self):
+        '''the search domain built from the filters of the start view'''
+        domain = []
+        if self.start.diagnosis:
+            domain.append(('diagnosis', '=', self.start.diagnosis.id))
+        if self.start.status:
+            domain.append(('status', '=', self.start.status))
+        if self.start.on_or_after:
+            domain.append(('date_onset', '>=', self.start.on_or_after))
+        if self.start.on_or_before:
+            domain.append(('date_onset', '<=', self.start.on_or_before))
+        return domain
+
+    def transition_reclassify(self):
+        Notification = Pool().get('gnuhealth.disease_notification')
+        if self.start.selected_only:
+            if not self._selected_ids():
+                self.raise_user_error('no_selection')
+            records = Notification.browse(self._selected_ids())
+        else:
+            domain = self.get_domain()
+            if not domain:
+                self.raise_user_error('no_filter')
+            records = Notification.search(domain)
+        self.done.changed = Notification.reclassify(
+            records, self.start.target_status)
+        return 'done'
+
+    def default_done(self, fields):
+        return {'changed': self.done.changed}